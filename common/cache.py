@@ -0,0 +1,100 @@
+"""
+Binary cache of the parsed text data files, shared by myCML and myCDL through their utils modules
+"""
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+from scipy.sparse import csr_matrix
+
+
+def file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+CACHE_ARRAYS = ("data", "indices", "indptr")
+
+
+def parser_name(parse):
+    return "{}.{}".format(parse.__module__, parse.__name__)
+
+
+def cached_csr_matrix(path, parse, version=1, cache_dir=None):
+    """
+    Return parse(path) as a csr_matrix. The first call stores the matrix arrays as raw .npy files in
+    `<cache_dir>/<file name>.<parse module>.<parse name>.cache/`, later calls memory-map them read-only so that
+    several processes share the same pages. The cache is rebuilt when the content of the source file, the parser
+    or its version changes.
+    :param path: the source text file
+    :param parse: the parser turning path into a sparse matrix, e.g. read_index_lists
+    :param version: the version of parse, bump it whenever the output of parse changes
+    :param cache_dir: where to keep the cache (default: next to the source file)
+    :return: csr_matrix
+    """
+    stat = os.stat(path)
+    cache_path = os.path.join(cache_dir or os.path.dirname(path) or ".",
+                              "{}.{}.cache".format(os.path.basename(path), parser_name(parse)))
+    try:
+        with open(os.path.join(cache_path, "meta.json")) as f:
+            meta = json.load(f)
+    except (IOError, ValueError):
+        meta = None
+    # a cache written by another parser or version is rebuilt
+    if meta is not None and (meta.get("parser") != parser_name(parse) or meta.get("parser_version") != version):
+        meta = None
+    # size and mtime are enough to trust the cache, a touched file is only re-hashed
+    if meta is not None and meta["size"] == stat.st_size and \
+            (meta["mtime"] == stat.st_mtime or meta["sha1"] == file_digest(path)):
+        if meta["mtime"] != stat.st_mtime:
+            # same content, the new mtime spares the next loads the hash
+            meta["mtime"] = stat.st_mtime
+            try:
+                write_meta(cache_path, meta)
+            except OSError as e:
+                print("Could not update {}: {}".format(cache_path, e))
+        arrays = tuple(np.load(os.path.join(cache_path, name + ".npy"), mmap_mode="r") for name in CACHE_ARRAYS)
+        return csr_matrix(arrays, shape=tuple(meta["shape"]), copy=False)
+
+    matrix = csr_matrix(parse(path))
+    meta = {"source": os.path.abspath(path), "size": stat.st_size, "mtime": stat.st_mtime,
+            "sha1": file_digest(path), "shape": list(matrix.shape), "parser": parser_name(parse),
+            "parser_version": version}
+    try:
+        write_cache(cache_path, matrix, meta)
+    except OSError as e:
+        print("Could not cache {} in {}: {}".format(path, cache_path, e))
+    return matrix
+
+
+def write_cache(cache_path, matrix, meta):
+    # write into a fresh directory and rename it, so that concurrent readers never see a partial cache
+    tmp_path = tempfile.mkdtemp(prefix=os.path.basename(cache_path) + ".", dir=os.path.dirname(cache_path))
+    try:
+        for name in CACHE_ARRAYS:
+            np.save(os.path.join(tmp_path, name + ".npy"), getattr(matrix, name))
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        if os.path.isdir(cache_path):
+            # processes that still map the old arrays keep their pages until they unmap them
+            shutil.rmtree(cache_path, ignore_errors=True)
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.isdir(cache_path):
+            raise
+
+
+def write_meta(cache_path, meta):
+    # replace meta.json by a rename, readers see the old or the new file but never half of one
+    fd, tmp_path = tempfile.mkstemp(prefix="meta.", suffix=".json", dir=cache_path)
+    with os.fdopen(fd, "w") as f:
+        json.dump(meta, f)
+    os.rename(tmp_path, os.path.join(cache_path, "meta.json"))
@@ -0,0 +1,139 @@
+"""
+Buffered text log and columnar metrics of a training run, shared by myCML and myCDL through their utils modules
+"""
+import atexit
+import os
+import numpy as np
+
+
+COLUMNAR_FORMATS = (None, "csv", "npy")
+
+
+class MetricsWriter(object):
+    """
+    Buffered log and metrics writer. The log file stays open for the whole run and the buffered lines are written
+    every flush_every records, instead of reopening the file for every line. The numeric records are also kept
+    column by column and saved at every flush as `<log stem>.metrics.csv` or `<log stem>.metrics/<column>.npy`,
+    so that they load without parsing the text log, see load_metrics.
+    """
+
+    def __init__(self, path, mode="a", flush_every=100, columnar=None):
+        """
+        :param path: the text log, e.g. cdl.log
+        :param mode: "a" appends to the log, "w" starts a new one
+        :param flush_every: number of records buffered before they are written
+        :param columnar: None, "csv" or "npy", the format of the records saved next to the log
+        """
+        if columnar not in COLUMNAR_FORMATS:
+            raise ValueError("columnar must be one of {}".format(COLUMNAR_FORMATS))
+        self.path = path
+        self.file = open(path, mode)
+        self.flush_every = flush_every
+        self.columnar = columnar
+        self.metrics_path = os.path.splitext(path)[0] + (".metrics.csv" if columnar == "csv" else ".metrics")
+        self.lines = []
+        self.records = []
+        self.n_pending = 0
+
+    def log(self, line):
+        """
+        Buffer a line of the text log
+        """
+        self.lines.append(line)
+        self.n_pending += 1
+        if self.n_pending >= self.flush_every:
+            self.flush()
+
+    def record(self, values, line=None):
+        """
+        :param values: a dict of numbers, e.g. {"epoch": 3, "loss": 0.5}. Records may have different keys, the
+               missing values are saved as NaN
+        :param line: (optional) the line of the record in the text log
+        """
+        self.records.append(values)
+        if line is None:
+            self.n_pending += 1
+            if self.n_pending >= self.flush_every:
+                self.flush()
+        else:
+            self.log(line)
+
+    def columns(self):
+        """
+        :return: (names, columns) the record keys in order of appearance and a float64 array per key
+        """
+        names = []
+        for values in self.records:
+            names.extend(name for name in values if name not in names)
+        return names, [np.array([values.get(name, np.nan) for values in self.records], dtype=np.float64)
+                       for name in names]
+
+    def flush(self):
+        if self.lines:
+            self.file.write("\n".join(self.lines) + "\n")
+            self.lines = []
+        self.file.flush()
+        if self.columnar is not None and self.records:
+            save_columns(self.metrics_path, *self.columns())
+        self.n_pending = 0
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def save_columns(path, names, columns):
+    """
+    Save the columns as a CSV file if path ends with .csv, otherwise as one .npy file per column in the directory path
+    """
+    if path.endswith(".csv"):
+        np.savetxt(path, np.column_stack(columns), delimiter=",", header=",".join(names), comments="")
+        return
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for name, column in zip(names, columns):
+        np.save(os.path.join(path, name + ".npy"), column)
+
+
+def load_metrics(path):
+    """
+    :param path: the metrics_path of a MetricsWriter, a .metrics.csv file or a .metrics directory
+    :return: a dict of float64 arrays, one per column
+    """
+    if path.endswith(".csv"):
+        with open(path) as f:
+            names = f.readline().strip().split(",")
+        columns = np.loadtxt(path, delimiter=",", skiprows=1, ndmin=2)
+        return dict((name, columns[:, i]) for i, name in enumerate(names))
+    return dict((name[:-len(".npy")], np.load(os.path.join(path, name)))
+                for name in os.listdir(path) if name.endswith(".npy"))
+
+
+METRICS_WRITERS = {}
+
+
+def metrics_writer(path, **kwargs):
+    """
+    :return: the MetricsWriter of path, created with kwargs by the first call, so that every module logging to
+             the same file shares one open file and one buffer. The writers are closed at exit.
+    """
+    key = os.path.abspath(path)
+    if key not in METRICS_WRITERS or METRICS_WRITERS[key].file.closed:
+        METRICS_WRITERS[key] = MetricsWriter(path, **kwargs)
+    return METRICS_WRITERS[key]
+
+
+def close_metrics_writers():
+    for writer in METRICS_WRITERS.values():
+        writer.close()
+    METRICS_WRITERS.clear()
+
+
+atexit.register(close_metrics_writers)
@@ -1,53 +1,241 @@
 # pylint: skip-file
+import multiprocessing
+import os
+from multiprocessing.sharedctypes import RawArray
 import numpy as np
+from scipy.sparse import csr_matrix
+from utils import metrics_writer
+
+# number of KxK systems solved at once by solve_rows
+CHUNK_ROWS = 4096
+# number of observed entries gathered at once by solve_rows and observed_predictions
+CHUNK_NNZ = 65536
+# number of row ranges per worker of a BCDPool half-step, more balance the workers better
+SHARDS_PER_WORKER = 4
+# the BLAS and OpenMP thread counts of the BCDPool workers, set to 1: the workers already share out the cores
+WORKER_THREAD_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS')
+
+def observed(R):
+    """
+    :param R: the (num_u, num_v) rating matrix, dense (np.mat, ndarray) or any scipy.sparse format
+    :return: the positive entries of R, the observed ones, as a csr_matrix
+    """
+    R = csr_matrix(R, dtype=np.float64, copy=True)
+    R.data[R.data < 0] = 0
+    R.eliminate_zeros()
+    return R
+
+def solve_rows(R, Y, Y_sq, a, b, reg, prior=None):
+    """
+    Solve the ALS system of every row i of R, the Gram matrix of the unobserved entries Y_sq being shared:
+        (Y_sq + (a-b)*Y_i'*Y_i + reg*I) * x_i = a*Y_i'*R_i + reg*prior_i
+    where Y_i are the rows of Y of the entries observed in row i. The rows are taken by increasing number of
+    observed entries, so that the Y_i of a chunk stack into a (rows, n, K) array with little zero padding, and
+    the systems of a chunk are solved at once.
+    :param R: (N, M) csr_matrix of the observed entries
+    :param Y: (M, K) the fixed factors
+    :param Y_sq: b*Y'*Y
+    :param a: confidence of the observed entries
+    :param b: confidence of the unobserved entries
+    :param reg: the weight of the Gaussian prior of the x_i
+    :param prior: (optional) (N, K) the means of the priors (default: 0)
+    :return: (N, K) the x_i
+    """
+    K = Y.shape[1]
+    X = np.empty((R.shape[0], K))
+    shared = Y_sq+np.eye(K)*reg
+    rhs = a*R.dot(Y)
+    if prior is not None:
+        rhs += reg*prior
+    counts = np.diff(R.indptr)
+    order = np.argsort(counts, kind='mergesort')
+    sorted_counts = counts[order]
+    start = 0
+    while start < len(order):
+        # at most CHUNK_ROWS rows and CHUNK_NNZ padded entries, but at least one row
+        n_padded = np.arange(1, CHUNK_ROWS+1)[:len(order)-start]*sorted_counts[start:start+CHUNK_ROWS]
+        rows = order[start:start+max(1, np.count_nonzero(n_padded <= CHUNK_NNZ))]
+        n = counts[rows[-1]]
+        R_rows = R[rows]
+        entries = np.repeat(np.arange(len(rows)), np.diff(R_rows.indptr))
+        positions = np.arange(R_rows.nnz)-np.repeat(R_rows.indptr[:-1], np.diff(R_rows.indptr))
+        Y_obs = np.zeros((len(rows), n, K))
+        Y_obs[entries, positions] = Y[R_rows.indices]
+        A = np.matmul(Y_obs.transpose(0, 2, 1), Y_obs)
+        A *= a-b
+        A += shared
+        X[rows] = np.linalg.solve(A, rhs[rows][:,:,None])[:,:,0]
+        start += len(rows)
+    return X
+
+def observed_predictions(R, U, V):
+    """
+    :return: U_i.V_j of every observed entry (i, j) of the csr_matrix R, in the order of R.data
+    """
+    rows = np.repeat(np.arange(R.shape[0]), np.diff(R.indptr))
+    predictions = np.empty(R.nnz)
+    for start in range(0, R.nnz, CHUNK_NNZ):
+        stop = start+CHUNK_NNZ
+        predictions[start:stop] = np.einsum('ij,ij->i', U[rows[start:stop]], V[R.indices[start:stop]])
+    return predictions
+
+def BCD_loss(R, U, V, theta, a, b, lambda_u, lambda_v):
+    """
+    sum_ij C_ij*(R_ij-U_i.V_j)^2/2 plus the priors of U and V, where C_ij is a on the observed entries and
+    b elsewhere. The unobserved entries are summed as b*sum(U'U * V'V) minus their observed part, so that
+    the dense residual U*V'-R is never built.
+    """
+    predictions = observed_predictions(R, U, V)
+    E = b*np.sum(U.T.dot(U)*V.T.dot(V))
+    E = E+np.sum(a*np.square(R.data-predictions)-b*np.square(predictions))
+    reg_loss_v = np.sum(np.square(theta-V))/2.0
+    reg_loss_u = np.sum(np.square(U))/2.0
+    return E/2.0+lambda_v*reg_loss_v+lambda_u*reg_loss_u
+
+def shared_array(shape):
+    """
+    :return: (raw, view) a float64 array of shape in shared memory and a numpy view on it
+    """
+    raw = RawArray('d', int(np.prod(shape)))
+    return raw, np.frombuffer(raw, dtype=np.float64).reshape(shape)
+
+# the ratings and shared arrays of a BCDPool worker, set by init_worker
+worker_state = {}
+
+def worker_context():
+    """
+    :return: the forkserver context where available (python 3, POSIX), so that the workers start from a fresh
+             process instead of forking the BLAS and MXNet threads of the trainer, else the multiprocessing module
+    """
+    if hasattr(multiprocessing, 'get_context') and 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing
+
+def init_worker(R, R_t, arrays):
+    try:
+        # a forked worker inherits the BLAS pool of its parent, the WORKER_THREAD_VARS only size new ones
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(1)
+    except ImportError:
+        pass
+    worker_state['R'] = R
+    worker_state['R_t'] = R_t
+    for name, (raw, shape) in arrays.items():
+        worker_state[name] = np.frombuffer(raw, dtype=np.float64).reshape(shape)
+
+def solve_shard(task):
+    """
+    Solve the rows start:stop of a half-step in a BCDPool worker: the items (V from U and theta) if transposed,
+    else the users (U from V). The solutions are written to the shared V or U.
+    """
+    transposed, start, stop, Y_sq, a, b, reg = task
+    if transposed:
+        X = solve_rows(worker_state['R_t'][start:stop], worker_state['U'], Y_sq, a, b, reg,
+                       worker_state['theta'][start:stop])
+        worker_state['V'][start:stop] = X
+    else:
+        worker_state['U'][start:stop] = solve_rows(worker_state['R'][start:stop], worker_state['V'], Y_sq, a, b, reg)
+
+class BCDPool(object):
+    """
+    A pool of worker processes solving the users and the items of the BCD_one half-steps in parallel. The
+    ratings are sent once to every worker, U, V and theta live in shared memory: the workers read the fixed
+    factors from it and write their rows of the solved ones back. Pass the pool to every BCD_one call on the
+    same R and close it (or use it as a context manager) at the end.
+    """
+    def __init__(self, R, K, n_workers=2):
+        """
+        :param R: the (num_u, num_v) rating matrix, dense or scipy.sparse
+        :param K: the number of factors
+        :param n_workers: number of worker processes, each running single-threaded BLAS
+        """
+        self.R = observed(R)
+        self.R_t = self.R.T.tocsr()
+        num_u, num_v = self.R.shape
+        self.n_workers = n_workers
+        self.arrays = {}
+        self.views = {}
+        for name, shape in (('U', (num_u, K)), ('V', (num_v, K)), ('theta', (num_v, K))):
+            raw, self.views[name] = shared_array(shape)
+            self.arrays[name] = (raw, shape)
+        # the workers read the WORKER_THREAD_VARS when they load BLAS, the trainer keeps its own
+        saved = dict((name, os.environ.get(name)) for name in WORKER_THREAD_VARS)
+        os.environ.update((name, '1') for name in WORKER_THREAD_VARS)
+        try:
+            self.pool = worker_context().Pool(n_workers, init_worker, (self.R, self.R_t, self.arrays))
+        finally:
+            for name, value in saved.items():
+                if value is None:
+                    del os.environ[name]
+                else:
+                    os.environ[name] = value
+
+    def solve_V(self, U, theta, a, b, lambda_v):
+        """
+        :return: the item half-step of BCD_one, the V solving every item for the fixed U
+        """
+        self.views['U'][:] = U
+        self.views['theta'][:] = theta
+        self.run(True, U.T.dot(U)*b, a, b, lambda_v)
+        return self.views['V'].copy()
+
+    def solve_U(self, V, a, b, lambda_u):
+        """
+        :return: the user half-step of BCD_one, the U solving every user for the fixed V
+        """
+        self.views['V'][:] = V
+        self.run(False, V.T.dot(V)*b, a, b, lambda_u)
+        return self.views['U'].copy()
+
+    def run(self, transposed, Y_sq, a, b, reg):
+        n_rows = self.R_t.shape[0] if transposed else self.R.shape[0]
+        bounds = np.linspace(0, n_rows, self.n_workers*SHARDS_PER_WORKER+1).astype(np.int64)
+        self.pool.map(solve_shard, [(transposed, start, stop, Y_sq, a, b, reg)
+                                    for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start])
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
 def BCD_one(R, U, V, theta, lambda_u, lambda_v, dir_save='.',
-        get_loss=False, num_iter=1):
-    U = U.T
-    V = np.mat(V.T)
-    theta = np.mat(theta.T)
-    num_v = R.shape[1]
-    num_u = R.shape[0]
-    K = U.shape[0]
+        get_loss=False, num_iter=1, pool=None):
+    """
+    num_iter rounds of alternating least squares on V then U
+    :param R: the (num_u, num_v) rating matrix, dense or scipy.sparse, its positive entries are the observed ones
+    :param U: (num_u, K) user factors
+    :param V: (num_v, K) item factors
+    :param theta: (num_v, K) the encoder outputs, the prior means of V
+    :param pool: (optional) a BCDPool built on R, to solve the users and the items in parallel
+    :return: (U, V, E) with U a np.mat, V an ndarray and E the loss if get_loss else 0
+    """
     a = 1
     b = 0.01
-    a_m_b = a-b
-    I_u = np.mat(np.eye(K)*lambda_u)
-    I_v = np.mat(np.eye(K)*lambda_v)
-    C  = np.mat(np.ones(R.shape))*b
-    C[np.where(R>0)] = a
-    #print 'I: %d, J: %d, K: %d' % (num_u,num_v,K)
+    R = observed(R) if pool is None else pool.R
+    R_t = R.T.tocsr() if pool is None else pool.R_t
+    U = np.array(U, dtype=np.float64)
+    V = np.array(V, dtype=np.float64)
+    theta = np.asarray(theta, dtype=np.float64)
     for it in range(num_iter):
-        U_sq = U*U.T*b
-        for j in range(num_v):
-            idx_a = np.where(R[:,j]>0)[0]#.A1
-            U_cut = U[:,idx_a]
-            V[:,j] = np.linalg.pinv(U_sq+U_cut*U_cut.T*a_m_b+I_v)*(U_cut*R[idx_a,j]+lambda_v*theta[:,j])
-        V_sq = V*V.T*b
-        for i in range(num_u):
-            idx_a = np.where(R[i,:]>0)[1]#.A1
-            V_cut = V[:,idx_a]
-            U[:,i] = np.linalg.pinv(V_sq+V_cut*V_cut.T*a_m_b+I_u)*(V_cut*R[i,idx_a].T)
+        if pool is None:
+            V = solve_rows(R_t, U, U.T.dot(U)*b, a, b, lambda_v, theta)
+            U = solve_rows(R, V, V.T.dot(V)*b, a, b, lambda_u)
+        else:
+            V = pool.solve_V(U, theta, a, b, lambda_v)
+            U = pool.solve_U(V, a, b, lambda_u)
         if it%10==9:
-            E = U.T*V-R
-            E = np.sum(np.multiply(C,np.square(E)))/2.0
-            reg_loss_v = np.sum(np.square(theta-V))/2.0
-            reg_loss_u = np.sum(np.square(U))/2.0
-            E = E+lambda_v*reg_loss_v+lambda_u*reg_loss_u
-            print 'Iter %d - E: %.3f' % (it,E)
-            fp = open(dir_save+'/cdl.log','a')
-            fp.write('Iter %d - E: %.3f\n' % (it,E))
-            fp.close()
+            E = BCD_loss(R, U, V, theta, a, b, lambda_u, lambda_v)
+            print('Iter %d - E: %.3f' % (it,E))
+            metrics_writer(os.path.join(dir_save, 'cdl.log')).record(
+                {'iter': it, 'bcd_err': E}, 'Iter %d - E: %.3f' % (it,E))
 
     if get_loss:
-        E = U.T*V-R
-        E = np.sum(np.multiply(C,np.square(E)))/2.0
-        reg_loss_v = np.sum(np.square(theta-V))/2.0
-        reg_loss_u = np.sum(np.square(U))/2.0
-        E = E+lambda_v*reg_loss_v+lambda_u*reg_loss_u
-        #print 'E: %.3f' % E
+        E = BCD_loss(R, U, V, theta, a, b, lambda_u, lambda_v)
     else:
         E = 0
-    U = U.T
-    V = np.asarray(V.T)
-    return U, V, E
-
+    return np.mat(U), V, E
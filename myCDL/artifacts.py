@@ -0,0 +1,106 @@
+"""
+CDL model artifacts: U, V and theta as raw float32 .npy files next to a JSON manifest, loadable with mmap_mode='r'.
+Convert the final-*.dat text dumps of older runs with
+
+    python artifacts.py cdl4
+"""
+from __future__ import print_function
+
+import json
+import os
+import re
+import sys
+
+import numpy as np
+
+ARRAYS = ('U', 'V', 'theta')
+MANIFEST = 'manifest.json'
+FORMAT_VERSION = 1
+
+
+def array_file(name):
+    return 'final-%s.npy' % name
+
+
+def save_model(dir_save, arrays, **manifest):
+    """
+    Save the arrays as float32 .npy files, then the manifest listing them
+    :param dir_save: the run directory, e.g. cdl4
+    :param arrays: a dict of the (n, K) factors, keyed by 'U', 'V' and/or 'theta'
+    :param manifest: the hyper-parameters and results of the run, e.g. K, lambda_u, lambda_v, epoch, loss
+    :return: the manifest
+    """
+    manifest = dict(manifest, version=FORMAT_VERSION, arrays={})
+    for name, array in sorted(arrays.items()):
+        array = np.ascontiguousarray(array, dtype=np.float32)
+        np.save(os.path.join(dir_save, array_file(name)), array)
+        manifest['arrays'][name] = {'file': array_file(name), 'shape': list(array.shape), 'dtype': 'float32'}
+    # written last, a run directory with a manifest holds every array it lists
+    with open(os.path.join(dir_save, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_model(dir_save, mmap_mode='r'):
+    """
+    :param dir_save: a run directory written by save_model or convert_dat
+    :param mmap_mode: 'r' maps the arrays read-only without reading them, None loads them in memory
+    :return: (arrays, manifest) the dict of the arrays listed by the manifest, and the manifest
+    """
+    path = os.path.join(dir_save, MANIFEST)
+    if not os.path.exists(path):
+        raise IOError('%s not found, convert the .dat files of %s with: python artifacts.py %s'
+                      % (path, dir_save, dir_save))
+    with open(path) as f:
+        manifest = json.load(f)
+    arrays = {}
+    for name, meta in manifest['arrays'].items():
+        arrays[name] = np.load(os.path.join(dir_save, meta['file']), mmap_mode=mmap_mode)
+    return arrays, manifest
+
+
+def parse_log(path):
+    """
+    :return: the K, lambdas, last epoch and training error found in a cdl.log, {} without a log
+    """
+    manifest = {}
+    if not os.path.exists(path):
+        return manifest
+    with open(path) as f:
+        for line in f:
+            match = re.match(r'p\d+: lambda_v/lambda_u/ratio/K: ([\d.]+)/([\d.]+)/([\d.]+)/(\d+)', line)
+            if match:
+                manifest.update(lambda_v=float(match.group(1)), lambda_u=float(match.group(2)),
+                                lambda_ratio=float(match.group(3)), K=int(match.group(4)))
+            match = re.match(r'Epoch (\d+) ', line)
+            if match:
+                manifest['epoch'] = int(match.group(1))
+            match = re.match(r'Training error: ([\d.]+)', line)
+            if match:
+                manifest['loss'] = float(match.group(1))
+    return manifest
+
+
+def convert_dat(dir_save):
+    """
+    Convert the final-U.dat, final-V.dat and final-theta.dat found in dir_save to .npy files and a manifest, with
+    the hyper-parameters of its cdl.log. The values keep the %.5f rounding of the text dumps.
+    :return: the manifest
+    """
+    arrays = {}
+    for name in ARRAYS:
+        path = os.path.join(dir_save, 'final-%s.dat' % name)
+        if os.path.exists(path):
+            arrays[name] = np.loadtxt(path, dtype=np.float32, ndmin=2)
+    if not arrays:
+        raise IOError('no final-*.dat in %s' % dir_save)
+    manifest = parse_log(os.path.join(dir_save, 'cdl.log'))
+    manifest.setdefault('K', next(iter(arrays.values())).shape[1])
+    return save_model(dir_save, arrays, converted_from='dat', **manifest)
+
+
+if __name__ == '__main__':
+    for dir_save in sys.argv[1:]:
+        manifest = convert_dat(dir_save)
+        print('%s: %s' % (dir_save, ', '.join('%s %s' % (name, tuple(meta['shape']))
+                                             for name, meta in sorted(manifest['arrays'].items()))))
@@ -5,6 +5,8 @@ import numpy as np
 import model
 import logging
 from solver import Solver, Monitor
+from BCD_one import BCDPool
+from utils import to_dense
 try:
    import cPickle as pickle
 except:
@@ -141,6 +143,8 @@ class AutoEncoderModel(model.MXModel):
     def layerwise_pretrain(self, X, batch_size, n_iter, optimizer, l_rate, decay, lr_scheduler=None):
         def l2_norm(label, pred):
             return np.mean(np.square(label-pred))/2.0
+        # the network takes dense batches, X may be the csr_matrix of data.get_mult
+        X = to_dense(X)
         solver = Solver(optimizer, momentum=0.9, wd=decay, learning_rate=l_rate, lr_scheduler=lr_scheduler)
         solver.set_metric(mx.metric.CustomMetric(l2_norm))
         solver.set_monitor(Monitor(1000))
@@ -158,9 +162,11 @@ class AutoEncoderModel(model.MXModel):
             solver.solve(self.xpu, self.stacks[i], self.args, self.args_grad, self.auxs, data_iter_i,
                          0, n_iter, {}, False)
 
-    def finetune(self, X, R, V, lambda_v_rt, lambda_u, lambda_v, dir_save, batch_size, n_iter, optimizer, l_rate, decay, lr_scheduler=None):
+    def finetune(self, X, R, V, lambda_v_rt, lambda_u, lambda_v, dir_save, batch_size, n_iter, optimizer, l_rate, decay, lr_scheduler=None, n_workers=1):
         def l2_norm(label, pred):
            return np.mean(np.square(label-pred))/2.0
+        # the network takes dense batches, X may be the csr_matrix of data.get_mult, R stays sparse
+        X = to_dense(X)
         solver = Solver(optimizer, momentum=0.9, wd=decay, learning_rate=l_rate, lr_scheduler=lr_scheduler)
         solver.set_metric(mx.metric.CustomMetric(l2_norm))
         solver.set_monitor(Monitor(1000))
@@ -169,15 +175,22 @@ class AutoEncoderModel(model.MXModel):
                 batch_size=batch_size, shuffle=False,
                 last_batch_handle='pad')
         logging.info('Fine tuning...')
-        # self.loss is the net
-        U, V, theta, BCD_loss = solver.solve(X, R, V, lambda_v_rt, lambda_u,
-            lambda_v, dir_save, batch_size, self.xpu, self.loss, self.args, self.args_grad, self.auxs, data_iter,
-            0, n_iter, {}, False)
+        # solve the users and the items of BCD_one in n_workers processes
+        pool = BCDPool(R, V.shape[1], n_workers) if n_workers > 1 else None
+        try:
+            # self.loss is the net
+            U, V, theta, BCD_loss = solver.solve(X, R, V, lambda_v_rt, lambda_u,
+                lambda_v, dir_save, batch_size, self.xpu, self.loss, self.args, self.args_grad, self.auxs, data_iter,
+                0, n_iter, {}, False, pool)
+        finally:
+            if pool is not None:
+                pool.close()
         return U, V, theta, BCD_loss
 
     # modified by hog
     def eval(self, X, V, lambda_v_rt):
         batch_size = 100
+        X = to_dense(X)
         data_iter = mx.io.NDArrayIter({'data': X, 'V': V, 'lambda_v_rt':
             lambda_v_rt},
             batch_size=batch_size, shuffle=False,
@@ -0,0 +1,205 @@
+"""
+Benchmarks of the CDL solvers against the original implementations. Run from this directory, e.g.
+
+    python benchmark.py bcd
+"""
+from __future__ import print_function
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from artifacts import convert_dat, load_model, save_model
+from BCD_one import BCD_one, BCDPool
+from data import read_user
+from evaluate import evaluate
+from mult import read_mult
+
+
+def timed(function, *args, **kwargs):
+    start = time.time()
+    result = function(*args, **kwargs)
+    return time.time() - start, result
+
+
+def BCD_one_dense(R, U, V, theta, lambda_u, lambda_v, num_iter=1):
+    """
+    The original BCD_one: a dense confidence matrix and one pinv per user and per item
+    """
+    U = U.T
+    V = np.mat(V.T)
+    theta = np.mat(theta.T)
+    num_v = R.shape[1]
+    num_u = R.shape[0]
+    K = U.shape[0]
+    a = 1
+    b = 0.01
+    a_m_b = a-b
+    I_u = np.mat(np.eye(K)*lambda_u)
+    I_v = np.mat(np.eye(K)*lambda_v)
+    C = np.mat(np.ones(R.shape))*b
+    C[np.where(R>0)] = a
+    for it in range(num_iter):
+        U_sq = U*U.T*b
+        for j in range(num_v):
+            idx_a = np.where(R[:,j]>0)[0]
+            U_cut = U[:,idx_a]
+            V[:,j] = np.linalg.pinv(U_sq+U_cut*U_cut.T*a_m_b+I_v)*(U_cut*R[idx_a,j]+lambda_v*theta[:,j])
+        V_sq = V*V.T*b
+        for i in range(num_u):
+            idx_a = np.where(R[i,:]>0)[1]
+            V_cut = V[:,idx_a]
+            U[:,i] = np.linalg.pinv(V_sq+V_cut*V_cut.T*a_m_b+I_u)*(V_cut*R[i,idx_a].T)
+    E = U.T*V-R
+    E = np.sum(np.multiply(C,np.square(E)))/2.0
+    reg_loss_v = np.sum(np.square(theta-V))/2.0
+    reg_loss_u = np.sum(np.square(U))/2.0
+    E = E+lambda_v*reg_loss_v+lambda_u*reg_loss_u
+    return U.T, np.asarray(V.T), E
+
+
+def citeulike_factors(K=50, seed=1):
+    """
+    :return: (R, U, V, theta) the citeulike train ratings as a csr_matrix and random factors
+    """
+    rng = np.random.RandomState(seed)
+    R = read_user()
+    num_u, num_v = R.shape
+    U = np.mat(rng.rand(num_u, K)/10)
+    V = rng.rand(num_v, K)/10
+    theta = rng.rand(num_v, K)/10
+    return R, U, V, theta
+
+
+def benchmark_bcd(num_iter=2, lambda_u=1, lambda_v=10, K=50):
+    """
+    BCD_one on sparse R against the dense original on citeulike: time and the largest differences of U, V and E
+    """
+    R, U, V, theta = citeulike_factors(K)
+    # the original takes a dense R and updates U in place
+    dense_time, (U_dense, V_dense, E_dense) = timed(BCD_one_dense, np.mat(R.toarray()), U.copy(), V, theta,
+                                                     lambda_u, lambda_v, num_iter)
+    sparse_time, (U_sparse, V_sparse, E_sparse) = timed(BCD_one, R, U, V, theta, lambda_u, lambda_v,
+                                                        tempfile.gettempdir(), True, num_iter)
+    print('%d x %d, K=%d, %d iterations: dense %.2fs, sparse %.2fs (%.0fx)' % (
+        R.shape[0], R.shape[1], K, num_iter, dense_time, sparse_time, dense_time/sparse_time))
+    print('max |dU| %.2e, max |dV| %.2e, E %.6f vs %.6f' % (
+        np.abs(U_dense-U_sparse).max(), np.abs(V_dense-V_sparse).max(), E_dense, E_sparse))
+    assert np.allclose(U_dense, U_sparse, atol=1e-6) and np.allclose(V_dense, V_sparse, atol=1e-6)
+    assert np.isclose(E_dense, E_sparse, rtol=1e-6)
+
+
+def benchmark_bcd_scaling(max_workers=None, num_iter=2, lambda_u=1, lambda_v=10, K=50):
+    """
+    Strong scaling of BCD_one with a BCDPool on citeulike, from 1 to max_workers processes (default: every core),
+    against the serial solver
+    """
+    max_workers = max_workers or multiprocessing.cpu_count()
+    R, U, V, theta = citeulike_factors(K)
+    serial_time, (U_serial, V_serial, _) = timed(BCD_one, R, U, V, theta, lambda_u, lambda_v,
+                                                 tempfile.gettempdir(), False, num_iter)
+    print('serial: %.2fs' % serial_time)
+    n_workers = 1
+    while True:
+        with BCDPool(R, K, n_workers) as pool:
+            parallel_time, (U_parallel, V_parallel, _) = timed(BCD_one, R, U, V, theta, lambda_u, lambda_v,
+                                                               tempfile.gettempdir(), False, num_iter, pool)
+        assert np.allclose(U_serial, U_parallel) and np.allclose(V_serial, V_parallel)
+        print('%d workers: %.2fs, speedup %.2f, efficiency %.0f%%' % (
+            n_workers, parallel_time, serial_time/parallel_time, 100*serial_time/parallel_time/n_workers))
+        if n_workers == max_workers:
+            break
+        n_workers = min(2*n_workers, max_workers)
+
+
+def write_synthetic_mult(path, num_docs=16980, D=8000, max_words=300, seed=1):
+    """
+    Write a mult.dat of num_docs documents of up to max_words distinct words
+    """
+    rng = np.random.RandomState(seed)
+    with open(path, 'w') as f:
+        for _ in range(num_docs):
+            n = rng.randint(1, max_words)
+            words = rng.choice(D, n, replace=False)
+            f.write('%d %s\n' % (n, ' '.join('%d:%d' % pair for pair in zip(words, rng.randint(1, 20, n)))))
+
+
+def benchmark_loaders(num_docs=16980, D=8000):
+    """
+    read_mult on a synthetic mult.dat and read_user on citeulike: parse and cached load times, and the size of
+    the csr matrices against the dense arrays they replace
+    """
+    data_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(data_dir, 'mult.dat')
+        write_synthetic_mult(path, num_docs, D)
+        for name, load in (('read_mult', lambda: read_mult(path)),
+                           ('read_user', lambda: read_user('cf-train-1-users.dat'))):
+            parse_time, X = timed(load)
+            cached_time, _ = timed(load)
+            nbytes = X.data.nbytes+X.indices.nbytes+X.indptr.nbytes
+            print('%s %s: %.2fs, %.3fs cached, %.1fMB csr vs %.1fMB dense float64' % (
+                name, X.shape, parse_time, cached_time, nbytes/2.**20, X.shape[0]*X.shape[1]*8/2.**20))
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def benchmark_artifacts(K=50, seed=1):
+    """
+    Load times of citeulike-sized factors from the %.5f text dumps and from the .npy artifacts, and their errors
+    """
+    rng = np.random.RandomState(seed)
+    arrays = {'U': rng.randn(5551, K)/5, 'V': rng.randn(16980, K)/5, 'theta': rng.randn(16980, K)/5}
+    dat_dir, npy_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+    try:
+        for name, array in arrays.items():
+            np.savetxt(os.path.join(dat_dir, 'final-%s.dat' % name), array, fmt='%.5f', comments='')
+        dat_time, dat = timed(lambda: dict((name, np.loadtxt(os.path.join(dat_dir, 'final-%s.dat' % name)))
+                                           for name in arrays))
+        convert_time, _ = timed(convert_dat, dat_dir)
+        save_model(npy_dir, arrays, K=K)
+        mmap_time, (mapped, _) = timed(load_model, npy_dir)
+        load_time, (loaded, _) = timed(load_model, npy_dir, None)
+        print('loadtxt %.2fs, convert %.2fs, load_model %.4fs mmap, %.4fs in memory' % (
+            dat_time, convert_time, mmap_time, load_time))
+        print('max error: text %.1e, float32 .npy %.1e' % (
+            max(np.abs(dat[name]-array).max() for name, array in arrays.items()),
+            max(np.abs(loaded[name]-array).max() for name, array in arrays.items())))
+        print('sizes: %s' % ', '.join('%s %.1fMB/%.1fMB' % (
+            name, os.path.getsize(os.path.join(dat_dir, 'final-%s.dat' % name))/2.**20,
+            os.path.getsize(os.path.join(npy_dir, 'final-%s.npy' % name))/2.**20) for name in sorted(arrays)))
+        assert all(np.array_equal(mapped[name], loaded[name]) for name in arrays)
+    finally:
+        shutil.rmtree(dat_dir)
+        shutil.rmtree(npy_dir)
+
+
+def benchmark_evaluate(K=50, seed=1):
+    """
+    evaluate.evaluate on citeulike-sized random factors: the whole metric suite of every user in one scoring pass
+    """
+    rng = np.random.RandomState(seed)
+    train = read_user('cf-train-1-users.dat')
+    test = read_user('cf-test-1-users.dat', *train.shape)
+    U, V = rng.randn(train.shape[0], K), rng.randn(train.shape[1], K)
+    evaluate_time, (results, _) = timed(evaluate, U, V, test, train, (8, 50))
+    print('%d users x %d items: %.2fs for %s' % (train.shape[0], train.shape[1], evaluate_time,
+                                                ', '.join(sorted(name for name in results if name != 'n_users'))))
+
+
+BENCHMARKS = {
+    'artifacts': benchmark_artifacts,
+    'bcd': benchmark_bcd,
+    'bcd_scaling': benchmark_bcd_scaling,
+    'evaluate': benchmark_evaluate,
+    'loaders': benchmark_loaders,
+}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
@@ -14,7 +14,9 @@ import logging
 import data
 from math import sqrt
 from autoencoder import AutoEncoderModel
+from artifacts import save_model
 import os
+from utils import metrics_writer
 
 if __name__ == '__main__':
     lambda_u = 1 # lambda_u in CDL
@@ -24,23 +26,30 @@ if __name__ == '__main__':
     is_dummy = False
     num_iter = 34000
     batch_size = 256
+    # processes solving the users and items of BCD_one, 1 solves them in the trainer. The speedup has only
+    # been measured on one core: raise it up to multiprocessing.cpu_count() after python benchmark.py bcd_scaling
+    n_workers = 1
 
     np.random.seed(1234) # set seed
     lv = 1e-2 # lambda_v/lambda_n in CDL
     dir_save = 'cdl%d' % p
     if not os.path.isdir(dir_save):
         os.system('mkdir %s' % dir_save)
-    fp = open(dir_save+'/cdl.log','w')
+    # cdl.log is opened once for the run, BCD_one and the solver log to it through metrics_writer,
+    # their per-epoch losses are also saved column by column in cdl.metrics/ (see utils.load_metrics)
+    log = metrics_writer(os.path.join(dir_save, 'cdl.log'), mode='w', columnar='npy')
     print 'p%d: lambda_v/lambda_u/ratio/K: %f/%f/%f/%d' % (p,lambda_v,lambda_u,lv,K)
-    fp.write('p%d: lambda_v/lambda_u/ratio/K: %f/%f/%f/%d\n' % \
+    log.log('p%d: lambda_v/lambda_u/ratio/K: %f/%f/%f/%d' % \
             (p,lambda_v,lambda_u,lv,K))
-    fp.close()
     if is_dummy:
         X = data.get_dummy_mult()
         R = data.read_dummy_user()
     else:
         X = data.get_mult()
-        R = data.read_user()
+        # one column per mult.dat document, the last items may have no train ratings
+        R = data.read_user(num_v=X.shape[0])
+    if R.shape[1] != X.shape[0]:
+        raise ValueError('%d items rated but %d documents in mult.dat' % (R.shape[1], X.shape[0]))
     # set to INFO to see less information during training
     logging.basicConfig(level=logging.DEBUG)
     #ae_model = AutoEncoderModel(mx.gpu(0), [784,500,500,2000,10], pt_dropout=0.2,
@@ -58,16 +67,17 @@ if __name__ == '__main__':
     U, V, theta, BCD_loss = ae_model.finetune(train_X, R, V, lambda_v_rt, lambda_u,
             lambda_v, dir_save, batch_size,
             num_iter, 'sgd', l_rate=0.1, decay=0.0,
-            lr_scheduler=mx.misc.FactorScheduler(20000,0.1))
+            lr_scheduler=mx.misc.FactorScheduler(20000,0.1), n_workers=n_workers)
     #ae_model.save('cdl_pt.arg')
-    np.savetxt(dir_save+'/final-U.dat',U,fmt='%.5f',comments='')
-    np.savetxt(dir_save+'/final-V.dat',V,fmt='%.5f',comments='')
-    np.savetxt(dir_save+'/final-theta.dat',theta,fmt='%.5f',comments='')
 
     #ae_model.load('cdl_pt.arg')
     Recon_loss = lambda_v/lv*ae_model.eval(train_X,V,lambda_v_rt)
     print "Training error: %.3f" % (BCD_loss+Recon_loss)
-    fp = open(dir_save+'/cdl.log','a')
-    fp.write("Training error: %.3f\n" % (BCD_loss+Recon_loss))
-    fp.close()
+    log.log("Training error: %.3f" % (BCD_loss+Recon_loss))
+    # final-U.npy, final-V.npy, final-theta.npy and manifest.json, see artifacts.load_model
+    epochs = [record['epoch'] for record in log.records if 'epoch' in record]
+    save_model(dir_save, {'U': U, 'V': V, 'theta': theta}, K=K, lambda_u=lambda_u, lambda_v=lambda_v,
+               lambda_ratio=lv, epoch=epochs[-1] if epochs else 0, loss=float(BCD_loss+Recon_loss),
+               bcd_loss=float(BCD_loss), recon_loss=float(Recon_loss))
+    log.close()
     #print "Validation error:", ae_model.eval(val_X)
@@ -1,27 +1,36 @@
 import numpy as np
+from scipy.sparse import csr_matrix
 from mult import read_mult
+from utils import INDEX_LISTS_VERSION, cached_csr_matrix, read_index_lists, resize_csr
 
 def get_mult():
-    X = read_mult('mult.dat',8000).astype(np.float32)
+    X = read_mult('mult.dat')
     return X
 
 def get_dummy_mult():
     X = np.random.rand(100,100)
     X[X<0.9] = 0
-    return X
+    return csr_matrix(X, dtype=np.float32)
+
+def parse_user(f_in):
+    # 'N item item ...' per user
+    return read_index_lists(f_in)
 
-def read_user(f_in='cf-train-1-users.dat',num_u=5551,num_v=16980):
-    fp = open(f_in)
-    R = np.mat(np.zeros((num_u,num_v)))
-    for i,line in enumerate(fp):
-        segs = line.strip().split(' ')[1:]
-        for seg in segs:
-            R[i,int(seg)] = 1
+def read_user(f_in='cf-train-1-users.dat',num_u=None,num_v=None):
+    """
+    :param num_u: the number of users (default: the number of lines)
+    :param num_v: the number of items (default: the largest item id + 1), pass the train num_v to a test file
+    :return: the binary (num_u, num_v) float32 csr_matrix of the ratings
+    """
+    R = resize_csr(cached_csr_matrix(f_in, parse_user, INDEX_LISTS_VERSION), num_u, num_v, dtype=np.float32)
+    # an item listed twice is rated once
+    R.sum_duplicates()
+    R.data[:] = 1
     return R
 
 def read_dummy_user():
-    R = np.mat(np.random.rand(100,100))
+    R = np.random.rand(100,100)
     R[R<0.9] = 0
     R[R>0.8] = 1
-    return R
+    return csr_matrix(R, dtype=np.float32)
 
@@ -0,0 +1,186 @@
+"""
+Offline evaluation of a CDL run: precision@K, recall@K, NDCG@K and AUC of every test user from a single scoring
+pass over the factors of artifacts.load_model, e.g.
+
+    python evaluate.py cdl4 -k 8 50
+
+writes cdl4/results.json and the rec-list.dat read by show_recommendation.py
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from artifacts import load_model
+from data import read_user
+
+# bytes available to the scores of one chunk of users and their working copies
+MEMORY_BUDGET = 256 * 2 ** 20
+# float64 arrays of (chunk, n_items) alive at once while scoring: the scores and their sorted copy
+ARRAYS_PER_CHUNK = 3
+
+
+def scoring_chunk_size(n_items, memory_budget=MEMORY_BUDGET):
+    """
+    :return: the number of users whose scores fit in memory_budget
+    """
+    return max(1, int(memory_budget // (n_items * 8 * ARRAYS_PER_CHUNK)))
+
+
+def top_k(scores, k):
+    """
+    :return: the (n, k) indices of the k largest scores of every row, best first
+    """
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    rows = np.arange(len(scores))[:, None]
+    return top[rows, np.argsort(-scores[rows, top], axis=1)]
+
+
+def auc_scores(scores, test_rows, test_items, n_test, n_negative):
+    """
+    :param scores: (n, n_items) scores, the excluded items set to +inf so that they rank above every candidate
+    :param test_rows: the rows of the test items, sorted
+    :param test_items: the test items, none of them excluded
+    :return: the (n,) AUC of every row, from the average ranks of its test items among its candidates
+    """
+    sorted_scores = np.sort(scores, axis=1)
+    test_scores = scores[test_rows, test_items]
+    ranks = np.empty(len(test_scores))
+    bounds = np.searchsorted(test_rows, np.arange(len(scores) + 1))
+    for row, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:])):
+        # ties share their ranks
+        ranks[start:stop] = (np.searchsorted(sorted_scores[row], test_scores[start:stop], 'left') +
+                             np.searchsorted(sorted_scores[row], test_scores[start:stop], 'right') + 1) / 2.
+    rank_sums = np.bincount(test_rows, ranks, minlength=len(scores))
+    return (rank_sums - n_test * (n_test + 1) / 2.) / (n_test * n_negative)
+
+
+def evaluate(U, V, test, train=None, ks=(8, 50), user_ids=None, chunk_size=None):
+    """
+    Score the users chunk by chunk, U[users]*V', and compute every metric on the same scores
+    :param U: (num_u, K) user factors
+    :param V: (num_v, K) item factors
+    :param test: the (num_u, num_v) csr_matrix of the test ratings
+    :param train: (optional) the csr_matrix of the train ratings, never recommended and left out of the AUC
+    :param ks: the cut-offs of precision, recall and NDCG
+    :param user_ids: the users to score (default: every user), the metrics are averaged over those with test items
+    :param chunk_size: the number of users scored at once (default: as many as fit in MEMORY_BUDGET)
+    :return: (results, top_items) the mean of every metric with the number of users averaged, 'n_users', and
+             the (len(user_ids), max(ks)) best items of every user
+    """
+    test = test.tocsr()
+    test.sum_duplicates()
+    train = train.tocsr() if train is not None else None
+    n_items = V.shape[0]
+    k_max = max(ks)
+    if user_ids is None:
+        user_ids = np.arange(test.shape[0])
+    chunk_size = chunk_size or scoring_chunk_size(n_items)
+    discounts = 1. / np.log2(np.arange(2, k_max + 2))
+    V = np.asarray(V, dtype=np.float64)
+    values = dict(('%s@%d' % (name, k), []) for k in ks for name in ('precision', 'recall', 'ndcg'))
+    values['auc'] = []
+    top_items = np.empty((len(user_ids), k_max), dtype=np.int64)
+    for start in range(0, len(user_ids), chunk_size):
+        users = user_ids[start:start + chunk_size]
+        rows = np.arange(len(users))
+        scores = np.asarray(U[users], dtype=np.float64).dot(V.T)
+        test_chunk = test[users]
+        test_rows = np.repeat(rows, np.diff(test_chunk.indptr))
+        test_items = test_chunk.indices
+        n_excluded = np.zeros(len(users))
+        if train is not None:
+            train_chunk = train[users]
+            train_rows = np.repeat(rows, np.diff(train_chunk.indptr))
+            scores[train_rows, train_chunk.indices] = -np.inf
+            n_excluded = np.diff(train_chunk.indptr)
+            excluded = np.isinf(scores[test_rows, test_items])
+            test_rows, test_items = test_rows[~excluded], test_items[~excluded]
+        n_test = np.bincount(test_rows, minlength=len(users))
+        evaluated = n_test > 0
+
+        top = top_k(scores, k_max)
+        top_items[start:start + len(users)] = top
+        relevant = np.zeros(scores.shape, dtype=bool)
+        relevant[test_rows, test_items] = True
+        hits = relevant[rows[:, None], top]
+        for k in ks:
+            n_hits = hits[:, :k].sum(1)
+            idcg = np.cumsum(discounts)[np.maximum(np.minimum(n_test, k), 1) - 1]
+            values['precision@%d' % k].append(n_hits[evaluated] / float(k))
+            values['recall@%d' % k].append(n_hits[evaluated] / n_test[evaluated].astype(np.float64))
+            values['ndcg@%d' % k].append(hits[evaluated, :k].dot(discounts[:k]) / idcg[evaluated])
+
+        # the excluded items above every candidate, so that they do not change the candidates' ranks
+        del relevant
+        scores[np.isneginf(scores)] = np.inf
+        n_negative = n_items - n_excluded - n_test
+        # 0/0 for the users without test items
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values['auc'].append(auc_scores(scores, test_rows, test_items, n_test, n_negative)[evaluated])
+    results = dict((name, float(np.mean(np.concatenate(chunks)))) for name, chunks in values.items())
+    results['n_users'] = int(sum(len(chunk) for chunk in values['auc']))
+    return results, top_items
+
+
+def write_rec_list(path, test, user_ids, top_items, cut):
+    """
+    Write the 'hits:item item ...' lines of the top cut items of every user, as cal_rec did
+    """
+    test = test.tocsr()
+    with open(path, 'w') as f:
+        for user, items in zip(user_ids, top_items[:, :cut]):
+            n_hits = np.count_nonzero(np.in1d(items, test.indices[test.indptr[user]:test.indptr[user + 1]]))
+            f.write('%d:%s\n' % (n_hits, ' '.join(map(str, items))))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('dir_save', help='the run directory holding the artifacts, e.g. cdl4')
+    parser.add_argument('-k', type=int, nargs='+', default=[8, 50], help='cut-offs of precision, recall and NDCG')
+    parser.add_argument('--train', default='cf-train-1-users.dat', help='train ratings, excluded from the ranking')
+    parser.add_argument('--test', default='cf-test-1-users.dat', help='test ratings')
+    parser.add_argument('--keep-train', action='store_true',
+                        help='rank the train items too, as the former cal_* scripts')
+    parser.add_argument('--n-users', type=int, help='evaluate a random sample of the test users')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the user sample')
+    parser.add_argument('--chunk-size', type=int, help='users scored at once (default: fit in %dMB)'
+                        % (MEMORY_BUDGET // 2 ** 20))
+    parser.add_argument('--output', help='the results file (default: <dir_save>/results.json)')
+    parser.add_argument('--rec-list', help='the Top-K lists of the smallest k (default: <dir_save>/rec-list.dat)')
+    args = parser.parse_args(argv)
+
+    start = time.time()
+    arrays, manifest = load_model(args.dir_save)
+    U, V = arrays['U'], arrays['V']
+    test = read_user(args.test, U.shape[0], V.shape[0])
+    train = None if args.keep_train else read_user(args.train, U.shape[0], V.shape[0])
+    user_ids = np.arange(U.shape[0])
+    if args.n_users is not None:
+        test_users = np.flatnonzero(np.diff(test.indptr))
+        user_ids = np.sort(np.random.RandomState(args.seed).choice(test_users, min(args.n_users, len(test_users)),
+                                                                   replace=False))
+    results, top_items = evaluate(U, V, test, train, args.k, user_ids, args.chunk_size)
+    results.update(exclude_train=train is not None, seconds=time.time() - start, manifest=manifest)
+
+    output = args.output or os.path.join(args.dir_save, 'results.json')
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    # show_recommendation.py reads the line of a user by its id
+    if len(user_ids) == U.shape[0]:
+        write_rec_list(args.rec_list or os.path.join(args.dir_save, 'rec-list.dat'), test, user_ids, top_items,
+                       min(args.k))
+    else:
+        print('rec-list.dat is only written when every user is scored')
+    for name in sorted(results):
+        if name != 'manifest':
+            print('%s: %s' % (name, results[name]))
+    print('Results written to %s' % output)
+
+
+if __name__ == '__main__':
+    main()
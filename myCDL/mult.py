@@ -1,14 +1,20 @@
 import numpy as np
+from utils import INDEX_LISTS_VERSION, cached_csr_matrix, read_index_lists, resize_csr
 
-def read_mult(f_in='mult.dat',D=8000):
-    fp = open(f_in)
-    lines = fp.readlines()
-    X = np.zeros((len(lines),D))
-    for i,line in enumerate(lines):
-        strs = line.strip().split(' ')[1:]
-        for strr in strs:
-            segs = strr.split(':')
-            X[i,int(segs[0])] = float(segs[1])
-    arr_max = np.amax(X,axis=1)
-    X = (X.T/arr_max).T
+def parse_mult(f_in):
+    # 'N id:count id:count ...' per document
+    return read_index_lists(f_in, value_sep=':', dtype=np.float32)
+
+def read_mult(f_in='mult.dat',D=None):
+    """
+    :param D: the vocabulary size (default: the largest word id + 1)
+    :return: the (documents, D) float32 csr_matrix of the word counts, every row divided by its largest count
+    """
+    X = resize_csr(cached_csr_matrix(f_in, parse_mult, INDEX_LISTS_VERSION), n_cols=D, dtype=np.float32)
+    lengths = np.diff(X.indptr)
+    non_empty = lengths > 0
+    # the max of every row, the segments of the empty rows hold no data
+    arr_max = np.ones(X.shape[0], dtype=np.float32)
+    arr_max[non_empty] = np.maximum.reduceat(X.data, X.indptr[:-1][non_empty])
+    X.data /= np.repeat(arr_max, lengths)
     return X
@@ -11,15 +11,15 @@ for i,row in enumerate(csvReader):
     if i==0:
         continue
     d_id_title[i-1] = row[3]
-R_test = read_user('cf-test-1-users.dat')
 R_train = read_user('cf-train-1-users.dat')
+R_test = read_user('cf-test-1-users.dat', *R_train.shape)
 fp = open(dir_save+'/rec-list.dat')
 lines = fp.readlines()
 
 #s_test = set(np.where(R_test[user_id,:]>0)[1].A1)
 #l_train = np.where(R_train[user_id,:]>0)[1].A1.tolist()
-s_test = set(np.ravel(np.where(R_test[user_id, :] > 0)[1]))
-l_train = np.ravel(np.where(R_train[user_id, :] > 0)[1]).tolist()
+s_test = set(R_test[user_id].indices)
+l_train = R_train[user_id].indices.tolist()
 l_pred = map(int,lines[user_id].strip().split(':')[1].split(' '))
 print '#####  Articles in the Training Sets  #####'
 for i in l_train:
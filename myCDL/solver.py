@@ -2,8 +2,10 @@
 import mxnet as mx
 import numpy as np
 import logging
+import os
 import model
 from BCD_one import BCD_one
+from utils import metrics_writer, to_dense
 
 class Monitor(object):
     def __init__(self, interval, level=logging.DEBUG, stat=None):
@@ -56,7 +58,9 @@ class Solver(object):
         self.iter_start_callback = callback
 
     def solve(self, X, R, V, lambda_v_rt, lambda_u, lambda_v, dir_save, batch_size, xpu, sym, args, args_grad, auxs,
-              data_iter, begin_iter, end_iter, args_lrmult={}, debug = False):
+              data_iter, begin_iter, end_iter, args_lrmult={}, debug = False, pool=None):
+        # X may be sparse, the reconstruction loss compares it with the dense outputs; R stays sparse for BCD_one
+        X = to_dense(X)
         # names and shapes
         input_desc = data_iter.provide_data + data_iter.provide_label
         input_names = [k for k, shape in input_desc]
@@ -132,17 +136,17 @@ class Solver(object):
                     data_iter, X.shape[0], xpu).values()[0]
                 # update U, V and get BCD loss
                 U, V, BCD_loss = BCD_one(R, U, V, theta,
-                    lambda_u, lambda_v, dir_save, True)
+                    lambda_u, lambda_v, dir_save, True, pool=pool)
                 # get recon' loss
                 Y = model.extract_feature(sym[1], args, auxs,
                     data_iter, X.shape[0], xpu).values()[0]
                 Recon_loss = lambda_v/np.square(lambda_v_rt_old[0,0])*np.sum(np.square(Y-X))/2.0
                 print "Epoch %d - tr_err/bcd_err/rec_err: %.1f/%.1f/%.1f" % (epoch,
                     BCD_loss+Recon_loss, BCD_loss, Recon_loss)
-                fp = open(dir_save+'/cdl.log','a')
-                fp.write("Epoch %d - tr_err/bcd_err/rec_err: %.1f/%.1f/%.1f\n" % (epoch,
+                metrics_writer(os.path.join(dir_save, 'cdl.log')).record(
+                    {'epoch': epoch, 'tr_err': BCD_loss+Recon_loss, 'bcd_err': BCD_loss, 'rec_err': Recon_loss},
+                    "Epoch %d - tr_err/bcd_err/rec_err: %.1f/%.1f/%.1f" % (epoch,
                     BCD_loss+Recon_loss, BCD_loss, Recon_loss))
-                fp.close()
                 lambda_v_rt[:] = lambda_v_rt_old[:] # back to normal lambda_v_rt
                 data_iter = mx.io.NDArrayIter({'data': X, 'V': V, 'lambda_v_rt':
                     lambda_v_rt},
@@ -185,6 +189,6 @@ class Solver(object):
         theta = model.extract_feature(sym[0], args, auxs,
             data_iter, X.shape[0], xpu).values()[0]
         U, V, BCD_loss = BCD_one(R, U, V, theta, lambda_u, lambda_v,
-            dir_save, True, 20)
-        fp.close()
+            dir_save, True, 20, pool)
+        metrics_writer(os.path.join(dir_save, 'cdl.log')).flush()
         return U, V, theta, BCD_loss
@@ -0,0 +1,73 @@
+import os
+import sys
+import numpy as np
+from scipy.sparse import csr_matrix
+
+# common/ at the root of the repository holds the modules shared with myCML
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+from common.cache import cached_csr_matrix
+from common.metrics import MetricsWriter, load_metrics, metrics_writer, save_columns
+
+
+# the version of read_index_lists, see cached_csr_matrix
+INDEX_LISTS_VERSION = 1
+
+
+def read_index_lists(path, skip_first=True, value_sep=None, dtype=np.int32):
+    """
+    Parse a file holding one whitespace separated list of ids per line, reading it only once
+    :param path: path of the file, e.g. cf-train-1-users.dat or mult.dat
+    :param skip_first: drop the first token of every line (the length of the list in the CDL files)
+    :param value_sep: if set, tokens are `id<value_sep>value` pairs, e.g. ':' for the word counts of mult.dat
+    :param dtype: dtype of the values (1 for every id when value_sep is None)
+    :return: a csr_matrix with one row per line, in file order and with repetitions kept
+    """
+    indptr = [0]
+    ids = []
+    values = []
+    with open(path) as f:
+        for line in f:
+            if value_sep is not None:
+                line = line.replace(value_sep, " ")
+            # the numbers of the line parsed at once, fromstring returns [-1.] for a blank line
+            numbers = np.fromstring(line, sep=" ") if line.strip() else np.empty(0)
+            if skip_first:
+                numbers = numbers[1:]
+            if value_sep is None:
+                ids.append(numbers)
+            else:
+                ids.append(numbers[0::2])
+                values.append(numbers[1::2])
+            indptr.append(indptr[-1] + len(ids[-1]))
+    ids = np.concatenate(ids).astype(np.int32) if ids else np.empty(0, dtype=np.int32)
+    if value_sep is None:
+        values = np.ones(len(ids), dtype=dtype)
+    else:
+        values = np.concatenate(values).astype(dtype)
+    n_cols = int(ids.max()) + 1 if len(ids) else 0
+    return csr_matrix((values, ids, np.asarray(indptr, dtype=np.int32)), shape=(len(indptr) - 1, n_cols))
+
+
+def resize_csr(matrix, n_rows=None, n_cols=None, dtype=None):
+    """
+    :return: a writable copy of the csr_matrix with empty rows appended up to n_rows and n_cols columns, by
+             default the shape of matrix
+    """
+    n_rows = matrix.shape[0] if n_rows is None else n_rows
+    n_cols = matrix.shape[1] if n_cols is None else n_cols
+    if n_rows < matrix.shape[0] or n_cols < matrix.shape[1]:
+        raise ValueError("cannot shrink a {} matrix to {}".format(matrix.shape, (n_rows, n_cols)))
+    indptr = np.concatenate((matrix.indptr, np.repeat(matrix.indptr[-1], n_rows - matrix.shape[0])))
+    return csr_matrix((np.array(matrix.data, dtype=dtype), np.array(matrix.indices), indptr),
+                      shape=(n_rows, n_cols))
+
+
+def to_dense(X, dtype=np.float32):
+    """
+    :return: X as a dense array, e.g. for the mx.io.NDArrayIter of the autoencoder
+    """
+    if hasattr(X, "toarray"):
+        return X.toarray().astype(dtype, copy=False)
+    return np.asarray(X, dtype=dtype)
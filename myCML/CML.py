@@ -1,11 +1,15 @@
 import functools
+import time
 import numpy
 import sklearn.preprocessing
 import tensorflow as tf
 import toolz
-from scipy.sparse import lil_matrix, dok_matrix
+from scipy.sparse import csr_matrix
 from tqdm import tqdm
-from utils import citeulike, split_data
+from sampler import WarpSampler
+from telemetry import Telemetry
+from training import EarlyStopping, EmbeddingCheckpointer, TrainingBudget
+from utils import citeulike, split_data, item_index, row_items, isin_sorted
 
 
 def doublewrap(function):
@@ -50,17 +54,13 @@ def define_scope(function, scope=None, *args, **kwargs):
 
 
 class RecallEvaluator(object):
+    """
+    Top-K recall of a model's item scores. The per-user indexes are built once, so create one evaluator
+    per (train, test) pair and reuse it across evaluation rounds.
+    """
     def __init__(self, train_user_item_matrix, test_user_item_matrix):
-
-        self.train_user_item_matrix = lil_matrix(train_user_item_matrix)
-        self.test_user_item_matrix = lil_matrix(test_user_item_matrix)
-        n_users = train_user_item_matrix.shape[0]
-        self.user_to_test_set = {u: set(self.test_user_item_matrix[u, :].nonzero()[1])
-                                 for u in range(n_users) if self.test_user_item_matrix[u, :].sum()}
-
-        if self.train_user_item_matrix is not None:
-            self.user_to_train_set = {u: set(self.train_user_item_matrix[u, :].nonzero()[1])
-                                      for u in range(n_users) if self.train_user_item_matrix[u, :].sum()}
+        self.train_user_item_matrix = item_index(train_user_item_matrix)
+        self.test_user_item_matrix = item_index(test_user_item_matrix)
 
     def eval(self, user_id, item_scores, k=50):
         """
@@ -70,51 +70,13 @@ class RecallEvaluator(object):
         :param k: compute the recall for the top K items
         :return: recall@K
         """
-        train_set = self.user_to_train_set[user_id]
-        test_set = self.user_to_test_set[user_id]
-
-        top_items = numpy.argpartition(-item_scores, k + len(train_set))[:k + len(train_set)]
-        top_n_items = 0
-        hits = 0
-        for i in top_items:
-            if i in train_set:
-                continue
-            if i in test_set:
-                hits += 1
-            top_n_items += 1
-            if top_n_items == k:
-                break
-        return hits / float(len(test_set))
-
-
-class WarpSampler(object):
-    """
-    A generator that generate tuples: user-positive-item pairs, negative-items
-
-    of shapes (Batch Size, 2) and (Batch Size, N_Negative)
-    """
-
-    def __init__(self, user_item_matrix, batch_size=10000, n_negative=10):
-        self.user_item_matrix = dok_matrix(user_item_matrix)
-        self.user_item_pairs = numpy.asarray(self.user_item_matrix.nonzero()).T
-        self.batch_size = batch_size
-        self.n_negative = n_negative
-
-    @property
-    def sample(self):
-        while True:
-            numpy.random.shuffle(self.user_item_pairs)
-            for i in range(int(len(self.user_item_pairs) / self.batch_size)):
-                user_positive_items_pairs = self.user_item_pairs[i * self.batch_size: (i + 1) * self.batch_size, :]
-
-                negative_samples = numpy.random.randint(0,
-                                                        self.user_item_matrix.shape[1],
-                                                        size=(self.batch_size, self.n_negative))
-
-                yield user_positive_items_pairs, negative_samples
+        train_items = row_items(self.train_user_item_matrix, user_id)
+        test_items = row_items(self.test_user_item_matrix, user_id)
 
-    def next_batch(self):
-        return self.sample.__next__()
+        top_items = numpy.argpartition(-item_scores, k + len(train_items))[:k + len(train_items)]
+        top_items = top_items[~isin_sorted(train_items, top_items)][:k]
+        hits = numpy.count_nonzero(isin_sorted(test_items, top_items))
+        return hits / float(len(test_items))
 
 
 class CML(object):
@@ -129,7 +91,8 @@ class CML(object):
                  hidden_layer_dim=128,
                  dropout_rate=0.5,
                  feature_l2_reg=0.1,
-                 feature_projection_scaling_factor=0.5
+                 feature_projection_scaling_factor=0.5,
+                 sparse_updates=False
                  ):
         """
 
@@ -137,8 +100,9 @@ class CML(object):
         :param n_items: number of items i.e. |V|
         :param
         :param embed_dim: embedding size i.e. K (default 20)
-        :param features: (optional) the feature vectors of items, shape: (|V|, N_Features).
-               Set it to None will disable feature loss(default: None)
+        :param features: (optional) the feature vectors of items, shape: (|V|, N_Features), a scipy sparse
+               matrix such as the features of citeulike() or a dense array. Only the rows of the items of each
+               batch are projected. Set it to None will disable feature loss(default: None)
         :param margin: hinge loss threshold i.e. z
         :param master_learning_rate: master learning rate for AdaGrad
         :param clip_norm: clip norm threshold (default 1.0)
@@ -147,6 +111,10 @@ class CML(object):
         :param feature_l2_reg: feature loss weight
         :param feature_projection_scaling_factor: scale the feature projection before compute l2 loss. Ideally,
                the scaled feature projection should be mostly within the clip_norm
+        :param sparse_updates: clip only the embedding rows of the mini-batch after each step instead of the
+               whole tables, so that a step costs O(batch size) rather than O(|U| + |V|). The embedding loss
+               gradients are already row-sparse, hence the Adagrad updates only touch those rows as well
+               (the feature loss covers the batch items only).
         """
 
         self.n_users = n_users
@@ -156,7 +124,15 @@ class CML(object):
         self.clip_norm = clip_norm
         self.margin = margin
         if features is not None:
-            self.features = tf.constant(features, dtype=tf.float32)
+            # kept as csr arrays, the projector gathers the rows of the items it needs
+            self.features = csr_matrix(features, dtype=numpy.float32, copy=True)
+            self.features.sort_indices()
+            self.n_features = self.features.shape[1]
+            self.feature_indptr = tf.constant(self.features.indptr, dtype=tf.int64)
+            self.feature_indices = tf.constant(self.features.indices, dtype=tf.int64)
+            self.feature_values = tf.constant(self.features.data, dtype=tf.float32)
+            with tf.variable_scope("feature_projector") as feature_projector_scope:
+                self.feature_projector_scope = feature_projector_scope
         else:
             self.features = None
 
@@ -165,16 +141,21 @@ class CML(object):
         self.dropout_rate = dropout_rate
         self.feature_l2_reg = feature_l2_reg
         self.feature_projection_scaling_factor = feature_projection_scaling_factor
+        self.sparse_updates = sparse_updates
 
         self.user_positive_items_pairs = tf.placeholder(tf.int32, [None, 2])
         self.negative_samples = tf.placeholder(tf.int32, [None, None])
         self.score_user_ids = tf.placeholder(tf.int32, [None])
+        # the items whose embedding init_item_embeddings sets to their feature projection
+        self.projected_item_ids = tf.placeholder(tf.int32, [None])
         self.user_embeddings
         self.item_embeddings
         self.embedding_loss
         self.feature_loss
         self.loss
         self.optimize
+        # built with the other variables, so that global_variables_initializer covers the norm cache
+        self.item_scores
 
     @define_scope
     def user_embeddings(self):
@@ -186,41 +167,61 @@ class CML(object):
         return tf.Variable(tf.random_normal([self.n_items, self.embed_dim],
                                             stddev=1 / (self.embed_dim ** 0.5), dtype=tf.float32))
 
-    @define_scope
-    def mlp_layer_1(self):
-        return tf.layers.dense(inputs=self.features,
-                               units=self.hidden_layer_dim,
-                               activation=tf.nn.relu, name="mlp_layer_1")
+    def project_features(self, item_ids):
+        """
+        :param item_ids: the items to project
+        :return: the projection of the feature vectors of item_ids to the user-item embedding
+        """
+        with tf.variable_scope(self.feature_projector_scope, reuse=tf.AUTO_REUSE):
+            # the (N, N_Features) feature rows of item_ids as a SparseTensor, gathered from the csr arrays
+            item_ids = tf.cast(item_ids, tf.int64)
+            positions = tf.ragged.range(tf.gather(self.feature_indptr, item_ids),
+                                        tf.gather(self.feature_indptr, item_ids + 1))
+            features = tf.SparseTensor(
+                tf.stack([positions.value_rowids(), tf.gather(self.feature_indices, positions.flat_values)], 1),
+                tf.gather(self.feature_values, positions.flat_values),
+                tf.stack([tf.size(item_ids, out_type=tf.int64), self.n_features]))
+
+            # fully-connected layers, the first one a sparse-dense matmul
+            with tf.variable_scope("mlp_layer_1"):
+                kernel = tf.get_variable("kernel", [self.n_features, self.hidden_layer_dim])
+                bias = tf.get_variable("bias", [self.hidden_layer_dim], initializer=tf.zeros_initializer())
+            mlp_layer_1 = tf.nn.relu(tf.sparse_tensor_dense_matmul(features, kernel) + bias)
+            dropout = tf.layers.dropout(inputs=mlp_layer_1, rate=self.dropout_rate)
+            output = tf.layers.dense(inputs=dropout, units=self.embed_dim, name="mlp_layer_2") \
+                * self.feature_projection_scaling_factor
 
-    @define_scope
-    def mlp_layer_2(self):
-        dropout = tf.layers.dropout(inputs=self.mlp_layer_1, rate=self.dropout_rate)
-        return tf.layers.dense(inputs=dropout, units=self.embed_dim, name="mlp_layer_2")
+            # projection to the embedding
+            return tf.clip_by_norm(output, self.clip_norm, axes=[1], name="feature_projection")
 
     @define_scope
     def feature_projection(self):
         """
-        :return: the projection of the feature vectors to the user-item embedding
+        :return: the projection of the feature vectors of the batch items to the user-item embedding
         """
 
         # feature loss
         if self.features is not None:
-            # fully-connected layer
-            output = self.mlp_layer_2 * self.feature_projection_scaling_factor
+            return self.project_features(self.batch_item_ids)
 
-            # projection to the embedding
-            return tf.clip_by_norm(output, self.clip_norm, axes=[1], name="feature_projection")
+    @define_scope
+    def init_item_embeddings(self):
+        """
+        :return: the op setting the embedding of projected_item_ids to their feature projection
+        """
+        return tf.scatter_update(self.item_embeddings, self.projected_item_ids,
+                                 self.project_features(self.projected_item_ids))
 
     @define_scope
     def feature_loss(self):
         """
-        :return: the l2 loss of the distance between items' their embedding and their feature projection
+        :return: the l2 loss of the distance between the batch items' embedding and their feature projection
         """
         if self.feature_projection is not None:
 
             # the distance between feature projection and the item's actual location in the embedding
             feature_distance = tf.reduce_mean(tf.squared_difference(
-                self.item_embeddings,
+                tf.nn.embedding_lookup(self.item_embeddings, self.batch_item_ids),
                 self.feature_projection), 1)
 
             # apply regularization weight
@@ -258,6 +259,8 @@ class CML(object):
 
         # number of impostors for each user-positive-item pair
         impostors = (tf.expand_dims(pos_distances, -1) - distance_to_neg_items + self.margin) > 0
+        # the fraction of negative samples that are impostors, reported by the telemetry
+        self.impostor_fraction = tf.reduce_mean(tf.cast(impostors, tf.float32), name="impostor_fraction")
 
         # best negative item (among W negative samples) their distance to the user embedding (N)
         closest_negative_distances = tf.reduce_min(distance_to_neg_items, 1, name="closest_negative_distances")
@@ -284,90 +287,182 @@ class CML(object):
         return [tf.assign(self.user_embeddings, tf.clip_by_norm(self.user_embeddings, self.clip_norm, axes=[1])),
                 tf.assign(self.item_embeddings, tf.clip_by_norm(self.item_embeddings, self.clip_norm, axes=[1]))]
 
+    @define_scope
+    def batch_user_ids(self):
+        # the distinct users of the mini-batch
+        return tf.unique(self.user_positive_items_pairs[:, 0])[0]
+
+    @define_scope
+    def batch_item_ids(self):
+        # the distinct positive and negative items of the mini-batch
+        return tf.unique(tf.concat([self.user_positive_items_pairs[:, 1],
+                                    tf.reshape(self.negative_samples, [-1])], 0))[0]
+
+    @define_scope
+    def clip_batch_rows_op(self):
+        """
+        :return: the clip of the mini-batch rows only, a scatter update of the rows the optimizer moved
+        """
+        return [tf.scatter_update(embeddings, ids,
+                                  tf.clip_by_norm(tf.gather(embeddings, ids), self.clip_norm, axes=[1]))
+                for embeddings, ids in ((self.user_embeddings, self.batch_user_ids),
+                                        (self.item_embeddings, self.batch_item_ids))]
+
     @define_scope
     def optimize(self):
         # have two separate learning rates. The first one for user/item embedding is un-normalized.
-        # The second one for feature projector NN is normalized by the number of items.
+        # The second one for feature projector NN is normalized by the number of items in the batch.
         gds = []
         gds.append(tf.train
                    .AdagradOptimizer(self.master_learning_rate)
                    .minimize(self.loss, var_list=[self.user_embeddings, self.item_embeddings]))
-        if self.feature_projection:
+        if self.feature_projection is not None:
             gds.append(tf.train
                        .AdagradOptimizer(self.master_learning_rate)
-                       .minimize(self.feature_loss / self.n_items))
+                       .minimize(self.feature_loss / tf.cast(tf.size(self.batch_item_ids), tf.float32)))
 
         with tf.control_dependencies(gds):
+            if self.sparse_updates:
+                return gds + self.clip_batch_rows_op
             return gds + [self.clip_by_norm_op]
 
+    @define_scope
+    def item_squared_norms(self):
+        # (1, N_ITEM), a cache shared by all the scored users and chunks, see refresh_item_squared_norms
+        return tf.Variable(tf.zeros([1, self.n_items]), trainable=False)
+
+    @define_scope
+    def refresh_item_squared_norms(self):
+        """
+        :return: the op recomputing item_squared_norms from the item embeddings, run it once before scoring
+                 whenever the item embeddings have changed, e.g. at the start of every evaluation
+        """
+        return tf.assign(self.item_squared_norms,
+                         tf.expand_dims(tf.reduce_sum(tf.square(self.item_embeddings), 1), 0))
+
     @define_scope
     def item_scores(self):
-        # (N_USER_IDS, 1, K)
-        user = tf.expand_dims(tf.nn.embedding_lookup(self.user_embeddings, self.score_user_ids), 1)
-        # (1, N_ITEM, K)
-        item = tf.expand_dims(self.item_embeddings, 0)
+        # (N_USER_IDS, K)
+        user = tf.nn.embedding_lookup(self.user_embeddings, self.score_user_ids)
+        # ||u - v||^2 = ||u||^2 - 2 u.v + ||v||^2, so that the only (N_USER, N_ITEM) intermediate is a matmul
+        user_squared_norms = tf.expand_dims(tf.reduce_sum(tf.square(user), 1), 1)
+        distances = user_squared_norms - 2 * tf.matmul(user, self.item_embeddings, transpose_b=True) \
+            + self.item_squared_norms
         # score = minus distance (N_USER, N_ITEM)
-        return -tf.reduce_sum(tf.squared_difference(user, item), 2, name="scores")
+        return tf.negative(distances, name="scores")
 
 
 BATCH_SIZE = 50000
 N_NEGATIVE = 20
 EVALUATION_EVERY_N_BATCHES = 100
 EMBED_DIM = 50
+EARLY_STOPPING_PATIENCE = 10
+CHECKPOINT_EVERY_N_EVALUATIONS = 10
+
+
+def telemetry_embeddings(sess, model, telemetry):
+    """
+    :return: the (user, item) embeddings for the norm histograms, (None, None) when telemetry writes no records
+    """
+    if telemetry.sink is None:
+        return None, None
+    return sess.run([model.user_embeddings, model.item_embeddings])
 
 
-def optimize(model, sampler, train, valid):
+def optimize(model, sampler, train, valid, patience=EARLY_STOPPING_PATIENCE, max_steps=None, max_seconds=None,
+             checkpoint_dir=None, checkpoint_every=CHECKPOINT_EVERY_N_EVALUATIONS, restore_best=True,
+             telemetry=None):
     """
-    Optimize the model. TODO: implement early-stopping
+    Optimize the model until the validation recall has not improved for `patience` evaluations, or until the
+    step or time budget is spent
     :param model: model to optimize
     :param sampler: mini-batch sampler
     :param train: train user-item matrix
     :param valid: validation user-item matrix
-    :return: None
+    :param patience: number of evaluations without a better validation recall before stopping
+    :param max_steps: (optional) maximum number of mini-batches
+    :param max_seconds: (optional) maximum training wall-clock time
+    :param checkpoint_dir: (optional) directory for the embedding checkpoints, the best ones go to its best/
+    :param checkpoint_every: save the embeddings every n evaluations (needs checkpoint_dir)
+    :param restore_best: load the embeddings of the best evaluation before returning
+    :param telemetry: (optional) a telemetry.Telemetry recording every training step and evaluation
+    :return: (sess, best_recall) the session holding the embeddings and the best validation recall
     """
+    telemetry = telemetry or Telemetry()
     sess = tf.Session()
     sess.run(tf.global_variables_initializer())
-    if model.feature_projection is not None:
-        # initialize item embedding with feature projection
-        sess.run(tf.assign(model.item_embeddings, model.feature_projection))
+    if model.features is not None:
+        # initialize item embedding with feature projection, BATCH_SIZE items at a time
+        for start in range(0, model.n_items, BATCH_SIZE):
+            sess.run(model.init_item_embeddings,
+                     {model.projected_item_ids: numpy.arange(start, min(start + BATCH_SIZE, model.n_items))})
+    # start from clipped embeddings, afterwards the sparse updates only need to clip the rows they move
+    for embeddings in (model.user_embeddings, model.item_embeddings):
+        sess.run(tf.assign(embeddings, tf.clip_by_norm(embeddings, model.clip_norm, axes=[1])))
+    # create evaluator on validation set
+    validation_recall = RecallEvaluator(train, valid)
+    early_stopping = EarlyStopping(patience)
+    budget = TrainingBudget(max_steps, max_seconds)
+    checkpointer = EmbeddingCheckpointer(model, checkpoint_dir)
+    step = 0
+    n_evaluations = 0
     while True:
-        # create evaluator on validation set
-        validation_recall = RecallEvaluator(train, valid)
         # compute recall on validate set
+        eval_start = time.time()
         valid_recalls = []
         # sample some users to calculate recall validation
         valid_users = list(set(valid.nonzero()[0]))[:300]
+        sess.run(model.refresh_item_squared_norms)
         for user_chunk in toolz.partition_all(300, valid_users):
             scores = sess.run(model.item_scores, {model.score_user_ids: user_chunk})
             valid_recalls.extend([validation_recall.eval(user, user_scores)
                                   for user, user_scores in zip(user_chunk, scores)]
                                  )
         print("\nRecall on (sampled) validation set: {}".format(numpy.mean(valid_recalls)))
-        # TODO: early stopping based on validation recall
-
+        telemetry.evaluation(step, {"Recall": numpy.mean(valid_recalls)}, time.time() - eval_start,
+                             *telemetry_embeddings(sess, model, telemetry), max_norm=model.clip_norm)
+        n_evaluations += 1
+        if early_stopping.update(numpy.mean(valid_recalls), step):
+            checkpointer.save_best(sess, step)
+        if checkpoint_every and n_evaluations % checkpoint_every == 0:
+            checkpointer.save(sess, step)
+        if early_stopping.should_stop or budget.exhausted(step):
+            break
 
         # train model
         losses = []
         # run n mini-batches
         for _ in tqdm(range(EVALUATION_EVERY_N_BATCHES), desc="Optimizing..."):
-            user_pos, neg = sampler.next_batch()
-            _, loss = sess.run((model.optimize, model.loss),
-                               {model.user_positive_items_pairs: user_pos,
-                                model.negative_samples: neg})
+            telemetry.start_step(step)
+            with telemetry.timed("sample"):
+                user_pos, neg = sampler.next_batch()
+            with telemetry.timed("feed"):
+                feed_dict = {model.user_positive_items_pairs: user_pos,
+                             model.negative_samples: neg}
+            _, loss, impostor_fraction = telemetry.run(
+                sess, (model.optimize, model.loss, model.impostor_fraction), feed_dict, step)
             losses.append(loss)
+            telemetry.end_step(step, len(user_pos), loss, impostor_fraction)
+            step += 1
+            if budget.exhausted(step):
+                break
         print("\nTraining loss {}".format(numpy.mean(losses)))
 
+    print("\nStopped after {} steps, best validation recall {} at step {}".format(
+        step, early_stopping.best, early_stopping.best_step))
+    if restore_best:
+        checkpointer.restore_best(sess)
+    return sess, early_stopping.best
+
 
 if __name__ == '__main__':
     # get user-item matrix
     user_item_matrix, features = citeulike(tag_occurence_thres=5)
     n_users, n_items = user_item_matrix.shape
-    # make feature as dense matrix
-    dense_features = features.toarray() + 1E-10
     # get train/valid/test user-item matrices
     train, valid, test = split_data(user_item_matrix)
     # create warp sampler
-    sampler = WarpSampler(train, batch_size=BATCH_SIZE, n_negative=N_NEGATIVE)
+    sampler = WarpSampler(train, batch_size=BATCH_SIZE, n_negative=N_NEGATIVE, seed=1)
 
     # WITHOUT features
     # Train a user-item joint embedding, where the items a user likes will be pulled closer to this users.
@@ -391,12 +486,12 @@ if __name__ == '__main__':
     # WITH features
     # In this case, we additionally train a feature projector to project raw item features into the
     # embedding. The projection serves as "a prior" to inform the item's potential location in the embedding.
-    # We use a two fully-connected layers NN as our feature projector. (This model is much more computation intensive.
-    # A GPU machine is recommended)
+    # We use a two fully-connected layers NN as our feature projector. The features stay sparse and only the items
+    # of each batch are projected, so that this model also trains on CPU.
     model = CML(n_users,
                 n_items,
                 # enable feature projection
-                features=dense_features,
+                features=features,
                 embed_dim=EMBED_DIM,
                 margin=1.0,
                 clip_norm=1.5,
@@ -0,0 +1,181 @@
+import numpy
+from scipy.sparse import csr_matrix
+
+from utils import item_index, isin_sorted, row_items
+
+
+def squared_distances(queries, vectors, vector_squared_norms):
+    """
+    :return: (len(queries), len(vectors)) squared euclidean distances, without the (N, M, K) difference tensor
+    """
+    query_squared_norms = numpy.square(queries).sum(1)[:, None]
+    return query_squared_norms - 2 * queries.dot(vectors.T) + vector_squared_norms[None, :]
+
+
+def kmeans(vectors, n_clusters, n_iter=20, seed=1, chunk_size=4096):
+    """
+    Lloyd's k-means, initialized with n_clusters distinct random vectors
+    :return: (centroids, assignments)
+    """
+    random_state = numpy.random.RandomState(seed)
+    centroids = vectors[random_state.choice(len(vectors), n_clusters, replace=False)].astype(numpy.float64)
+    assignments = numpy.zeros(len(vectors), dtype=numpy.int64)
+    for _ in range(n_iter):
+        assignments = assign(vectors, centroids, chunk_size)
+        counts = numpy.bincount(assignments, minlength=n_clusters)
+        # cluster sums as a (n_clusters, N) one-hot sparse matrix product
+        sums = csr_matrix((numpy.ones(len(vectors)), (assignments, numpy.arange(len(vectors)))),
+                          shape=(n_clusters, len(vectors))).dot(vectors)
+        non_empty = counts > 0
+        centroids[non_empty] = sums[non_empty] / counts[non_empty, None]
+        # restart the empty clusters on random vectors
+        n_empty = n_clusters - non_empty.sum()
+        if n_empty:
+            centroids[~non_empty] = vectors[random_state.choice(len(vectors), n_empty, replace=False)]
+    return centroids, assignments
+
+
+def assign(vectors, centroids, chunk_size=4096):
+    """
+    :return: the index of the closest centroid of each vector
+    """
+    centroid_squared_norms = numpy.square(centroids).sum(1)
+    assignments = numpy.empty(len(vectors), dtype=numpy.int64)
+    for start in range(0, len(vectors), chunk_size):
+        # ||v||^2 does not change the argmin
+        distances = centroid_squared_norms[None, :] - 2 * vectors[start: start + chunk_size].dot(centroids.T)
+        assignments[start: start + chunk_size] = distances.argmin(1)
+    return assignments
+
+
+class IVFIndex(object):
+    """
+    Inverted file index over item embeddings: the items are clustered with k-means and a query only scans the
+    items of the n_probe clusters whose centroids are the closest to it
+    """
+
+    def __init__(self, centroids, list_offsets, list_items, list_vectors, n_probe=8):
+        self.centroids = centroids
+        self.centroid_squared_norms = numpy.square(centroids).sum(1)
+        self.list_offsets = list_offsets
+        self.list_items = list_items
+        self.list_vectors = list_vectors
+        self.list_squared_norms = numpy.square(list_vectors).sum(1)
+        self.n_probe = n_probe
+
+    @classmethod
+    def build(cls, item_embeddings, n_lists=None, n_probe=8, n_iter=20, points_per_list=256, seed=1):
+        """
+        :param item_embeddings: (|V|, K) item embeddings, e.g. sess.run(model.item_embeddings)
+        :param n_lists: number of k-means clusters (default: sqrt(|V|))
+        :param n_probe: default number of clusters scanned per query
+        :param points_per_list: k-means is fit on at most n_lists * points_per_list sampled items
+        """
+        item_embeddings = numpy.asarray(item_embeddings, dtype=numpy.float32)
+        n_lists = n_lists or max(1, int(numpy.sqrt(len(item_embeddings))))
+        training_items = item_embeddings
+        if len(item_embeddings) > n_lists * points_per_list:
+            sample = numpy.random.RandomState(seed).choice(len(item_embeddings), n_lists * points_per_list,
+                                                           replace=False)
+            training_items = item_embeddings[sample]
+        centroids, _ = kmeans(training_items, n_lists, n_iter=n_iter, seed=seed)
+        assignments = assign(item_embeddings, centroids)
+        list_items = numpy.argsort(assignments, kind="mergesort")
+        list_offsets = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(assignments, minlength=n_lists))))
+        return cls(centroids.astype(numpy.float32), list_offsets, list_items, item_embeddings[list_items], n_probe)
+
+    def search(self, queries, k, n_probe=None, exclude=None):
+        """
+        :param queries: (N, K) query embeddings
+        :param k: number of neighbours per query
+        :param n_probe: number of clusters scanned per query (default: self.n_probe)
+        :param exclude: (optional) a list of sorted item arrays, the items never returned for each query
+        :return: (N, k) item ids ordered by increasing distance, padded with -1 when the probed clusters hold
+                 fewer than k items
+        """
+        n_probe = min(n_probe or self.n_probe, len(self.centroids))
+        queries = numpy.asarray(queries, dtype=numpy.float32)
+        probes = numpy.argpartition(squared_distances(queries, self.centroids, self.centroid_squared_norms),
+                                    n_probe - 1, axis=1)[:, :n_probe]
+        neighbours = numpy.full((len(queries), k), -1, dtype=numpy.int64)
+        for q, query in enumerate(queries):
+            positions = numpy.concatenate([numpy.arange(self.list_offsets[l], self.list_offsets[l + 1])
+                                           for l in probes[q]])
+            candidates = self.list_items[positions]
+            if exclude is not None:
+                kept = ~isin_sorted(exclude[q], candidates)
+                positions, candidates = positions[kept], candidates[kept]
+            # ||q||^2 is the same for every candidate of a query
+            distances = self.list_squared_norms[positions] - 2 * self.list_vectors[positions].dot(query)
+            n = min(k, len(candidates))
+            if n == 0:
+                continue
+            top = numpy.argpartition(distances, n - 1)[:n]
+            neighbours[q, :n] = candidates[top[numpy.argsort(distances[top])]]
+        return neighbours
+
+
+class Recommender(object):
+    """
+    Top-K recommendation of a trained CML model: the nearest items to each user in the embedding,
+    served from an IVFIndex
+    """
+
+    def __init__(self, user_embeddings, index, train_user_item_matrix=None):
+        """
+        :param user_embeddings: (|U|, K) user embeddings, e.g. sess.run(model.user_embeddings)
+        :param index: the IVFIndex over the item embeddings
+        :param train_user_item_matrix: (optional) the items to exclude from each user's recommendations
+        """
+        self.user_embeddings = numpy.asarray(user_embeddings, dtype=numpy.float32)
+        self.index = index
+        self.train_user_item_matrix = None
+        if train_user_item_matrix is not None:
+            self.train_user_item_matrix = item_index(train_user_item_matrix)
+
+    @classmethod
+    def from_session(cls, sess, model, train_user_item_matrix=None, **index_args):
+        user_embeddings, item_embeddings = sess.run([model.user_embeddings, model.item_embeddings])
+        return cls(user_embeddings, IVFIndex.build(item_embeddings, **index_args), train_user_item_matrix)
+
+    def recommend(self, user_ids, k=10, exclude_train=True, n_probe=None):
+        """
+        :param user_ids: the users to recommend to
+        :param k: number of items per user
+        :param exclude_train: never recommend a user's train items
+        :param n_probe: clusters scanned per user, more is slower and closer to the exact Top-K
+        :return: (len(user_ids), k) item ids, best first
+        """
+        user_ids = numpy.asarray(user_ids)
+        exclude = None
+        if exclude_train and self.train_user_item_matrix is not None:
+            exclude = [row_items(self.train_user_item_matrix, user) for user in user_ids]
+        return self.index.search(self.user_embeddings[user_ids], k, n_probe=n_probe, exclude=exclude)
+
+    def save(self, path):
+        """
+        Export the recommender to a single .npz file
+        """
+        arrays = {"user_embeddings": self.user_embeddings,
+                  "centroids": self.index.centroids,
+                  "list_offsets": self.index.list_offsets,
+                  "list_items": self.index.list_items,
+                  "list_vectors": self.index.list_vectors,
+                  "n_probe": self.index.n_probe}
+        if self.train_user_item_matrix is not None:
+            arrays.update(train_indptr=self.train_user_item_matrix.indptr,
+                          train_indices=self.train_user_item_matrix.indices,
+                          train_shape=self.train_user_item_matrix.shape)
+        numpy.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        arrays = numpy.load(path)
+        index = IVFIndex(arrays["centroids"], arrays["list_offsets"], arrays["list_items"], arrays["list_vectors"],
+                         int(arrays["n_probe"]))
+        train = None
+        if "train_indptr" in arrays:
+            indices = arrays["train_indices"]
+            train = csr_matrix((numpy.ones(len(indices), dtype=numpy.int8), indices, arrays["train_indptr"]),
+                               shape=tuple(arrays["train_shape"]))
+        return cls(arrays["user_embeddings"], index, train)
@@ -0,0 +1,360 @@
+"""
+Micro benchmarks for the data pipeline and recommendation serving. Run from this directory, e.g.
+
+    python benchmark.py loader
+"""
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import numpy as np
+from scipy.sparse import dok_matrix
+
+from ann import IVFIndex, Recommender
+from hogwild import HogwildTrainer, SharedCML
+from numpy_cml import CML as NumPyCML, validation_recall
+from sampler import WarpSampler
+from topk import exact_top_k
+from utils import binary_csr_matrix, citeulike, item_index, row_items, split_data
+
+
+def timed(function, *args, **kwargs):
+    start = time.time()
+    result = function(*args, **kwargs)
+    return time.time() - start, result
+
+
+def write_synthetic_citeulike(data_dir, scale=10, seed=1):
+    """
+    Write a synthetic users.dat / tag-item.dat pair with `scale` times the size of citeulike-t
+    (7947 users, 25975 items, 52946 tags, ~18 items per user and ~6.5 items per tag).
+    Lines follow the citeulike-t layout: the first token is the number of ids on the line.
+    """
+    rng = np.random.RandomState(seed)
+    n_users, n_items, n_tags = 7947 * scale, 25975 * scale, 52946 * scale
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    for name, n_lines, mean_length in (("users.dat", n_users, 17.), ("tag-item.dat", n_tags, 5.5)):
+        lengths = rng.geometric(1. / mean_length, size=n_lines)
+        ids = rng.randint(0, n_items, size=lengths.sum())
+        with open(os.path.join(data_dir, name), "w") as f:
+            start = 0
+            for length in lengths:
+                line = ids[start: start + length]
+                f.write("{} {}\n".format(length, " ".join(map(str, line))))
+                start += length
+
+
+def citeulike_dok(tag_occurence_thres=10, data_dir="citeulike-t"):
+    """
+    The previous dok_matrix loader of utils.citeulike, kept as the baseline for `benchmark_loader`
+    """
+    users_path = os.path.join(data_dir, "users.dat")
+    tags_path = os.path.join(data_dir, "tag-item.dat")
+    user_dict = defaultdict(set)
+    for u, item_list in enumerate(open(users_path).readlines()):
+        items = item_list.strip().split(" ")
+        for item in items:
+            user_dict[u].add(int(item))
+
+    n_users = len(user_dict)
+    n_items = max([item for items in user_dict.values() for item in items]) + 1
+
+    user_item_matrix = dok_matrix((n_users, n_items), dtype=np.int32)
+    for u, item_list in enumerate(open(users_path).readlines()):
+        items = item_list.strip().split(" ")
+        for item in items:
+            user_item_matrix[u, int(item)] = 1
+
+    n_features = 0
+    for l in open(tags_path).readlines():
+        items = l.strip().split(" ")
+        if len(items) >= tag_occurence_thres:
+            n_features += 1
+    features = dok_matrix((n_items, n_features), dtype=np.int32)
+    feature_index = 0
+    for l in open(tags_path).readlines():
+        items = l.strip().split(" ")
+        if len(items) >= tag_occurence_thres:
+            features[[int(i) for i in items], feature_index] = 1
+            feature_index += 1
+
+    return user_item_matrix, features
+
+
+def benchmark_loader(scale=10, tag_occurence_thres=5):
+    """
+    Compare utils.citeulike against the dok_matrix loader on a synthetic `scale` x citeulike-t input
+    """
+    data_dir = tempfile.mkdtemp()
+    try:
+        write_synthetic_citeulike(data_dir, scale=scale)
+        csr_time, (user_item_matrix, features) = timed(citeulike, tag_occurence_thres, data_dir, cache=False)
+        dok_time, (expected_user_item_matrix, expected_features) = timed(citeulike_dok, tag_occurence_thres,
+                                                                         data_dir)
+    finally:
+        shutil.rmtree(data_dir)
+    assert (user_item_matrix != expected_user_item_matrix).nnz == 0
+    assert (features != expected_features).nnz == 0
+    print("{}x citeulike-t ({} interactions, {} item-feature entries)".format(
+        scale, user_item_matrix.nnz, features.nnz))
+    print("dok loader: {:.2f}s, csr loader: {:.2f}s, speedup {:.1f}x".format(
+        dok_time, csr_time, dok_time / csr_time))
+
+
+def benchmark_cache(scale=10, tag_occurence_thres=5):
+    """
+    Time utils.citeulike without the binary cache, on the first (cache writing) call and on a cached call
+    """
+    data_dir = tempfile.mkdtemp()
+    try:
+        write_synthetic_citeulike(data_dir, scale=scale)
+        parse_time, (user_item_matrix, features) = timed(citeulike, tag_occurence_thres, data_dir, cache=False)
+        write_time, _ = timed(citeulike, tag_occurence_thres, data_dir)
+        mmap_time, (cached_user_item_matrix, cached_features) = timed(citeulike, tag_occurence_thres, data_dir)
+    finally:
+        shutil.rmtree(data_dir)
+    assert (user_item_matrix != cached_user_item_matrix).nnz == 0
+    assert (features != cached_features).nnz == 0
+    print("{}x citeulike-t: text {:.2f}s, text + cache write {:.2f}s, cached {:.2f}s".format(
+        scale, parse_time, write_time, mmap_time))
+
+
+def synthetic_embeddings(n_users, n_items, dim=50, n_clusters=200, noise=0.15, seed=1):
+    """
+    Clustered user and item embeddings inside the unit ball, a stand-in for the embeddings of a trained CML model
+    """
+    rng = np.random.RandomState(seed)
+    centers = rng.normal(size=(n_clusters, dim))
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+
+    def sample(n):
+        points = centers[rng.randint(0, n_clusters, size=n)] + rng.normal(scale=noise, size=(n, dim))
+        return (points / np.maximum(np.linalg.norm(points, axis=1, keepdims=True), 1)).astype(np.float32)
+
+    return sample(n_users), sample(n_items)
+
+
+def exact_recommend(user_embeddings, item_embeddings, train_user_item_matrix, user_ids, k):
+    """
+    Brute-force Top-K by the same distance as CML.item_scores, train items excluded
+    """
+    item_squared_norms = np.square(item_embeddings).sum(1)
+    distances = item_squared_norms[None, :] - 2 * user_embeddings[user_ids].dot(item_embeddings.T)
+    for row, user in enumerate(user_ids):
+        distances[row, row_items(train_user_item_matrix, user)] = np.inf
+    top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(top, np.argsort(np.take_along_axis(distances, top, 1), axis=1), 1)
+
+
+def benchmark_ann(n_users=10000, n_items=250000, k=50, n_queries=1000, seed=1):
+    """
+    Recall@k of the IVF recommender against the exact Top-K, and the per-user latency of both, for several n_probe
+    """
+    rng = np.random.RandomState(seed)
+    user_embeddings, item_embeddings = synthetic_embeddings(n_users, n_items, seed=seed)
+    train = item_index(binary_csr_matrix(np.repeat(np.arange(n_users), 20), rng.randint(0, n_items, 20 * n_users),
+                                         (n_users, n_items)))
+    user_ids = rng.choice(n_users, n_queries, replace=False)
+
+    build_time, index = timed(IVFIndex.build, item_embeddings)
+    recommender = Recommender(user_embeddings, index, train)
+    exact_time, expected = timed(exact_recommend, user_embeddings, item_embeddings, train, user_ids, k)
+    print("{} items, {} lists, build {:.2f}s, exact {:.3f}ms/user".format(
+        n_items, len(index.centroids), build_time, 1000 * exact_time / n_queries))
+    for n_probe in (1, 2, 4, 8, 16, 32):
+        ann_time, recommended = timed(recommender.recommend, user_ids, k, n_probe=n_probe)
+        recall = np.mean([len(np.intersect1d(a, b)) for a, b in zip(recommended, expected)]) / k
+        print("n_probe {:>2}: recall@{} {:.3f}, {:.3f}ms/user, {:.1f}x faster".format(
+            n_probe, k, recall, 1000 * ann_time / n_queries, exact_time / ann_time))
+
+
+def benchmark_topk(n_users=1000, n_items=200000, k=50, seed=1):
+    """
+    topk.exact_top_k against argpartition on the full (users, items) score matrix: time, memory, pruning and
+    that both return the same items
+    """
+    rng = np.random.RandomState(seed)
+    user_embeddings, item_embeddings = synthetic_embeddings(n_users, n_items, noise=0.05, seed=seed)
+    # spread the norms within the clip_norm ball
+    item_embeddings *= rng.uniform(0.2, 1, size=(n_items, 1)).astype(np.float32)
+    train = item_index(binary_csr_matrix(np.repeat(np.arange(n_users), 20), rng.randint(0, n_items, 20 * n_users),
+                                         (n_users, n_items)))
+    user_ids = np.arange(n_users)
+
+    exact_time, expected = timed(exact_recommend, user_embeddings, item_embeddings, train, user_ids, k)
+    blocked_time, (top_items, _, pruned) = timed(exact_top_k, user_embeddings, item_embeddings, k, exclude=train)
+    assert all(set(a) == set(b) for a, b in zip(top_items, expected))
+    print("{} users x {} items: full matrix {:.2f}s ({:.0f}MB of scores), blocked {:.2f}s, {:.0%} blocks pruned".format(
+        n_users, n_items, exact_time, n_users * n_items * 4 / 2. ** 20, blocked_time, pruned))
+
+
+def synthetic_interactions(scale=1, seed=1):
+    """
+    The user-item matrix of write_synthetic_citeulike
+    """
+    data_dir = tempfile.mkdtemp()
+    try:
+        write_synthetic_citeulike(data_dir, scale=scale, seed=seed)
+        user_item_matrix, _ = citeulike(data_dir=data_dir, cache=False)
+    finally:
+        shutil.rmtree(data_dir)
+    return user_item_matrix
+
+
+def benchmark_numpy_cml(batch_size=50000, n_negative=20, embed_dim=50, n_steps=20):
+    """
+    Training throughput in user-positive-item pairs per second of numpy_cml.CML, and of CML.CML when
+    TensorFlow is installed, on citeulike-t sized synthetic data
+    """
+    user_item_matrix = synthetic_interactions()
+    n_users, n_items = user_item_matrix.shape
+    sampler = WarpSampler(user_item_matrix, batch_size=batch_size, n_negative=n_negative, seed=1)
+    batches = [sampler.next_batch() for _ in range(n_steps)]
+    model = NumPyCML(n_users, n_items, embed_dim=embed_dim, margin=1.0, clip_norm=1.1, sparse_updates=True, seed=1)
+    numpy_time, _ = timed(lambda: [model.partial_fit(*batch) for batch in batches])
+    print("NumPy CML: {:.0f} pairs/sec".format(n_steps * batch_size / numpy_time))
+    try:
+        import tensorflow as tf
+        from CML import CML
+    except ImportError:
+        print("TensorFlow is not installed, skipping CML.CML")
+        return
+    model = CML(n_users, n_items, embed_dim=embed_dim, margin=1.0, clip_norm=1.1, sparse_updates=True)
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        tf_time, _ = timed(lambda: [sess.run(model.optimize, {model.user_positive_items_pairs: user_pos,
+                                                              model.negative_samples: neg})
+                                    for user_pos, neg in batches])
+    print("TensorFlow CML: {:.0f} pairs/sec".format(n_steps * batch_size / tf_time))
+
+
+def benchmark_numpy_parity(batch_size=10000, n_negative=20, embed_dim=50, n_steps=20, tolerance=1e-4):
+    """
+    Train CML.CML and numpy_cml.CML from the same embeddings on the same batches and compare the loss of
+    every step and the final embeddings
+    """
+    import tensorflow as tf
+    from CML import CML
+
+    user_item_matrix = synthetic_interactions()
+    n_users, n_items = user_item_matrix.shape
+    sampler = WarpSampler(user_item_matrix, batch_size=batch_size, n_negative=n_negative, seed=1)
+    arguments = dict(embed_dim=embed_dim, margin=1.0, clip_norm=1.1, master_learning_rate=0.5,
+                     sparse_updates=True)
+    tf.set_random_seed(1)
+    tf_model = CML(n_users, n_items, **arguments)
+    numpy_model = NumPyCML(n_users, n_items, seed=1, **arguments)
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        for variable, embeddings in ((tf_model.user_embeddings, numpy_model.user_embeddings),
+                                     (tf_model.item_embeddings, numpy_model.item_embeddings)):
+            variable.load(embeddings, sess)
+        max_loss_error = 0.
+        for _ in range(n_steps):
+            user_pos, neg = sampler.next_batch()
+            feed = {tf_model.user_positive_items_pairs: user_pos, tf_model.negative_samples: neg}
+            tf_loss = sess.run(tf_model.loss, feed)
+            sess.run(tf_model.optimize, feed)
+            numpy_loss = numpy_model.partial_fit(user_pos, neg)
+            max_loss_error = max(max_loss_error, abs(tf_loss - numpy_loss) / abs(tf_loss))
+        tf_embeddings = sess.run([tf_model.user_embeddings, tf_model.item_embeddings])
+    embedding_error = max(np.abs(tf_embeddings[0] - numpy_model.user_embeddings).max(),
+                          np.abs(tf_embeddings[1] - numpy_model.item_embeddings).max())
+    print("{} steps: max relative loss difference {:.2e}, max embedding difference {:.2e}".format(
+        n_steps, max_loss_error, embedding_error))
+    assert max_loss_error < tolerance and embedding_error < tolerance
+
+
+def benchmark_hogwild(max_workers=None, batch_size=10000, n_negative=20, embed_dim=50, n_steps=200,
+                      recall_tolerance=0.15):
+    """
+    Hogwild scaling from 1 to max_workers processes (default: the number of cores): training throughput,
+    its efficiency relative to perfect scaling, and the validation recall after the same number of batches
+    on citeulike-t (synthetic data when citeulike-t is missing)
+    :param recall_tolerance: the largest relative difference allowed between the recall@50 of every run and
+           that of the single worker run, the workers' lock-free updates must not cost accuracy
+    """
+    n_cores = multiprocessing.cpu_count()
+    max_workers = max_workers or n_cores
+    if max_workers > n_cores or n_cores == 1:
+        print("{} core(s): the runs of more workers than cores measure their overhead, not a speedup".format(
+            n_cores))
+    if os.path.isdir("citeulike-t"):
+        user_item_matrix, _ = citeulike()
+    else:
+        user_item_matrix = synthetic_interactions()
+    train, valid, _ = split_data(user_item_matrix)
+    train, valid = item_index(train), item_index(valid)
+    valid_users = np.flatnonzero(np.diff(valid.indptr))
+    single_throughput = None
+    single_recall = None
+    n_workers = 1
+    while n_workers <= max_workers:
+        model = SharedCML(*train.shape, embed_dim=embed_dim, margin=1.0, clip_norm=1.1, sparse_updates=True,
+                          seed=1)
+        with HogwildTrainer(model, train, n_workers, batch_size, n_negative, seed=1) as trainer:
+            train_time, _ = timed(trainer.run, n_steps)
+        throughput = n_steps * batch_size / train_time
+        single_throughput = single_throughput or throughput
+        recall = validation_recall(model, train, valid, valid_users)
+        single_recall = single_recall or recall
+        print("{:>3} workers: {:.0f} pairs/sec, {:.0%} scaling efficiency{}, recall@50 {:.4f} ({:+.1%})".format(
+            n_workers, throughput, throughput / (n_workers * single_throughput),
+            " (oversubscribed)" if n_workers > n_cores else "", recall, recall / single_recall - 1))
+        assert abs(recall - single_recall) <= recall_tolerance * single_recall, \
+            "recall@50 of {} workers is more than {:.0%} away from the single worker run".format(
+                n_workers, recall_tolerance)
+        n_workers *= 2
+
+
+def benchmark_auc(n_users=300, n_items=20000, seed=1):
+    """
+    RecallEvaluator.cal_AUC and auc_batch against sklearn's roc_auc_score on the non-train items of each user,
+    with tied scores
+    """
+    from sklearn.metrics import roc_auc_score
+    from myCML import RecallEvaluator
+
+    rng = np.random.RandomState(seed)
+    users = np.repeat(np.arange(n_users), 40)
+    train, valid, _ = split_data(binary_csr_matrix(users, rng.randint(0, n_items, len(users)), (n_users, n_items)))
+    evaluator = RecallEvaluator(train, valid)
+    user_ids = evaluator.test_users
+    # rounded scores, so that some test items tie with negatives
+    scores = np.round(rng.normal(size=(len(user_ids), n_items)), 2).astype(np.float32)
+
+    def sklearn_auc():
+        aucs = []
+        for user, user_scores in zip(user_ids, scores):
+            candidates = np.setdiff1d(np.arange(n_items), evaluator.train_items(user))
+            aucs.append(roc_auc_score(np.in1d(candidates, evaluator.test_items(user)), user_scores[candidates]))
+        return np.array(aucs)
+
+    sklearn_time, expected = timed(sklearn_auc)
+    per_user_time, per_user = timed(lambda: np.array([evaluator.cal_AUC(user, user_scores)
+                                                      for user, user_scores in zip(user_ids, scores)]))
+    batch_time, batch = timed(evaluator.auc_batch, user_ids, scores)
+    assert np.allclose(per_user, expected) and np.allclose(batch, expected)
+    print("{} users x {} items: sklearn per user {:.2f}s, cal_AUC {:.2f}s, auc_batch {:.2f}s".format(
+        len(user_ids), n_items, sklearn_time, per_user_time, batch_time))
+
+
+BENCHMARKS = {
+    "ann": benchmark_ann,
+    "auc": benchmark_auc,
+    "cache": benchmark_cache,
+    "hogwild": benchmark_hogwild,
+    "loader": benchmark_loader,
+    "numpy_cml": benchmark_numpy_cml,
+    "numpy_parity": benchmark_numpy_parity,
+    "topk": benchmark_topk,
+}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
@@ -0,0 +1,221 @@
+"""
+Hogwild training of numpy_cml.CML: worker processes sample from their own shard of the users and apply
+lock-free sparse Adagrad updates to embeddings and accumulators held in shared memory
+"""
+import multiprocessing
+import queue
+from multiprocessing.sharedctypes import RawArray
+
+import numpy
+from scipy.sparse import csr_matrix
+
+from numpy_cml import CML, validation_recall
+from sampler import WarpSampler
+from training import EarlyStopping, TrainingBudget
+from utils import citeulike, item_index, split_data
+
+BATCH_SIZE = 50000
+N_NEGATIVE = 20
+N_WORKERS = multiprocessing.cpu_count()
+EVALUATION_EVERY_N_BATCHES = 100
+EMBED_DIM = 50
+EARLY_STOPPING_PATIENCE = 10
+# seconds between the checks that the workers are alive while waiting for their results
+WORKER_POLL_SECONDS = 1.0
+
+SHARED_ARRAYS = ("user_embeddings", "item_embeddings", "user_accumulator", "item_accumulator")
+
+
+def shared_array(array):
+    """
+    :return: (raw, view) a float32 copy of array in shared memory and a numpy view on it
+    """
+    raw = RawArray("f", array.size)
+    view = numpy.frombuffer(raw, dtype=numpy.float32).reshape(array.shape)
+    view[:] = array
+    return raw, view
+
+
+class SharedCML(CML):
+    """
+    numpy_cml.CML whose embeddings and Adagrad accumulators live in shared memory. Processes started with the
+    model as an argument update the same arrays, with fork as with spawn.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(SharedCML, self).__init__(*args, **kwargs)
+        self.shared = {}
+        for name in SHARED_ARRAYS:
+            array = getattr(self, name)
+            raw, view = shared_array(array)
+            self.shared[name] = (raw, array.shape)
+            setattr(self, name, view)
+
+    def __getstate__(self):
+        # send the shared buffers, not copies of their content
+        state = dict(self.__dict__)
+        for name in SHARED_ARRAYS:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for name, (raw, shape) in self.shared.items():
+            setattr(self, name, numpy.frombuffer(raw, dtype=numpy.float32).reshape(shape))
+
+
+def shard_users(user_item_matrix, n_shards):
+    """
+    :return: n_shards copies of the user-item matrix, shard i keeping the rows of the users u with u % n_shards == i
+    """
+    user_item_matrix = item_index(user_item_matrix)
+    users = numpy.repeat(numpy.arange(user_item_matrix.shape[0]), numpy.diff(user_item_matrix.indptr))
+    shards = []
+    for i in range(n_shards):
+        keep = users % n_shards == i
+        shards.append(csr_matrix((user_item_matrix.data[keep], (users[keep], user_item_matrix.indices[keep])),
+                                 shape=user_item_matrix.shape))
+    return shards
+
+
+def hogwild_worker(model, shard, batch_size, n_negative, seed, tasks, results):
+    """
+    Train the shared model on batches of the shard: every task is a number of steps, every result the list of
+    their losses. A None task stops the worker.
+    """
+    sampler = WarpSampler(shard, batch_size=batch_size, n_negative=n_negative, seed=seed)
+    for n_steps in iter(tasks.get, None):
+        results.put([model.partial_fit(*sampler.next_batch()) for _ in range(n_steps)])
+
+
+class HogwildTrainer(object):
+    """
+    A pool of worker processes training one SharedCML. Call close() (or use the trainer as a context manager)
+    to stop the workers.
+    """
+
+    def __init__(self, model, train, n_workers=N_WORKERS, batch_size=BATCH_SIZE, n_negative=N_NEGATIVE, seed=None):
+        """
+        :param model: the SharedCML to train
+        :param train: the train user-item matrix, split by user between the workers
+        :param n_workers: number of worker processes
+        :param batch_size: number of user-positive-item pairs of every worker batch
+        :param n_negative: number of negative items per pair
+        :param seed: seed of the samplers, worker i uses [seed, i]
+        """
+        self.n_workers = n_workers
+        self.tasks = [multiprocessing.Queue() for _ in range(n_workers)]
+        self.results = multiprocessing.Queue()
+        self.workers = []
+        for i, shard in enumerate(shard_users(train, n_workers)):
+            worker = multiprocessing.Process(target=hogwild_worker,
+                                             args=(model, shard, batch_size, n_negative,
+                                                   None if seed is None else [seed, i], self.tasks[i],
+                                                   self.results))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def run(self, n_steps):
+        """
+        Run n_steps batches, split between the workers
+        :return: the losses of the batches
+        """
+        n_tasks = 0
+        for i, tasks in enumerate(self.tasks):
+            worker_steps = n_steps // self.n_workers + (i < n_steps % self.n_workers)
+            if worker_steps:
+                tasks.put(worker_steps)
+                n_tasks += 1
+        losses = []
+        while n_tasks:
+            try:
+                losses.extend(self.results.get(timeout=WORKER_POLL_SECONDS))
+                n_tasks -= 1
+            except queue.Empty:
+                self.check_workers()
+        return losses
+
+    def check_workers(self):
+        """
+        Raise a RuntimeError if a worker has exited, e.g. killed by the OOM killer or by an exception, after
+        terminating the others: its task will never be answered
+        """
+        dead = [(i, worker.exitcode) for i, worker in enumerate(self.workers) if not worker.is_alive()]
+        if dead:
+            for worker in self.workers:
+                worker.terminate()
+                worker.join()
+            self.workers = []
+            raise RuntimeError("Hogwild workers exited: " + ", ".join(
+                "worker {} with exit code {}".format(i, exitcode) for i, exitcode in dead))
+
+    def close(self):
+        for tasks in self.tasks:
+            tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def optimize(model, train, valid, n_workers=N_WORKERS, batch_size=BATCH_SIZE, n_negative=N_NEGATIVE,
+             patience=EARLY_STOPPING_PATIENCE, max_steps=None, max_seconds=None, restore_best=True, seed=None):
+    """
+    numpy_cml.optimize with the mini-batches run by n_workers Hogwild processes
+    :param model: the SharedCML to optimize
+    :return: (model, best_recall)
+    """
+    train, valid = item_index(train), item_index(valid)
+    # sample some users to calculate recall validation
+    valid_users = numpy.flatnonzero(numpy.diff(valid.indptr))[:300]
+    early_stopping = EarlyStopping(patience)
+    budget = TrainingBudget(max_steps, max_seconds)
+    best_embeddings = None
+    step = 0
+    with HogwildTrainer(model, train, n_workers, batch_size, n_negative, seed) as trainer:
+        while True:
+            recall = validation_recall(model, train, valid, valid_users)
+            print("\nRecall on (sampled) validation set: {}".format(recall))
+            if early_stopping.update(recall, step):
+                best_embeddings = model.user_embeddings.copy(), model.item_embeddings.copy()
+            if early_stopping.should_stop or budget.exhausted(step):
+                break
+
+            # train model
+            n_steps = EVALUATION_EVERY_N_BATCHES
+            if max_steps is not None:
+                n_steps = min(n_steps, max_steps - step)
+            losses = trainer.run(n_steps)
+            step += n_steps
+            print("\nTraining loss {}".format(numpy.mean(losses)))
+
+    print("\nStopped after {} steps, best validation recall {} at step {}".format(
+        step, early_stopping.best, early_stopping.best_step))
+    if restore_best:
+        model.user_embeddings[:], model.item_embeddings[:] = best_embeddings
+    return model, early_stopping.best
+
+
+if __name__ == '__main__':
+    # get user-item matrix
+    user_item_matrix, _ = citeulike(tag_occurence_thres=5)
+    n_users, n_items = user_item_matrix.shape
+    # get train/valid/test user-item matrices
+    train, valid, test = split_data(user_item_matrix)
+    model = SharedCML(n_users,
+                      n_items,
+                      embed_dim=EMBED_DIM,
+                      margin=1.0,
+                      clip_norm=1.1,
+                      master_learning_rate=0.5,
+                      # the workers only clip the rows they move, clipping whole tables would race on all of them
+                      sparse_updates=True,
+                      seed=1,
+                      )
+    optimize(model, train, valid, seed=1)
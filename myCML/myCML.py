@@ -1,4 +1,5 @@
 import functools
+import time
 import numpy
 import sklearn.preprocessing
 
@@ -8,16 +9,14 @@ from sklearn.utils import check_X_y
 import sys
 import tensorflow as tf
 import toolz
-from scipy.sparse import lil_matrix, dok_matrix
+from scipy.sparse import csr_matrix
 from tqdm import tqdm
-from utils import citeulike, split_data
-from sklearn.metrics import roc_curve
-from sklearn.metrics import auc
-from sklearn.metrics import roc_auc_score
+from sampler import WarpSampler
+from telemetry import Telemetry
+from training import EarlyStopping, EmbeddingCheckpointer, TrainingBudget
+from utils import citeulike, split_data, item_index, row_items, isin_sorted, scatter_rows, metrics_writer
 
 
-PATH = '/home/xiepanlong/CTRExperiment/Collaborative-metric-learning/Test.txt'
-
 def doublewrap(function):
     """
     A decorator decorator, allowing to use the decorator to be used without
@@ -58,18 +57,6 @@ def define_scope(function, scope=None, *args, **kwargs):
 
     return decorator
 
-def save_INFO(path, context, explain):
-    """
-    :param path: 
-    :return: 
-    """
-    file = open(path, 'a')
-    file.write(explain + '\n')
-    for i in context:
-        file.write(str(i) + ',')
-    file.write('\n')
-    file.close()
-
 def dcg_at_k(y_score, k=5, method=0):
     y_score = numpy.asfarray(y_score)[:k]
     if y_score.size:
@@ -81,53 +68,93 @@ def dcg_at_k(y_score, k=5, method=0):
             raise ValueError('method must be 0 or 1.')
     return 0
 
+def dcg_discounts(k, method=0):
+    """
+    The position discounts used by dcg_at_k, i.e. dcg_at_k(r, k, method) == r[:k].dot(dcg_discounts(len(r[:k]), method))
+    """
+    if method == 0:
+        return numpy.concatenate(([1.], 1. / numpy.log2(numpy.arange(2, k + 1))))
+    elif method == 1:
+        return 1. / numpy.log2(numpy.arange(2, k + 2))
+    else:
+        raise ValueError('method must be 0 or 1.')
+
 class RecallEvaluator(object):
+    """
+    Validation metrics of a model's item scores. The per-user indexes are built once, so create one evaluator
+    per (train, test) pair and reuse it across evaluation rounds.
+    """
     def __init__(self, train_user_item_matrix, test_user_item_matrix):
-        self.train_user_item_matrix = lil_matrix(train_user_item_matrix)
-        self.test_user_item_matrix = lil_matrix(test_user_item_matrix)
-        n_users = train_user_item_matrix.shape[0]
-        self.user_to_test_set = {u: set(self.test_user_item_matrix[u, :].nonzero()[1])
-                                 for u in range(n_users) if self.test_user_item_matrix[u, :].sum()}
+        self.train_user_item_matrix = item_index(train_user_item_matrix)
+        self.test_user_item_matrix = item_index(test_user_item_matrix)
+        # the users that have test items, i.e. those that can be evaluated
+        self.test_users = numpy.flatnonzero(numpy.diff(self.test_user_item_matrix.indptr))
 
-        if self.train_user_item_matrix is not None:
-            self.user_to_train_set = {u: set(self.train_user_item_matrix[u, :].nonzero()[1])
-                                      for u in range(n_users) if self.train_user_item_matrix[u, :].sum()}
+    def train_items(self, user_id):
+        """
+        :return: the sorted train items of user_id
+        """
+        return row_items(self.train_user_item_matrix, user_id)
 
-    def cal_AUC(self, user_id, item_scores):
+    def test_items(self, user_id):
         """
-        Compute AUC
-        :param user_id: 
-        :param item_scores: 
-        :return: 
+        :return: the sorted test items of user_id
         """
-        train_set = self.user_to_train_set[user_id]
-        test_set = self.user_to_test_set[user_id]
+        return row_items(self.test_user_item_matrix, user_id)
 
-        amin, amax = item_scores.min(), item_scores.max()
-        item_scores = (item_scores - amin) / (amax - amin)
-        idea_score = numpy.zeros(item_scores.shape[0])
-        # print('len: ', len(item_scores))
-        # print('item_scores: ', item_scores)
-        # print('idea_score1: ', idea_score)
-        # print('test_set: ')
-
-        for i in test_set:
-            # print(i)
-            idea_score[i] = 1
-        for i in train_set:
-            numpy.delete(item_scores, i, axis=0)
-            numpy.delete(idea_score, i, axis=0)
-        idea_max = idea_score.max()
-        # print(idea_max)
-        # if idea_max < 1:
-        #    return 11111.1
-        # print('len2: ', len(idea_score))
-        # print('idea_score2: ', idea_score)
-        # fpr, tpr, thresholds = roc_curve(idea_score, item_scores, pos_label=2)
-        # return auc(fpr, tpr)
-
-        return roc_auc_score(idea_score, item_scores)
+    def top_k_hits(self, user_id, item_scores, k):
+        """
+        :return: the number of test items among the K best scored items that are not in the train set
+        """
+        train_items = self.train_items(user_id)
+        candidates = numpy.argpartition(-item_scores, k + len(train_items))[:k + len(train_items)]
+        candidates = candidates[~isin_sorted(train_items, candidates)]
+        # argpartition leaves the candidates unordered, the K best are those of highest score
+        top_items = candidates[numpy.argsort(-item_scores[candidates], kind="mergesort")[:k]]
+        return numpy.count_nonzero(isin_sorted(self.test_items(user_id), top_items))
 
+    def cal_AUC(self, user_id, item_scores):
+        """
+        Compute the AUC of a particular user, the probability that a test item is scored above an item that is
+        neither a test nor a train item
+        :param user_id: the user id
+        :param item_scores: an array contains the predicted score to every item
+        :return: AUC
+        """
+        return self.auc_batch([user_id], item_scores[None, :])[0]
+
+    def auc_batch(self, user_ids, item_scores):
+        """
+        Compute the AUC of a block of users from the ranks of their test items among the candidate items, the
+        items not in their train set. Ties count one half, as sklearn.metrics.roc_auc_score.
+        :param user_ids: the user ids, every user must have test items
+        :param item_scores: an array of shape (len(user_ids), N_ITEM), the predicted scores of those users
+        :return: an array of shape (len(user_ids),)
+        """
+        user_ids = numpy.asarray(user_ids)
+        n_users, n_items = item_scores.shape
+        train_rows, train_items = scatter_rows(self.train_user_item_matrix, user_ids)
+        test_rows, test_items = scatter_rows(self.test_user_item_matrix, user_ids)
+        # (row, item) keys are globally sorted, a test item that is also a train item is not a candidate
+        test_in_train = isin_sorted(train_rows * n_items + train_items, test_rows * n_items + test_items)
+        test_rows, test_items = test_rows[~test_in_train], test_items[~test_in_train]
+        # the train items are sorted after every candidate, so that they do not change the candidates' ranks
+        masked_scores = numpy.array(item_scores, dtype=numpy.float64)
+        masked_scores[train_rows, train_items] = numpy.inf
+        sorted_scores = numpy.sort(masked_scores, axis=1)
+        test_scores = masked_scores[test_rows, test_items]
+        # the average rank of every test item among the items of its row, ties share their ranks
+        ranks = numpy.empty(len(test_scores))
+        bounds = numpy.searchsorted(test_rows, numpy.arange(n_users + 1))
+        for row, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:])):
+            scores = test_scores[start: stop]
+            ranks[start: stop] = (numpy.searchsorted(sorted_scores[row], scores, 'left') +
+                                  numpy.searchsorted(sorted_scores[row], scores, 'right') + 1) / 2.
+        n_test = numpy.bincount(test_rows, minlength=n_users)
+        n_negative = n_items - numpy.bincount(train_rows, minlength=n_users) - n_test
+        # Mann-Whitney U: the sum of the test items' ranks minus the ranks they would have below every negative
+        return (numpy.bincount(test_rows, ranks, minlength=n_users) - n_test * (n_test + 1) / 2.) / \
+            (n_test * n_negative)
 
     def cal_precision(self, user_id, item_scores, k=50):
         """
@@ -136,27 +163,9 @@ class RecallEvaluator(object):
         :param item_scores: an array contains the predicted score to every item
         :return: precision@K
         """
-
-        train_set = self.user_to_train_set[user_id]
-        test_set = self.user_to_test_set[user_id]
-
-        top_items = numpy.argpartition(-item_scores, k + len(train_set))[:k + len(train_set)]
-        top_n_items = 0
-        hits = 0
-        for i in top_items:
-            if i in train_set:
-                continue
-            if i in test_set:
-                hits += 1
-            top_n_items += 1
-            if top_n_items == k:
-                break
-        return hits / float(k)
+        return self.top_k_hits(user_id, item_scores, k) / float(k)
 
     def cal_NDCG_at_k(self, user_id, item_scores, k=5, method=0):
-        train_set = self.user_to_train_set[user_id]
-        test_set = self.user_to_test_set[user_id]
-
         amin, amax = item_scores.min(), item_scores.max()
         y_score = (item_scores - amin) / (amax - amin)
 
@@ -173,51 +182,53 @@ class RecallEvaluator(object):
         :param k: compute the recall for the top K items
         :return: recall@K
         """
-        train_set = self.user_to_train_set[user_id]
-        test_set = self.user_to_test_set[user_id]
-
-        top_items = numpy.argpartition(-item_scores, k + len(train_set))[:k + len(train_set)]
-        top_n_items = 0
-        hits = 0
-        for i in top_items:
-            if i in train_set:
-                continue
-            if i in test_set:
-                hits += 1
-            top_n_items += 1
-            if top_n_items == k:
-                break
-        return hits / float(len(test_set))
-
-
-class WarpSampler(object):
-    """
-    A generator that generate tuples: user-positive-item pairs, negative-items
-
-    of shapes (Batch Size, 2) and (Batch Size, N_Negative)
-    """
-
-    def __init__(self, user_item_matrix, batch_size=10000, n_negative=10):
-        self.user_item_matrix = dok_matrix(user_item_matrix)
-        self.user_item_pairs = numpy.asarray(self.user_item_matrix.nonzero()).T
-        self.batch_size = batch_size
-        self.n_negative = n_negative
-
-    @property
-    def sample(self):
-        while True:
-            numpy.random.shuffle(self.user_item_pairs)
-            for i in range(int(len(self.user_item_pairs) / self.batch_size)):
-                user_positive_items_pairs = self.user_item_pairs[i * self.batch_size: (i + 1) * self.batch_size, :]
-
-                negative_samples = numpy.random.randint(0,
-                                                        self.user_item_matrix.shape[1],
-                                                        size=(self.batch_size, self.n_negative))
-
-                yield user_positive_items_pairs, negative_samples
-
-    def next_batch(self):
-        return self.sample.__next__()
+        return self.top_k_hits(user_id, item_scores, k) / float(len(self.test_items(user_id)))
+
+    def eval_batch(self, user_ids, item_scores, k=50, method=0):
+        """
+        Compute recall@K, precision@K, NDCG@K and AUC for a block of users at once
+        :param user_ids: the user ids, every user must have test items
+        :param item_scores: an array of shape (len(user_ids), N_ITEM), the predicted scores of those users
+        :param k: the cut-off of the Top-K metrics
+        :param method: the dcg_at_k discount used by NDCG@K
+        :return: a dict of arrays of shape (len(user_ids),) keyed by 'recall', 'precision', 'ndcg' and 'auc'
+        """
+        user_ids = numpy.asarray(user_ids)
+        # exclude the train items from the Top-K
+        masked_scores = numpy.array(item_scores, dtype=numpy.float64)
+        masked_scores[scatter_rows(self.train_user_item_matrix, user_ids)] = -numpy.inf
+        top_items = numpy.argpartition(-masked_scores, k - 1, axis=1)[:, :k]
+        # sort the Top-K by score
+        top_items = numpy.take_along_axis(
+            top_items, numpy.argsort(-numpy.take_along_axis(masked_scores, top_items, 1), axis=1), 1)
+        metrics = self.top_k_metrics(user_ids, top_items, method)
+        metrics['auc'] = self.auc_batch(user_ids, item_scores)
+        return metrics
+
+    def top_k_metrics(self, user_ids, top_items, method=0):
+        """
+        Compute recall@K, precision@K and NDCG@K from the Top-K lists alone, e.g. those of topk.exact_top_k
+        with exclude=self.train_user_item_matrix
+        :param user_ids: the user ids, every user must have test items
+        :param top_items: an array of shape (len(user_ids), K), each user's best items first, without train items
+        :param method: the dcg_at_k discount used by NDCG@K
+        :return: a dict of arrays of shape (len(user_ids),) keyed by 'recall', 'precision' and 'ndcg'
+        """
+        k = top_items.shape[1]
+        test_rows, test_items = scatter_rows(self.test_user_item_matrix, numpy.asarray(user_ids))
+        n_test = numpy.bincount(test_rows, minlength=len(top_items))
+        # test items are sorted within each row, (row, item) keys are globally sorted
+        n_keys = max(self.test_user_item_matrix.shape[1], top_items.max() + 1)
+        test_keys = test_rows * n_keys + test_items
+        top_keys = numpy.arange(len(top_items))[:, None] * n_keys + top_items
+        top_hits = isin_sorted(test_keys, top_keys.ravel()).reshape(top_items.shape) & (top_items >= 0)
+        hits = top_hits.sum(1)
+
+        discounts = dcg_discounts(k, method)
+        idcg = numpy.cumsum(discounts)[numpy.minimum(n_test, k) - 1]
+        return {'recall': hits / n_test.astype(numpy.float64),
+                'precision': hits / float(k),
+                'ndcg': top_hits.dot(discounts) / idcg}
 
 
 class CML(object):
@@ -232,7 +243,8 @@ class CML(object):
                  hidden_layer_dim=128,
                  dropout_rate=0.2,
                  feature_l2_reg=0.1,
-                 feature_projection_scaling_factor=0.5
+                 feature_projection_scaling_factor=0.5,
+                 sparse_updates=False
                  ):
         """
 
@@ -240,8 +252,9 @@ class CML(object):
         :param n_items: number of items i.e. |V|
         :param
         :param embed_dim: embedding size i.e. K (default 20)
-        :param features: (optional) the feature vectors of items, shape: (|V|, N_Features).
-               Set it to None will disable feature loss(default: None)
+        :param features: (optional) the feature vectors of items, shape: (|V|, N_Features), a scipy sparse
+               matrix such as the features of citeulike() or a dense array. Only the rows of the items of each
+               batch are projected. Set it to None will disable feature loss(default: None)
         :param margin: hinge loss threshold i.e. z
         :param master_learning_rate: master learning rate for AdaGrad
         :param clip_norm: clip norm threshold (default 1.0)
@@ -250,6 +263,10 @@ class CML(object):
         :param feature_l2_reg: feature loss weight
         :param feature_projection_scaling_factor: scale the feature projection before compute l2 loss. Ideally,
                the scaled feature projection should be mostly within the clip_norm
+        :param sparse_updates: clip only the embedding rows of the mini-batch after each step instead of the
+               whole tables, so that a step costs O(batch size) rather than O(|U| + |V|). The embedding loss
+               gradients are already row-sparse, hence the Adagrad updates only touch those rows as well
+               (the feature loss covers the batch items only).
         """
 
         self.n_users = n_users
@@ -259,7 +276,15 @@ class CML(object):
         self.clip_norm = clip_norm
         self.margin = margin
         if features is not None:
-            self.features = tf.constant(features, dtype=tf.float32)
+            # kept as csr arrays, the projector gathers the rows of the items it needs
+            self.features = csr_matrix(features, dtype=numpy.float32, copy=True)
+            self.features.sort_indices()
+            self.n_features = self.features.shape[1]
+            self.feature_indptr = tf.constant(self.features.indptr, dtype=tf.int64)
+            self.feature_indices = tf.constant(self.features.indices, dtype=tf.int64)
+            self.feature_values = tf.constant(self.features.data, dtype=tf.float32)
+            with tf.variable_scope("feature_projector") as feature_projector_scope:
+                self.feature_projector_scope = feature_projector_scope
         else:
             self.features = None
 
@@ -268,16 +293,21 @@ class CML(object):
         self.dropout_rate = dropout_rate
         self.feature_l2_reg = feature_l2_reg
         self.feature_projection_scaling_factor = feature_projection_scaling_factor
+        self.sparse_updates = sparse_updates
 
         self.user_positive_items_pairs = tf.placeholder(tf.int32, [None, 2])
         self.negative_samples = tf.placeholder(tf.int32, [None, None])
         self.score_user_ids = tf.placeholder(tf.int32, [None])
+        # the items whose embedding init_item_embeddings sets to their feature projection
+        self.projected_item_ids = tf.placeholder(tf.int32, [None])
         self.user_embeddings
         self.item_embeddings
         self.embedding_loss
         self.feature_loss
         self.loss
         self.optimize
+        # built with the other variables, so that global_variables_initializer covers the norm cache
+        self.item_scores
 
     @define_scope
     def user_embeddings(self):
@@ -289,41 +319,61 @@ class CML(object):
         return tf.Variable(tf.random_normal([self.n_items, self.embed_dim],
                                             stddev=1 / (self.embed_dim ** 0.5), dtype=tf.float32))
 
-    @define_scope
-    def mlp_layer_1(self):
-        return tf.layers.dense(inputs=self.features,
-                               units=self.hidden_layer_dim,
-                               activation=tf.nn.relu, name="mlp_layer_1")
+    def project_features(self, item_ids):
+        """
+        :param item_ids: the items to project
+        :return: the projection of the feature vectors of item_ids to the user-item embedding
+        """
+        with tf.variable_scope(self.feature_projector_scope, reuse=tf.AUTO_REUSE):
+            # the (N, N_Features) feature rows of item_ids as a SparseTensor, gathered from the csr arrays
+            item_ids = tf.cast(item_ids, tf.int64)
+            positions = tf.ragged.range(tf.gather(self.feature_indptr, item_ids),
+                                        tf.gather(self.feature_indptr, item_ids + 1))
+            features = tf.SparseTensor(
+                tf.stack([positions.value_rowids(), tf.gather(self.feature_indices, positions.flat_values)], 1),
+                tf.gather(self.feature_values, positions.flat_values),
+                tf.stack([tf.size(item_ids, out_type=tf.int64), self.n_features]))
+
+            # fully-connected layers, the first one a sparse-dense matmul
+            with tf.variable_scope("mlp_layer_1"):
+                kernel = tf.get_variable("kernel", [self.n_features, self.hidden_layer_dim])
+                bias = tf.get_variable("bias", [self.hidden_layer_dim], initializer=tf.zeros_initializer())
+            mlp_layer_1 = tf.nn.relu(tf.sparse_tensor_dense_matmul(features, kernel) + bias)
+            dropout = tf.layers.dropout(inputs=mlp_layer_1, rate=self.dropout_rate)
+            output = tf.layers.dense(inputs=dropout, units=self.embed_dim, name="mlp_layer_2") \
+                * self.feature_projection_scaling_factor
 
-    @define_scope
-    def mlp_layer_2(self):
-        dropout = tf.layers.dropout(inputs=self.mlp_layer_1, rate=self.dropout_rate)
-        return tf.layers.dense(inputs=dropout, units=self.embed_dim, name="mlp_layer_2")
+            # projection to the embedding
+            return tf.clip_by_norm(output, self.clip_norm, axes=[1], name="feature_projection")
 
     @define_scope
     def feature_projection(self):
         """
-        :return: the projection of the feature vectors to the user-item embedding
+        :return: the projection of the feature vectors of the batch items to the user-item embedding
         """
 
         # feature loss
         if self.features is not None:
-            # fully-connected layer
-            output = self.mlp_layer_2 * self.feature_projection_scaling_factor
+            return self.project_features(self.batch_item_ids)
 
-            # projection to the embedding
-            return tf.clip_by_norm(output, self.clip_norm, axes=[1], name="feature_projection")
+    @define_scope
+    def init_item_embeddings(self):
+        """
+        :return: the op setting the embedding of projected_item_ids to their feature projection
+        """
+        return tf.scatter_update(self.item_embeddings, self.projected_item_ids,
+                                 self.project_features(self.projected_item_ids))
 
     @define_scope
     def feature_loss(self):
         """
-        :return: the l2 loss of the distance between items' their embedding and their feature projection
+        :return: the l2 loss of the distance between the batch items' embedding and their feature projection
         """
         if self.feature_projection is not None:
 
             # the distance between feature projection and the item's actual location in the embedding
             feature_distance = tf.reduce_mean(tf.squared_difference(
-                self.item_embeddings,
+                tf.nn.embedding_lookup(self.item_embeddings, self.batch_item_ids),
                 self.feature_projection), 1)
 
             # apply regularization weight
@@ -361,6 +411,8 @@ class CML(object):
 
         # number of impostors for each user-positive-item pair
         impostors = (tf.expand_dims(pos_distances, -1) - distance_to_neg_items + self.margin) > 0
+        # the fraction of negative samples that are impostors, reported by the telemetry
+        self.impostor_fraction = tf.reduce_mean(tf.cast(impostors, tf.float32), name="impostor_fraction")
 
         # best negative item (among W negative samples) their distance to the user embedding (N)
         closest_negative_distances = tf.reduce_min(distance_to_neg_items, 1, name="closest_negative_distances")
@@ -387,644 +439,252 @@ class CML(object):
         return [tf.assign(self.user_embeddings, tf.clip_by_norm(self.user_embeddings, self.clip_norm, axes=[1])),
                 tf.assign(self.item_embeddings, tf.clip_by_norm(self.item_embeddings, self.clip_norm, axes=[1]))]
 
+    @define_scope
+    def batch_user_ids(self):
+        # the distinct users of the mini-batch
+        return tf.unique(self.user_positive_items_pairs[:, 0])[0]
+
+    @define_scope
+    def batch_item_ids(self):
+        # the distinct positive and negative items of the mini-batch
+        return tf.unique(tf.concat([self.user_positive_items_pairs[:, 1],
+                                    tf.reshape(self.negative_samples, [-1])], 0))[0]
+
+    @define_scope
+    def clip_batch_rows_op(self):
+        """
+        :return: the clip of the mini-batch rows only, a scatter update of the rows the optimizer moved
+        """
+        return [tf.scatter_update(embeddings, ids,
+                                  tf.clip_by_norm(tf.gather(embeddings, ids), self.clip_norm, axes=[1]))
+                for embeddings, ids in ((self.user_embeddings, self.batch_user_ids),
+                                        (self.item_embeddings, self.batch_item_ids))]
+
     @define_scope
     def optimize(self):
         # have two separate learning rates. The first one for user/item embedding is un-normalized.
-        # The second one for feature projector NN is normalized by the number of items.
+        # The second one for feature projector NN is normalized by the number of items in the batch.
         gds = []
         gds.append(tf.train
                    .AdagradOptimizer(self.master_learning_rate)
                    .minimize(self.loss, var_list=[self.user_embeddings, self.item_embeddings]))
-        if self.feature_projection:
+        if self.feature_projection is not None:
             gds.append(tf.train
                        .AdagradOptimizer(self.master_learning_rate)
-                       .minimize(self.feature_loss / self.n_items))
+                       .minimize(self.feature_loss / tf.cast(tf.size(self.batch_item_ids), tf.float32)))
 
         with tf.control_dependencies(gds):
+            if self.sparse_updates:
+                return gds + self.clip_batch_rows_op
             return gds + [self.clip_by_norm_op]
 
+    @define_scope
+    def item_squared_norms(self):
+        # (1, N_ITEM), a cache shared by all the scored users and chunks, see refresh_item_squared_norms
+        return tf.Variable(tf.zeros([1, self.n_items]), trainable=False)
+
+    @define_scope
+    def refresh_item_squared_norms(self):
+        """
+        :return: the op recomputing item_squared_norms from the item embeddings, run it once before scoring
+                 whenever the item embeddings have changed, e.g. at the start of every evaluation
+        """
+        return tf.assign(self.item_squared_norms,
+                         tf.expand_dims(tf.reduce_sum(tf.square(self.item_embeddings), 1), 0))
+
     @define_scope
     def item_scores(self):
-        # (N_USER_IDS, 1, K)
-        user = tf.expand_dims(tf.nn.embedding_lookup(self.user_embeddings, self.score_user_ids), 1)
-        # (1, N_ITEM, K)
-        item = tf.expand_dims(self.item_embeddings, 0)
+        # (N_USER_IDS, K)
+        user = tf.nn.embedding_lookup(self.user_embeddings, self.score_user_ids)
+        # ||u - v||^2 = ||u||^2 - 2 u.v + ||v||^2, so that the only (N_USER, N_ITEM) intermediate is a matmul
+        user_squared_norms = tf.expand_dims(tf.reduce_sum(tf.square(user), 1), 1)
+        distances = user_squared_norms - 2 * tf.matmul(user, self.item_embeddings, transpose_b=True) \
+            + self.item_squared_norms
         # score = minus distance (N_USER, N_ITEM)
-        return -tf.reduce_sum(tf.squared_difference(user, item), 2, name="scores")
+        return tf.negative(distances, name="scores")
 
 
 BATCH_SIZE = 50000
 N_NEGATIVE = 20
+# background workers generating the training batches
+N_SAMPLER_WORKERS = 4
 EVALUATION_EVERY_N_BATCHES = 100
 EMBED_DIM = 50
+EARLY_STOPPING_PATIENCE = 10
+CHECKPOINT_EVERY_N_EVALUATIONS = 10
+# bytes that scoring a chunk of validation users may use
+EVALUATION_MEMORY_BUDGET = 2 ** 30
+# the validation metrics of optimize, in print order, any of them can be the early_stopping_metric
+VALIDATION_METRICS = ("Recall", "Precision", "AUC", "NDCG")
 
 
-def optimize(model, sampler, train, valid):
+def scoring_chunk_size(n_items, memory_budget=EVALUATION_MEMORY_BUDGET, bytes_per_score=24):
     """
-    Optimize the model. TODO: implement early-stopping
-    :param model: model to optimize
-    :param sampler: mini-batch sampler
-    :param train: train user-item matrix
-    :param valid: validation user-item matrix
-    :return: None
+    The number of users whose scores fit in memory_budget
+    :param n_items: number of items i.e. |V|
+    :param memory_budget: bytes available for one chunk
+    :param bytes_per_score: bytes held per (user, item) score: the fetched float32 scores, and the float64
+           masked copy with the int64 argpartition (or the float64 sorted copy) of RecallEvaluator.eval_batch
+    :return: chunk size, at least 1
     """
-    sess = tf.Session()
-    sess.run(tf.global_variables_initializer())
-    if model.feature_projection is not None:
-        # initialize item embedding with feature projection
-        sess.run(tf.assign(model.item_embeddings, model.feature_projection))
-    while True:
-        # create evaluator on validation set
-        validation_recall = RecallEvaluator(train, valid)
-        # compute recall on validate set
-        valid_recalls = []
-        # sample some users to calculate recall validation
-        valid_users = list(set(valid.nonzero()[0]))[:]
-        for user_chunk in toolz.partition_all(len(valid_users), valid_users):
-            scores = sess.run(model.item_scores, {model.score_user_ids: user_chunk})
-            valid_recalls.extend([validation_recall.cal_Recall(user, user_scores)
-                                  for user, user_scores in zip(user_chunk, scores)]
-                                 )
-        print("\nRecall on (sampled) validation set: {}".format(numpy.mean(valid_recalls)))
-        # TODO: early stopping based on validation recall
-
-        # compute precision
-        valid_precisions = []
-        # sample some users to calculate precision validation
-        valid_users = list(set(valid.nonzero()[0]))[:]
-        for user_chunk in toolz.partition_all(len(valid_users), valid_users):
-            scores = sess.run(model.item_scores, {model.score_user_ids: user_chunk})
-            valid_precisions.extend([validation_recall.cal_precision(user, user_scores)
-                                     for user, user_scores in zip(user_chunk, scores)]
-                                    )
-        print("\nPrecision on (sampled) validation set: {}".format(numpy.mean(valid_precisions)))
-
-        # compute AUC
-        vaild_AUCs = []
-        # sample some users to calculate precision validation
-        valid_users = list(set(valid.nonzero()[0]))[:]
-        for user_chunk in toolz.partition_all(len(valid_users), valid_users):
-            scores = sess.run(model.item_scores, {model.score_user_ids: user_chunk})
-            vaild_AUCs.extend([validation_recall.cal_AUC(user, user_scores)
-                                     for user, user_scores in zip(user_chunk, scores)]
-                                    )
-        print("\nAUC on (sampled) validation set: {}".format(numpy.mean(vaild_AUCs)))
-
-        #Compute NDCG
-        valid_NDCGs = []
-        valid_users = list(set(valid.nonzero()[0]))[:]
-        for user_chunk in toolz.partition_all(len(valid_users), valid_users):
-            scores = sess.run(model.item_scores, {model.score_user_ids: user_chunk})
-            valid_NDCGs.extend([validation_recall.cal_NDCG_at_k(user, user_scores, len(valid_users))
-                                     for user, user_scores in zip(user_chunk, scores)]
-                                    )
-
-        print("\nNDCG on (sampled) validation set: {}".format(numpy.mean(valid_NDCGs)))
-        # train model
-        losses = []
-        # run n mini-batches
-        for _ in tqdm(range(EVALUATION_EVERY_N_BATCHES), desc="Optimizing..."):
-            user_pos, neg = sampler.next_batch()
-            _, loss = sess.run((model.optimize, model.loss),
-                               {model.user_positive_items_pairs: user_pos,
-                                model.negative_samples: neg})
-            losses.append(loss)
-        print("\nTraining loss {}".format(numpy.mean(losses)))
+    return max(1, int(memory_budget // (n_items * bytes_per_score)))
 
 
-if __name__ == '__main__':
-    # get user-item matrix
-    user_item_matrix, features = citeulike(tag_occurence_thres=5)
-    n_users, n_items = user_item_matrix.shape
-    # make feature as dense matrix
-    dense_features = features.toarray() + 1E-10
-    # get train/valid/test user-item matrices
-    train, valid, test = split_data(user_item_matrix)
-    # create warp sampler
-    sampler = WarpSampler(train, batch_size=BATCH_SIZE, n_negative=N_NEGATIVE)
-
-    # WITHOUT features
-    # Train a user-item joint embedding, where the items a user likes will be pulled closer to this users.
-    # Once the embedding is trained, the recommendations are made by finding the k-Nearest-Neighbor to each user.
-    model = CML(n_users,
-                n_items,
-                # set features to None to disable feature projection
-                features=None,
-                # size of embedding
-                embed_dim=EMBED_DIM,
-                # the size of hinge loss margin.
-                margin=1.0,
-                # clip the embedding so that their norm <= clip_norm
-                clip_norm=1.1,
-                # learning rate for AdaGrad
-                master_learning_rate=0.9,
-                )
-
-    optimize(model, sampler, train, valid)
-
-    # WITH features
-    # In this case, we additionally train a feature projector to project raw item features into the
-    # embedding. The projection serves as "a prior" to inform the item's potential location in the embedding.
-    # We use a two fully-connected layers NN as our feature projector. (This model is much more computation intensive.
-    # A GPU machine is recommended)
-    model = CML(n_users,
-                n_items,
-                # enable feature projection
-                features=dense_features,
-                embed_dim=EMBED_DIM,
-                margin=1.0,
-                clip_norm=1.5,
-                master_learning_rate=0.9,
-                # the size of the hidden layer in the feature projector NN
-                hidden_layer_dim=256,
-                # dropout rate between hidden layer and output layer in the feature projector NN
-                dropout_rate=0.5,
-                # scale the output of the NN so that the magnitude of the NN output is closer to the item embedding
-                feature_projection_scaling_factor=1,
-                # the penalty to the distance between projection and item's actual location in the embedding
-                # tune this to adjust how much the embedding should be biased towards the item features.
-                feature_l2_reg=5,
-                )
-    optimize(model, sampler, train, valid)
-
-
-
-PATH = '/home/xiepanlong/CTRExperiment/Collaborative-metric-learning/Test.txt'
-
-def doublewrap(function):
+def batch_metrics(evaluator, k=50, method=0):
     """
-    A decorator decorator, allowing to use the decorator to be used without
-    parentheses if not arguments are provided. All arguments must be optional.
-    """
-
-    @functools.wraps(function)
-    def decorator(*args, **kwargs):
-        if len(args) == 1 and len(kwargs) == 0 and callable(args[0]):
-            return function(args[0])
-        else:
-            return lambda wrapee: function(wrapee, *args, **kwargs)
-
-    return decorator
-
-
-@doublewrap
-def define_scope(function, scope=None, *args, **kwargs):
-    """
-    A decorator for functions that define TensorFlow operations. The wrapped
-    function will only be executed once. Subsequent calls to it will directly
-    return the result so that operations are added to the graph only once.
-    The operations added by the function live within a tf.variable_scope(). If
-    this decorator is used with arguments, they will be forwarded to the
-    variable scope. The scope name defaults to the name of the wrapped
-    function.
+    The validation metrics of a block of users from a single RecallEvaluator.eval_batch call
+    :param evaluator: the RecallEvaluator of the validation set
+    :param k: the cut-off of Recall, Precision and NDCG
+    :param method: the dcg_at_k discount used by NDCG
+    :return: function(user_ids, scores) -> a dict of the per-user values keyed by VALIDATION_METRICS names
     """
-    attribute = '_cache_' + function.__name__
-    name = scope or function.__name__
+    def block_metrics(user_ids, scores):
+        values = evaluator.eval_batch(user_ids, scores, k, method)
+        return {"Recall": values["recall"], "Precision": values["precision"], "AUC": values["auc"],
+                "NDCG": values["ndcg"]}
 
-    @property
-    @functools.wraps(function)
-    def decorator(self):
-        if not hasattr(self, attribute):
-            with tf.variable_scope(name, *args, **kwargs):
-                setattr(self, attribute, function(self))
-        return getattr(self, attribute)
+    return block_metrics
 
-    return decorator
 
-def save_INFO(path, context, explain):
+def evaluate(sess, model, user_ids, metrics, chunk_size=None, memory_budget=EVALUATION_MEMORY_BUDGET):
     """
-    :param path: 
-    :return: 
+    Score every chunk of users once and compute all the metrics on the same scores
+    :param sess: the session holding the model variables
+    :param model: the model whose item_scores are evaluated
+    :param user_ids: the users to evaluate
+    :param metrics: function(user_ids, scores) -> a dict of per-user values keyed by metric name, e.g. batch_metrics
+    :param chunk_size: the number of users scored at once (default: as many as fit in memory_budget)
+    :param memory_budget: bytes available to score one chunk, see scoring_chunk_size
+    :return: a dict mapping every metric name to its mean over the users
     """
-    file = open(path, 'a')
-    file.write(explain + '\n')
-    for i in context:
-        file.write(str(i) + ',')
-    file.write('\n')
-    file.close()
-
-def dcg_at_k(y_score, k=5, method=0):
-    y_score = numpy.asfarray(y_score)[:k]
-    if y_score.size:
-        if method == 0:
-            return y_score[0] + numpy.sum(y_score[1:] / numpy.log2(numpy.arange(2, y_score.size + 1)))
-        elif method == 1:
-            return numpy.sum(y_score / numpy.log2(numpy.arange(2, y_score.size + 2)))
-        else:
-            raise ValueError('method must be 0 or 1.')
-    return 0
-
-class RecallEvaluator(object):
-    def __init__(self, train_user_item_matrix, test_user_item_matrix):
-        self.train_user_item_matrix = lil_matrix(train_user_item_matrix)
-        self.test_user_item_matrix = lil_matrix(test_user_item_matrix)
-        n_users = train_user_item_matrix.shape[0]
-        self.user_to_test_set = {u: set(self.test_user_item_matrix[u, :].nonzero()[1])
-                                 for u in range(n_users) if self.test_user_item_matrix[u, :].sum()}
-
-        if self.train_user_item_matrix is not None:
-            self.user_to_train_set = {u: set(self.train_user_item_matrix[u, :].nonzero()[1])
-                                      for u in range(n_users) if self.train_user_item_matrix[u, :].sum()}
-
-    def cal_AUC(self, user_id, item_scores):
-        """
-        Compute AUC
-        :param user_id: 
-        :param item_scores: 
-        :return: 
-        """
-        train_set = self.user_to_train_set[user_id]
-        test_set = self.user_to_test_set[user_id]
-
-        amin, amax = item_scores.min(), item_scores.max()
-        item_scores = (item_scores - amin) / (amax - amin)
-        idea_score = numpy.zeros(item_scores.shape[0])
-
-        for i in test_set:
-            idea_score[i] = 1
-        for i in train_set:
-            numpy.delete(item_scores, i, axis=0)
-            numpy.delete(idea_score, i, axis=0)
-        idea_max = idea_score.max()
-        if idea_max < 1:
-            return 11111.1
-
-        return roc_auc_score(idea_score, item_scores)
-
-
-    def cal_precision(self, user_id, item_scores, k=50):
-        """
-        Compute the precision for a particular user given the predicted scores to items
-        :param user_id:  the user id 
-        :param item_scores: an array contains the predicted score to every item
-        :return: precision@K
-        """
-
-        train_set = self.user_to_train_set[user_id]
-        test_set = self.user_to_test_set[user_id]
-
-        top_items = numpy.argpartition(-item_scores, k + len(train_set))[:k + len(train_set)]
-        top_n_items = 0
-        hits = 0
-        for i in top_items:
-            if i in train_set:
-                continue
-            if i in test_set:
-                hits += 1
-            top_n_items += 1
-            if top_n_items == k:
-                break
-        return hits / float(k)
-
-    def cal_Recall(self, user_id, item_scores, k=50):
-        """
-        Compute the Top-K recall for a particular user given the predicted scores to items
-        :param user_id: the user id
-        :param item_scores: an array contains the predicted score to every item
-        :param k: compute the recall for the top K items
-        :return: recall@K
-        """
-        train_set = self.user_to_train_set[user_id]
-        test_set = self.user_to_test_set[user_id]
-
-        top_items = numpy.argpartition(-item_scores, k + len(train_set))[:k + len(train_set)]
-        top_n_items = 0
-        hits = 0
-        for i in top_items:
-            if i in train_set:
-                continue
-            if i in test_set:
-                hits += 1
-            top_n_items += 1
-            if top_n_items == k:
-                break
-        return hits / float(len(test_set))
-
-     def cal_NDCG_at_k(self, user_id, item_scores, k=5, method=0):
-        train_set = self.user_to_train_set[user_id]
-        test_set = self.user_to_test_set[user_id]
+    chunk_size = chunk_size or scoring_chunk_size(model.n_items, memory_budget)
+    sess.run(model.refresh_item_squared_norms)
+    values = {}
+    for user_chunk in toolz.partition_all(chunk_size, user_ids):
+        scores = sess.run(model.item_scores, {model.score_user_ids: user_chunk})
+        for name, chunk_values in metrics(user_chunk, scores).items():
+            values.setdefault(name, []).append(chunk_values)
+    return {name: numpy.mean(numpy.concatenate(chunks)) for name, chunks in values.items()}
 
-        amin, amax = item_scores.min(), item_scores.max()
-        y_score = (item_scores - amin) / (amax - amin)
-
-        dcg_max = dcg_at_k(sorted(y_score, reverse=True), k, method)
-        if not dcg_max:
-            return 0.
-        return dcg_at_k(y_score, k, method) / dcg_max
 
-class WarpSampler(object):
+def telemetry_embeddings(sess, model, telemetry):
     """
-    A generator that generate tuples: user-positive-item pairs, negative-items
-
-    of shapes (Batch Size, 2) and (Batch Size, N_Negative)
+    :return: the (user, item) embeddings for the norm histograms, (None, None) when telemetry writes no records
     """
+    if telemetry.sink is None:
+        return None, None
+    return sess.run([model.user_embeddings, model.item_embeddings])
 
-    def __init__(self, user_item_matrix, batch_size=10000, n_negative=10):
-        self.user_item_matrix = dok_matrix(user_item_matrix)
-        self.user_item_pairs = numpy.asarray(self.user_item_matrix.nonzero()).T
-        self.batch_size = batch_size
-        self.n_negative = n_negative
-
-    @property
-    def sample(self):
-        while True:
-            numpy.random.shuffle(self.user_item_pairs)
-            for i in range(int(len(self.user_item_pairs) / self.batch_size)):
-                user_positive_items_pairs = self.user_item_pairs[i * self.batch_size: (i + 1) * self.batch_size, :]
-
-                negative_samples = numpy.random.randint(0,
-                                                        self.user_item_matrix.shape[1],
-                                                        size=(self.batch_size, self.n_negative))
-
-                yield user_positive_items_pairs, negative_samples
-
-    def next_batch(self):
-        return self.sample.__next__()
-
-
-class CML(object):
-    def __init__(self,
-                 n_users,
-                 n_items,
-                 embed_dim=20,
-                 features=None,
-                 margin=0.1,
-                 master_learning_rate=0.1,
-                 clip_norm=1.0,
-                 hidden_layer_dim=128,
-                 dropout_rate=0.2,
-                 feature_l2_reg=0.1,
-                 feature_projection_scaling_factor=0.5
-                 ):
-        """
-
-        :param n_users: number of users i.e. |U|
-        :param n_items: number of items i.e. |V|
-        :param
-        :param embed_dim: embedding size i.e. K (default 20)
-        :param features: (optional) the feature vectors of items, shape: (|V|, N_Features).
-               Set it to None will disable feature loss(default: None)
-        :param margin: hinge loss threshold i.e. z
-        :param master_learning_rate: master learning rate for AdaGrad
-        :param clip_norm: clip norm threshold (default 1.0)
-        :param hidden_layer_dim: the size of feature projector's hidden layer (default: 128)
-        :param dropout_rate: the dropout rate between the hidden layer to final feature projection layer
-        :param feature_l2_reg: feature loss weight
-        :param feature_projection_scaling_factor: scale the feature projection before compute l2 loss. Ideally,
-               the scaled feature projection should be mostly within the clip_norm
-        """
 
-        self.n_users = n_users
-        self.n_items = n_items
-        self.embed_dim = embed_dim
-
-        self.clip_norm = clip_norm
-        self.margin = margin
-        if features is not None:
-            self.features = tf.constant(features, dtype=tf.float32)
-        else:
-            self.features = None
-
-        self.master_learning_rate = master_learning_rate
-        self.hidden_layer_dim = hidden_layer_dim
-        self.dropout_rate = dropout_rate
-        self.feature_l2_reg = feature_l2_reg
-        self.feature_projection_scaling_factor = feature_projection_scaling_factor
-
-        self.user_positive_items_pairs = tf.placeholder(tf.int32, [None, 2])
-        self.negative_samples = tf.placeholder(tf.int32, [None, None])
-        self.score_user_ids = tf.placeholder(tf.int32, [None])
-        self.user_embeddings
-        self.item_embeddings
-        self.embedding_loss
-        self.feature_loss
-        self.loss
-        self.optimize
-
-    @define_scope
-    def user_embeddings(self):
-        return tf.Variable(tf.random_normal([self.n_users, self.embed_dim],
-                                            stddev=1 / (self.embed_dim ** 0.5), dtype=tf.float32))
-
-    @define_scope
-    def item_embeddings(self):
-        return tf.Variable(tf.random_normal([self.n_items, self.embed_dim],
-                                            stddev=1 / (self.embed_dim ** 0.5), dtype=tf.float32))
-
-    @define_scope
-    def mlp_layer_1(self):
-        return tf.layers.dense(inputs=self.features,
-                               units=self.hidden_layer_dim,
-                               activation=tf.nn.relu, name="mlp_layer_1")
-
-    @define_scope
-    def mlp_layer_2(self):
-        dropout = tf.layers.dropout(inputs=self.mlp_layer_1, rate=self.dropout_rate)
-        return tf.layers.dense(inputs=dropout, units=self.embed_dim, name="mlp_layer_2")
-
-    @define_scope
-    def feature_projection(self):
-        """
-        :return: the projection of the feature vectors to the user-item embedding
-        """
-
-        # feature loss
-        if self.features is not None:
-            # fully-connected layer
-            output = self.mlp_layer_2 * self.feature_projection_scaling_factor
-
-            # projection to the embedding
-            return tf.clip_by_norm(output, self.clip_norm, axes=[1], name="feature_projection")
-
-    @define_scope
-    def feature_loss(self):
-        """
-        :return: the l2 loss of the distance between items' their embedding and their feature projection
-        """
-        if self.feature_projection is not None:
-
-            # the distance between feature projection and the item's actual location in the embedding
-            feature_distance = tf.reduce_mean(tf.squared_difference(
-                self.item_embeddings,
-                self.feature_projection), 1)
-
-            # apply regularization weight
-            return tf.reduce_sum(feature_distance, name="feature_loss") * self.feature_l2_reg
-        else:
-            return tf.constant(0, dtype=tf.float32)
-
-    @define_scope
-    def embedding_loss(self):
-        """
-        :return: the distance metric loss
-        """
-        # Let
-        # N = batch size,
-        # K = embedding size,
-        # W = number of negative samples per a user-positive-item pair
-
-        # user embedding (N, K)
-        users = tf.nn.embedding_lookup(self.user_embeddings,
-                                       self.user_positive_items_pairs[:, 0],
-                                       name="users")
-
-        # positive item embedding (N, K)
-        pos_items = tf.nn.embedding_lookup(self.item_embeddings, self.user_positive_items_pairs[:, 1],
-                                           name="pos_items")
-        # positive item to user distance (N)
-        pos_distances = tf.reduce_mean(tf.squared_difference(users, pos_items), 1, name="pos_distances")
-
-        # negative item embedding (N, K, W)
-        neg_items = tf.transpose(tf.nn.embedding_lookup(self.item_embeddings, self.negative_samples),
-                                 (0, 2, 1), name="neg_items")
-        # distance to negative items (N x W)
-        distance_to_neg_items = tf.reduce_mean(tf.squared_difference(tf.expand_dims(users, -1), neg_items), 1,
-                                               name="distance_to_neg_items")
-
-        # number of impostors for each user-positive-item pair
-        impostors = (tf.expand_dims(pos_distances, -1) - distance_to_neg_items + self.margin) > 0
-
-        # best negative item (among W negative samples) their distance to the user embedding (N)
-        closest_negative_distances = tf.reduce_min(distance_to_neg_items, 1, name="closest_negative_distances")
-
-        # compute hinge loss (N)
-        loss_per_pair = tf.maximum(pos_distances - closest_negative_distances + self.margin, 0,
-                                   name="pair_loss")
-        weighted_loss_per_pair = loss_per_pair
-
-        # the embedding loss
-        loss = tf.reduce_sum(weighted_loss_per_pair, name="loss")
-
-        return loss
-
-    @define_scope
-    def loss(self):
-        """
-        :return: the total loss = embedding loss + feature loss
-        """
-        return self.embedding_loss + self.feature_loss
-
-    @define_scope
-    def clip_by_norm_op(self):
-        return [tf.assign(self.user_embeddings, tf.clip_by_norm(self.user_embeddings, self.clip_norm, axes=[1])),
-                tf.assign(self.item_embeddings, tf.clip_by_norm(self.item_embeddings, self.clip_norm, axes=[1]))]
-
-    @define_scope
-    def optimize(self):
-        # have two separate learning rates. The first one for user/item embedding is un-normalized.
-        # The second one for feature projector NN is normalized by the number of items.
-        gds = []
-        gds.append(tf.train
-                   .AdagradOptimizer(self.master_learning_rate)
-                   .minimize(self.loss, var_list=[self.user_embeddings, self.item_embeddings]))
-        if self.feature_projection:
-            gds.append(tf.train
-                       .AdagradOptimizer(self.master_learning_rate)
-                       .minimize(self.feature_loss / self.n_items))
-
-        with tf.control_dependencies(gds):
-            return gds + [self.clip_by_norm_op]
-
-    @define_scope
-    def item_scores(self):
-        # (N_USER_IDS, 1, K)
-        user = tf.expand_dims(tf.nn.embedding_lookup(self.user_embeddings, self.score_user_ids), 1)
-        # (1, N_ITEM, K)
-        item = tf.expand_dims(self.item_embeddings, 0)
-        # score = minus distance (N_USER, N_ITEM)
-        return -tf.reduce_sum(tf.squared_difference(user, item), 2, name="scores")
-
-
-BATCH_SIZE = 50000
-N_NEGATIVE = 20
-EVALUATION_EVERY_N_BATCHES = 100
-EMBED_DIM = 50
-
-
-def optimize(model, sampler, train, valid):
+def optimize(model, sampler, train, valid, early_stopping_metric="Recall", patience=EARLY_STOPPING_PATIENCE,
+             max_steps=None, max_seconds=None, checkpoint_dir=None,
+             checkpoint_every=CHECKPOINT_EVERY_N_EVALUATIONS, restore_best=True,
+             telemetry=None, metrics_path=None, evaluation_memory_budget=EVALUATION_MEMORY_BUDGET):
     """
-    Optimize the model. TODO: implement early-stopping
+    Optimize the model until early_stopping_metric has not improved on the validation set for `patience`
+    evaluations, or until the step or time budget is spent
     :param model: model to optimize
     :param sampler: mini-batch sampler
     :param train: train user-item matrix
     :param valid: validation user-item matrix
-    :return: None
+    :param early_stopping_metric: the validation metric to monitor: Recall, Precision, AUC or NDCG
+    :param patience: number of evaluations without improvement before stopping
+    :param max_steps: (optional) maximum number of mini-batches
+    :param max_seconds: (optional) maximum training wall-clock time
+    :param checkpoint_dir: (optional) directory for the embedding checkpoints, the best ones go to its best/
+    :param checkpoint_every: save the embeddings every n evaluations (needs checkpoint_dir)
+    :param restore_best: load the embeddings of the best evaluation before returning
+    :param telemetry: (optional) a telemetry.Telemetry recording every training step and evaluation
+    :param metrics_path: (optional) a text log of the evaluations, their metrics are also saved column by column
+           next to it (see utils.load_metrics)
+    :param evaluation_memory_budget: bytes available to score one chunk of validation users, see scoring_chunk_size
+    :return: (sess, best_record) the session holding the embeddings and the validation metrics of the best
+             evaluation
     """
+    telemetry = telemetry or Telemetry()
+    metrics_log = metrics_writer(metrics_path, columnar="npy") if metrics_path is not None else None
     sess = tf.Session()
     sess.run(tf.global_variables_initializer())
-    if model.feature_projection is not None:
-        # initialize item embedding with feature projection
-        sess.run(tf.assign(model.item_embeddings, model.feature_projection))
+    if model.features is not None:
+        # initialize item embedding with feature projection, BATCH_SIZE items at a time
+        for start in range(0, model.n_items, BATCH_SIZE):
+            sess.run(model.init_item_embeddings,
+                     {model.projected_item_ids: numpy.arange(start, min(start + BATCH_SIZE, model.n_items))})
+    # start from clipped embeddings, afterwards the sparse updates only need to clip the rows they move
+    for embeddings in (model.user_embeddings, model.item_embeddings):
+        sess.run(tf.assign(embeddings, tf.clip_by_norm(embeddings, model.clip_norm, axes=[1])))
+    # create evaluator on validation set
+    validation_recall = RecallEvaluator(train, valid)
+    # users to calculate the validation metrics on
+    valid_users = validation_recall.test_users
+    valid_metrics = batch_metrics(validation_recall)
+    early_stopping = EarlyStopping(patience)
+    budget = TrainingBudget(max_steps, max_seconds)
+    checkpointer = EmbeddingCheckpointer(model, checkpoint_dir)
+    best_record = None
+    step = 0
+    n_evaluations = 0
     while True:
-        # create evaluator on validation set
-        validation_recall = RecallEvaluator(train, valid)
-        # compute recall on validate set
-        valid_recalls = []
-        # sample some users to calculate recall validation
-        valid_users = list(set(valid.nonzero()[0]))[:300]
-        for user_chunk in toolz.partition_all(300, valid_users):
-            scores = sess.run(model.item_scores, {model.score_user_ids: user_chunk})
-            valid_recalls.extend([validation_recall.cal_Recall(user, user_scores)
-                                  for user, user_scores in zip(user_chunk, scores)]
-                                 )
-        print("\nRecall on (sampled) validation set: {}".format(numpy.mean(valid_recalls)))
-        # TODO: early stopping based on validation recall
-
-        # compute precision
-        valid_precisions = []
-        # sample some users to calculate precision validation
-        valid_users = list(set(valid.nonzero()[0]))[:300]
-        for user_chunk in toolz.partition_all(300, valid_users):
-            scores = sess.run(model.item_scores, {model.score_user_ids: user_chunk})
-            valid_precisions.extend([validation_recall.cal_precision(user, user_scores)
-                                     for user, user_scores in zip(user_chunk, scores)]
-                                    )
-        print("\nPrecision on (sampled) validation set: {}".format(numpy.mean(valid_precisions)))
-
-        # compute AUC
-        vaild_AUCs = []
-        # sample some users to calculate precision validation
-        valid_users = list(set(valid.nonzero()[0]))[:300]
-        for user_chunk in toolz.partition_all(300, valid_users):
-            scores = sess.run(model.item_scores, {model.score_user_ids: user_chunk})
-            vaild_AUCs.extend([validation_recall.cal_AUC(user, user_scores)
-                                     for user, user_scores in zip(user_chunk, scores)]
-                                    )
-        print("\nAUC on (sampled) validation set: {}".format(numpy.mean(vaild_AUCs)))
-
-        #Compute NDCG
-        valid_NDCGs = []
-        valid_users = list(set(valid.nonzero()[0]))[:]
-        for user_chunk in toolz.partition_all(len(valid_users), valid_users):
-            scores = sess.run(model.item_scores, {model.score_user_ids: user_chunk})
-            valid_NDCGs.extend([validation_recall.cal_NDCG_at_k(user, user_scores, len(valid_users))
-                                     for user, user_scores in zip(user_chunk, scores)]
-                                    )
-
-        print("\nNDCG on (sampled) validation set: {}".format(numpy.mean(valid_NDCGs)))
+        # score the validation users once and compute every metric on the same scores
+        eval_start = time.time()
+        record = evaluate(sess, model, valid_users, valid_metrics, memory_budget=evaluation_memory_budget)
+        telemetry.evaluation(step, record, time.time() - eval_start, *telemetry_embeddings(sess, model, telemetry),
+                             max_norm=model.clip_norm)
+        for name in VALIDATION_METRICS:
+            print("\n{} on the validation set: {}".format(name, record[name]))
+        if metrics_log is not None:
+            values = dict(record, step=step)
+            metrics_log.record(values, "Step {} - ".format(step) + ", ".join(
+                "{}: {:.5f}".format(name, record[name]) for name in VALIDATION_METRICS))
+        n_evaluations += 1
+        if early_stopping.update(record[early_stopping_metric], step):
+            best_record = record
+            checkpointer.save_best(sess, step)
+        if checkpoint_every and n_evaluations % checkpoint_every == 0:
+            checkpointer.save(sess, step)
+        if early_stopping.should_stop or budget.exhausted(step):
+            break
 
         # train model
         losses = []
         # run n mini-batches
         for _ in tqdm(range(EVALUATION_EVERY_N_BATCHES), desc="Optimizing..."):
-            user_pos, neg = sampler.next_batch()
-            _, loss = sess.run((model.optimize, model.loss),
-                               {model.user_positive_items_pairs: user_pos,
-                                model.negative_samples: neg})
+            telemetry.start_step(step)
+            with telemetry.timed("sample"):
+                user_pos, neg = sampler.next_batch()
+            with telemetry.timed("feed"):
+                feed_dict = {model.user_positive_items_pairs: user_pos,
+                             model.negative_samples: neg}
+            _, loss, impostor_fraction = telemetry.run(
+                sess, (model.optimize, model.loss, model.impostor_fraction), feed_dict, step)
             losses.append(loss)
+            telemetry.end_step(step, len(user_pos), loss, impostor_fraction)
+            step += 1
+            if budget.exhausted(step):
+                break
         print("\nTraining loss {}".format(numpy.mean(losses)))
+        if metrics_log is not None:
+            metrics_log.record({"step": step, "loss": numpy.mean(losses)})
+        if sampler.n_workers:
+            print("Sampler queue: {}".format(sampler.stats()))
+
+    print("\nStopped after {} steps, best validation {} {} at step {}".format(
+        step, early_stopping_metric, early_stopping.best, early_stopping.best_step))
+    if metrics_log is not None:
+        metrics_log.flush()
+    if restore_best:
+        checkpointer.restore_best(sess)
+    return sess, best_record
 
 
 if __name__ == '__main__':
     # get user-item matrix
     user_item_matrix, features = citeulike(tag_occurence_thres=5)
     n_users, n_items = user_item_matrix.shape
-    # make feature as dense matrix
-    dense_features = features.toarray() + 1E-10
     # get train/valid/test user-item matrices
     train, valid, test = split_data(user_item_matrix)
     # create warp sampler
-    sampler = WarpSampler(train, batch_size=BATCH_SIZE, n_negative=N_NEGATIVE)
+    sampler = WarpSampler(train, batch_size=BATCH_SIZE, n_negative=N_NEGATIVE, n_workers=N_SAMPLER_WORKERS, seed=1)
 
     # WITHOUT features
     # Train a user-item joint embedding, where the items a user likes will be pulled closer to this users.
@@ -1048,12 +708,12 @@ if __name__ == '__main__':
     # WITH features
     # In this case, we additionally train a feature projector to project raw item features into the
     # embedding. The projection serves as "a prior" to inform the item's potential location in the embedding.
-    # We use a two fully-connected layers NN as our feature projector. (This model is much more computation intensive.
-    # A GPU machine is recommended)
+    # We use a two fully-connected layers NN as our feature projector. The features stay sparse and only the items
+    # of each batch are projected, so that this model also trains on CPU.
     model = CML(n_users,
                 n_items,
                 # enable feature projection
-                features=dense_features,
+                features=features,
                 embed_dim=EMBED_DIM,
                 margin=1.0,
                 clip_norm=1.5,
@@ -1069,3 +729,4 @@ if __name__ == '__main__':
                 feature_l2_reg=5,
                 )
     optimize(model, sampler, train, valid)
+    sampler.close()
@@ -0,0 +1,253 @@
+"""
+CML without TensorFlow: the embedding loss of CML.CML with explicit gradients, row-sparse Adagrad and norm
+clipping in NumPy, trained on the same WarpSampler batches
+"""
+import numpy
+from tqdm import tqdm
+
+from sampler import WarpSampler
+from topk import exact_top_k
+from training import EarlyStopping, TrainingBudget
+from utils import citeulike, isin_sorted, item_index, row_items, split_data
+
+# tf.train.AdagradOptimizer's initial_accumulator_value
+INITIAL_ACCUMULATOR_VALUE = 0.1
+# number of user-positive-item pairs whose (pairs, negatives, embed_dim) negative embeddings are gathered at once
+PAIRS_CHUNK_SIZE = 4096
+
+
+def sum_duplicate_rows(ids, rows):
+    """
+    :return: (unique_ids, summed_rows) the rows of every distinct id summed, as the sparse gradients of TF
+    """
+    if len(ids) == 0:
+        return ids, rows
+    order = numpy.argsort(ids, kind="mergesort")
+    sorted_ids = ids[order]
+    starts = numpy.flatnonzero(numpy.concatenate(([True], sorted_ids[1:] != sorted_ids[:-1])))
+    return sorted_ids[starts], numpy.add.reduceat(rows[order], starts, axis=0)
+
+
+def clip_rows(embeddings, ids, clip_norm):
+    """
+    Clip the norm of embeddings[ids] to clip_norm in place, as tf.clip_by_norm(..., axes=[1])
+    """
+    rows = embeddings[ids]
+    norms = numpy.sqrt(numpy.square(rows).sum(1))
+    too_long = norms > clip_norm
+    embeddings[ids[too_long]] = rows[too_long] * (clip_norm / norms[too_long])[:, None]
+
+
+class CML(object):
+    """
+    The NumPy counterpart of CML.CML. Instead of a graph and a session:
+        model.partial_fit(user_positive_items_pairs, negative_samples) runs one Adagrad step and returns the loss
+        model.item_scores(user_ids) returns the (len(user_ids), |V|) scores
+    user_embeddings and item_embeddings are plain float32 arrays.
+    """
+
+    def __init__(self,
+                 n_users,
+                 n_items,
+                 embed_dim=20,
+                 features=None,
+                 margin=0.1,
+                 master_learning_rate=0.5,
+                 clip_norm=1.0,
+                 hidden_layer_dim=128,
+                 dropout_rate=0.5,
+                 feature_l2_reg=0.1,
+                 feature_projection_scaling_factor=0.5,
+                 sparse_updates=False,
+                 seed=None
+                 ):
+        """
+        Same arguments and defaults as CML.CML, without the feature projector: features must be None and
+        hidden_layer_dim, dropout_rate, feature_l2_reg and feature_projection_scaling_factor are unused.
+        :param sparse_updates: clip only the rows a step moved, False (default) clips the whole tables
+        :param seed: seed of the embedding initialization
+        """
+        if features is not None:
+            raise ValueError("the NumPy backend does not support features, use CML.CML for the feature projector")
+        self.n_users = n_users
+        self.n_items = n_items
+        self.embed_dim = embed_dim
+        self.features = None
+        self.margin = margin
+        self.master_learning_rate = master_learning_rate
+        self.clip_norm = clip_norm
+        self.hidden_layer_dim = hidden_layer_dim
+        self.dropout_rate = dropout_rate
+        self.feature_l2_reg = feature_l2_reg
+        self.feature_projection_scaling_factor = feature_projection_scaling_factor
+        self.sparse_updates = sparse_updates
+
+        random_state = numpy.random.RandomState(seed)
+        self.user_embeddings = random_state.normal(scale=1 / (embed_dim ** 0.5),
+                                                   size=(n_users, embed_dim)).astype(numpy.float32)
+        self.item_embeddings = random_state.normal(scale=1 / (embed_dim ** 0.5),
+                                                   size=(n_items, embed_dim)).astype(numpy.float32)
+        self.user_accumulator = numpy.full_like(self.user_embeddings, INITIAL_ACCUMULATOR_VALUE)
+        self.item_accumulator = numpy.full_like(self.item_embeddings, INITIAL_ACCUMULATOR_VALUE)
+        # start from clipped embeddings, afterwards the sparse updates only need to clip the rows they move
+        self.clip_by_norm()
+
+    def clip_by_norm(self):
+        clip_rows(self.user_embeddings, numpy.arange(self.n_users), self.clip_norm)
+        clip_rows(self.item_embeddings, numpy.arange(self.n_items), self.clip_norm)
+
+    def closest_negatives(self, users, negative_samples):
+        """
+        :return: (distances, items) the distance to and the id of the closest negative item of every pair
+        """
+        distances = numpy.empty(len(users), dtype=numpy.float32)
+        items = numpy.empty(len(users), dtype=negative_samples.dtype)
+        for start in range(0, len(users), PAIRS_CHUNK_SIZE):
+            chunk = slice(start, start + PAIRS_CHUNK_SIZE)
+            # (chunk, W, K)
+            neg_items = self.item_embeddings[negative_samples[chunk]]
+            distance_to_neg_items = numpy.square(users[chunk][:, None, :] - neg_items).mean(2)
+            closest = distance_to_neg_items.argmin(1)
+            rows = numpy.arange(len(closest))
+            distances[chunk] = distance_to_neg_items[rows, closest]
+            items[chunk] = negative_samples[chunk][rows, closest]
+        return distances, items
+
+    def embedding_loss(self, user_positive_items_pairs, negative_samples, gradients=False):
+        """
+        :return: the hinge loss of CML.CML.embedding_loss, with gradients=True (loss, user_ids, user_gradients,
+                 item_ids, item_gradients) where the ids may repeat
+        """
+        user_ids = user_positive_items_pairs[:, 0]
+        pos_ids = user_positive_items_pairs[:, 1]
+        users = self.user_embeddings[user_ids]
+        pos_items = self.item_embeddings[pos_ids]
+        pos_distances = numpy.square(users - pos_items).mean(1)
+        closest_negative_distances, neg_ids = self.closest_negatives(users, negative_samples)
+        loss_per_pair = pos_distances - closest_negative_distances + self.margin
+        active = loss_per_pair > 0
+        loss = float(loss_per_pair[active].sum())
+        if not gradients:
+            return loss
+
+        # d/du mean((u - p)^2) - mean((u - n)^2) = 2 / K (n - p), only the pairs with a positive hinge count
+        users, pos_items = users[active], pos_items[active]
+        neg_items = self.item_embeddings[neg_ids[active]]
+        scale = numpy.float32(2. / self.embed_dim)
+        user_gradients = scale * (neg_items - pos_items)
+        pos_gradients = scale * (pos_items - users)
+        neg_gradients = scale * (users - neg_items)
+        return (loss, user_ids[active], user_gradients,
+                numpy.concatenate((pos_ids[active], neg_ids[active])),
+                numpy.concatenate((pos_gradients, neg_gradients)))
+
+    def apply_adagrad(self, embeddings, accumulator, ids, gradients):
+        """
+        Adagrad on the rows ids only, as tf.train.AdagradOptimizer on the IndexedSlices of embedding_lookup
+        :return: the distinct ids that were updated
+        """
+        ids, gradients = sum_duplicate_rows(ids, gradients)
+        accumulator[ids] += numpy.square(gradients)
+        embeddings[ids] -= self.master_learning_rate * gradients / numpy.sqrt(accumulator[ids])
+        return ids
+
+    def partial_fit(self, user_positive_items_pairs, negative_samples):
+        """
+        One optimization step on a WarpSampler batch
+        :return: the loss of the batch before the step
+        """
+        loss, user_ids, user_gradients, item_ids, item_gradients = self.embedding_loss(
+            numpy.asarray(user_positive_items_pairs), numpy.asarray(negative_samples), gradients=True)
+        user_ids = self.apply_adagrad(self.user_embeddings, self.user_accumulator, user_ids, user_gradients)
+        item_ids = self.apply_adagrad(self.item_embeddings, self.item_accumulator, item_ids, item_gradients)
+        if self.sparse_updates:
+            clip_rows(self.user_embeddings, user_ids, self.clip_norm)
+            clip_rows(self.item_embeddings, item_ids, self.clip_norm)
+        else:
+            self.clip_by_norm()
+        return loss
+
+    def item_scores(self, user_ids):
+        users = self.user_embeddings[user_ids]
+        distances = numpy.square(users).sum(1)[:, None] - 2 * users.dot(self.item_embeddings.T) \
+            + numpy.square(self.item_embeddings).sum(1)[None, :]
+        # score = minus distance (N_USER, N_ITEM)
+        return -distances
+
+
+BATCH_SIZE = 50000
+N_NEGATIVE = 20
+EVALUATION_EVERY_N_BATCHES = 100
+EMBED_DIM = 50
+EARLY_STOPPING_PATIENCE = 10
+
+
+def validation_recall(model, train, valid, user_ids, k=50):
+    """
+    :param train: the train user-item matrix as returned by utils.item_index
+    :param valid: the validation user-item matrix as returned by utils.item_index
+    :return: the mean recall@k of the users, train items excluded
+    """
+    top_items, _, _ = exact_top_k(model.user_embeddings, model.item_embeddings, k, user_ids=user_ids, exclude=train)
+    return numpy.mean([numpy.count_nonzero(isin_sorted(row_items(valid, user), top)) /
+                       float(len(row_items(valid, user))) for user, top in zip(user_ids, top_items)])
+
+
+def optimize(model, sampler, train, valid, patience=EARLY_STOPPING_PATIENCE, max_steps=None, max_seconds=None,
+             restore_best=True):
+    """
+    Optimize the model until the validation recall has not improved for `patience` evaluations, or until the
+    step or time budget is spent, as CML.optimize
+    :param restore_best: copy the embeddings of the best evaluation back into the model before returning
+    :return: (model, best_recall)
+    """
+    train, valid = item_index(train), item_index(valid)
+    # sample some users to calculate recall validation
+    valid_users = numpy.flatnonzero(numpy.diff(valid.indptr))[:300]
+    early_stopping = EarlyStopping(patience)
+    budget = TrainingBudget(max_steps, max_seconds)
+    best_embeddings = None
+    step = 0
+    while True:
+        recall = validation_recall(model, train, valid, valid_users)
+        print("\nRecall on (sampled) validation set: {}".format(recall))
+        if early_stopping.update(recall, step):
+            best_embeddings = model.user_embeddings.copy(), model.item_embeddings.copy()
+        if early_stopping.should_stop or budget.exhausted(step):
+            break
+
+        # train model
+        losses = []
+        # run n mini-batches
+        for _ in tqdm(range(EVALUATION_EVERY_N_BATCHES), desc="Optimizing..."):
+            user_pos, neg = sampler.next_batch()
+            losses.append(model.partial_fit(user_pos, neg))
+            step += 1
+            if budget.exhausted(step):
+                break
+        print("\nTraining loss {}".format(numpy.mean(losses)))
+
+    print("\nStopped after {} steps, best validation recall {} at step {}".format(
+        step, early_stopping.best, early_stopping.best_step))
+    if restore_best:
+        model.user_embeddings[:], model.item_embeddings[:] = best_embeddings
+    return model, early_stopping.best
+
+
+if __name__ == '__main__':
+    # get user-item matrix
+    user_item_matrix, _ = citeulike(tag_occurence_thres=5)
+    n_users, n_items = user_item_matrix.shape
+    # get train/valid/test user-item matrices
+    train, valid, test = split_data(user_item_matrix)
+    # create warp sampler
+    sampler = WarpSampler(train, batch_size=BATCH_SIZE, n_negative=N_NEGATIVE, seed=1)
+    model = CML(n_users,
+                n_items,
+                embed_dim=EMBED_DIM,
+                margin=1.0,
+                clip_norm=1.1,
+                master_learning_rate=0.5,
+                seed=1,
+                )
+    optimize(model, sampler, train, valid)
@@ -0,0 +1,340 @@
+import multiprocessing
+import queue
+import threading
+import time
+
+import numpy
+
+from utils import item_index
+
+
+def random_integers(random_state, high, size):
+    # numpy.random.Generator names it integers, RandomState and the numpy.random module randint
+    if hasattr(random_state, "integers"):
+        return random_state.integers(0, high, size=size)
+    return random_state.randint(0, high, size=size)
+
+
+def random_uniform(random_state, size):
+    if hasattr(random_state, "integers"):
+        return random_state.random(size)
+    return random_state.random_sample(size)
+
+
+def batches_per_epoch(n_pairs, batch_size, include_last_batch=False):
+    if include_last_batch:
+        return -(-n_pairs // batch_size)
+    return n_pairs // batch_size
+
+
+class AliasTable(object):
+    """
+    Walker's alias method: O(1) draws from a fixed discrete distribution after an O(N) set-up
+    """
+
+    def __init__(self, weights):
+        """
+        :param weights: non-negative weights of the outcomes 0..N-1
+        """
+        weights = numpy.asarray(weights, dtype=numpy.float64)
+        n = len(weights)
+        scaled = weights * n / weights.sum()
+        self.prob = numpy.ones(n)
+        self.alias = numpy.arange(n)
+        small = list(numpy.flatnonzero(scaled < 1.))
+        large = list(numpy.flatnonzero(scaled >= 1.))
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1. - scaled[s]
+            (small if scaled[l] < 1. else large).append(l)
+
+    def sample(self, random_state, size):
+        outcomes = random_integers(random_state, len(self.prob), size)
+        keep = random_uniform(random_state, size) < self.prob[outcomes]
+        return numpy.where(keep, outcomes, self.alias[outcomes])
+
+
+class NegativeSampler(object):
+    """
+    Draw negative items for the users of a batch, uniformly or by item popularity, optionally rejecting the
+    items the user has interacted with
+    """
+
+    def __init__(self, user_item_matrix, n_negative, exact=False, popularity_exponent=None, max_rounds=100):
+        """
+        :param user_item_matrix: the train user-item matrix as returned by utils.item_index
+        :param n_negative: number of negatives per user-positive-item pair
+        :param exact: redraw the negatives that are positives of their user
+        :param popularity_exponent: if set, draw item i with probability proportional to
+               (number of users of i) ** popularity_exponent, e.g. 0.75; uniformly otherwise
+        :param max_rounds: the rejection gives up after this many redraws, for users who like almost every item
+        """
+        self.n_items = user_item_matrix.shape[1]
+        self.n_negative = n_negative
+        self.max_rounds = max_rounds
+        self.alias_table = None
+        if popularity_exponent is not None:
+            popularity = numpy.bincount(user_item_matrix.indices, minlength=self.n_items)
+            self.alias_table = AliasTable(popularity.astype(numpy.float64) ** popularity_exponent)
+        self.uniform_buffer = None
+        self.positive_keys = None
+        if exact:
+            # CSR rows hold sorted items, so the keys user * |V| + item are sorted over the whole matrix
+            users = numpy.repeat(numpy.arange(user_item_matrix.shape[0], dtype=numpy.int64),
+                                 numpy.diff(user_item_matrix.indptr))
+            self.positive_keys = users * self.n_items + user_item_matrix.indices
+
+    def draw_items(self, random_state, size, out=None):
+        """
+        :param out: if set, the integer array to draw into. Uniform draws then allocate nothing, which
+               needs a numpy.random.Generator (it can fill a preallocated array of floats)
+        """
+        if self.alias_table is not None:
+            items = self.alias_table.sample(random_state, size)
+        elif out is None:
+            items = random_integers(random_state, self.n_items, size)
+        else:
+            if self.uniform_buffer is None or self.uniform_buffer.shape != out.shape:
+                self.uniform_buffer = numpy.empty(out.shape)
+            # floor(u * |V|) for u uniform in [0, 1), clipped against rounding up to |V|
+            random_state.random(out=self.uniform_buffer)
+            numpy.multiply(self.uniform_buffer, self.n_items, out=self.uniform_buffer)
+            numpy.copyto(out, self.uniform_buffer, casting="unsafe")
+            return numpy.minimum(out, self.n_items - 1, out=out)
+        if out is None:
+            return items
+        out[...] = items
+        return out
+
+    def is_positive(self, users, items):
+        keys = users.astype(numpy.int64) * self.n_items + items
+        positions = numpy.minimum(numpy.searchsorted(self.positive_keys, keys), len(self.positive_keys) - 1)
+        return self.positive_keys[positions] == keys
+
+    def sample(self, users, random_state, out=None):
+        """
+        :param users: the user of every pair of the batch
+        :param out: (optional) the (len(users), n_negative) array to fill, see draw_items
+        :return: (len(users), n_negative) negative items
+        """
+        negative_samples = self.draw_items(random_state, (len(users), self.n_negative), out)
+        if self.positive_keys is None or len(self.positive_keys) == 0:
+            return negative_samples
+        users = numpy.broadcast_to(users[:, None], negative_samples.shape)
+        rows, cols = numpy.nonzero(self.is_positive(users, negative_samples))
+        for _ in range(self.max_rounds):
+            if not len(rows):
+                break
+            # redraw the collisions only
+            negative_samples[rows, cols] = self.draw_items(random_state, len(rows))
+            collisions = self.is_positive(users[rows, cols], negative_samples[rows, cols])
+            rows, cols = rows[collisions], cols[collisions]
+        return negative_samples
+
+
+def sample_batches(user_item_pairs, batch_size, negative_sampler, random_state, include_last_batch=False,
+                   buffers=None):
+    """
+    Generate (user_positive_items_pairs, negative_samples) batches epoch after epoch. Every epoch visits each
+    pair once, in the order of a permutation of the pair indices.
+    :param user_item_pairs: (N_Pairs, 2) array of user-positive-item pairs, only read so that it can be shared
+    :param negative_sampler: the NegativeSampler drawing the negative items
+    :param random_state: numpy.random.RandomState, or the numpy.random module for the global stream
+    :param include_last_batch: also yield the smaller last batch of every epoch instead of dropping it
+    :param buffers: (optional) (pair_buffer, negative_buffer) of shapes (batch_size, 2) and
+           (batch_size, N_Negative). Every full batch is written into them instead of new arrays, so a batch
+           is only valid until the next one is drawn. random_state must be a numpy.random.Generator.
+    """
+    order = numpy.arange(len(user_item_pairs))
+    while True:
+        random_state.shuffle(order)
+        for i in range(batches_per_epoch(len(user_item_pairs), batch_size, include_last_batch)):
+            index = order[i * batch_size: (i + 1) * batch_size]
+            if buffers is not None and len(index) == batch_size:
+                user_positive_items_pairs = numpy.take(user_item_pairs, index, axis=0, out=buffers[0])
+                negative_samples = negative_sampler.sample(user_positive_items_pairs[:, 0], random_state,
+                                                           out=buffers[1])
+            else:
+                user_positive_items_pairs = user_item_pairs[index, :]
+                negative_samples = negative_sampler.sample(user_positive_items_pairs[:, 0], random_state)
+
+            yield user_positive_items_pairs, negative_samples
+
+
+def prefetch_batches(user_item_pairs, batch_size, negative_sampler, include_last_batch, seed, batch_queue, stop):
+    """
+    Worker loop of WarpSampler: put batches drawn with its own random stream into batch_queue until stop is set
+    """
+    random_state = numpy.random.RandomState(seed)
+    for batch in sample_batches(user_item_pairs, batch_size, negative_sampler, random_state, include_last_batch):
+        while not stop.is_set():
+            try:
+                batch_queue.put(batch, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        if stop.is_set():
+            return
+
+
+class WarpSampler(object):
+    """
+    A generator that generate tuples: user-positive-item pairs, negative-items
+
+    of shapes (Batch Size, 2) and (Batch Size, N_Negative)
+
+    With n_workers > 0 the batches are generated in the background: every worker runs its own epochs over the
+    user-item pairs with its own random stream, and fills a bounded queue the trainer reads from.
+    Call close() (or use the sampler as a context manager) to stop the workers.
+
+    `step` counts the batches handed out, `epoch` and `epoch_step` locate them in the epochs. They are exact
+    without workers; with workers an epoch is the number of batches that one epoch holds.
+    """
+
+    def __init__(self, user_item_matrix, batch_size=10000, n_negative=10, exact_negatives=False,
+                 popularity_exponent=None, include_last_batch=False, reuse_buffers=False, n_workers=0,
+                 use_processes=False, max_queue_size=8, seed=None):
+        """
+        :param user_item_matrix: the train user-item matrix
+        :param batch_size: number of user-positive-item pairs per batch
+        :param n_negative: number of negative items per pair
+        :param exact_negatives: never use a user's positive items as its negatives (see NegativeSampler)
+        :param popularity_exponent: draw negatives by popularity ** popularity_exponent instead of uniformly
+        :param include_last_batch: also emit the smaller last batch of every epoch instead of dropping it
+        :param reuse_buffers: write every full batch into the same preallocated arrays, which stay valid
+               until the next batch is drawn. Only without workers; draws from numpy.random.Generator(PCG64(seed)),
+               seeded from the OS entropy if seed is None, never from the global numpy.random stream
+        :param n_workers: number of background workers, 0 generates the batches on the calling thread
+               from RandomState(seed), or from the global numpy.random stream if seed is None (unless reuse_buffers)
+        :param use_processes: run the workers as processes instead of threads
+        :param max_queue_size: number of ready batches the workers may keep ahead of the trainer
+        :param seed: seed of the random streams, worker i uses RandomState([seed, i])
+        """
+        if reuse_buffers and n_workers:
+            raise ValueError("reuse_buffers needs n_workers=0, queued batches cannot share one buffer")
+        self.user_item_matrix = item_index(user_item_matrix)
+        self.user_item_pairs = numpy.asarray(self.user_item_matrix.nonzero()).T
+        self.batch_size = batch_size
+        self.n_negative = n_negative
+        self.negative_sampler = NegativeSampler(self.user_item_matrix, n_negative, exact=exact_negatives,
+                                                popularity_exponent=popularity_exponent)
+        self.include_last_batch = include_last_batch
+        self.batches_per_epoch = batches_per_epoch(len(self.user_item_pairs), batch_size, include_last_batch)
+        if self.batches_per_epoch == 0:
+            # every epoch would be empty: epoch would divide by zero and sample would never yield
+            raise ValueError("{} user-item pairs do not fill a batch of {}, lower batch_size or set "
+                             "include_last_batch=True".format(len(self.user_item_pairs), batch_size))
+        self.n_workers = n_workers
+        self.seed = seed
+        self.buffers = None
+        if reuse_buffers:
+            self.buffers = (numpy.empty((batch_size, 2), dtype=self.user_item_pairs.dtype),
+                            numpy.empty((batch_size, n_negative), dtype=numpy.int64))
+        self._batches = None
+        self.step = 0
+
+        # trainer side queue statistics
+        self.n_stalls = 0
+        self.wait_time = 0.
+        self.queue_depth_sum = 0
+        self.min_queue_depth = None
+
+        self.workers = []
+        if n_workers:
+            if use_processes:
+                self.batch_queue = multiprocessing.Queue(max_queue_size)
+                self.stop_event = multiprocessing.Event()
+                worker_type = multiprocessing.Process
+            else:
+                self.batch_queue = queue.Queue(max_queue_size)
+                self.stop_event = threading.Event()
+                worker_type = threading.Thread
+            for i in range(n_workers):
+                worker_seed = None if seed is None else [seed, i]
+                worker = worker_type(target=prefetch_batches,
+                                     args=(self.user_item_pairs, batch_size, self.negative_sampler,
+                                           include_last_batch, worker_seed, self.batch_queue, self.stop_event))
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+
+    @property
+    def epoch(self):
+        return self.step // self.batches_per_epoch
+
+    @property
+    def epoch_step(self):
+        return self.step % self.batches_per_epoch
+
+    @property
+    def sample(self):
+        if self.n_workers:
+            batches = iter(self.get_prefetched, None)
+        elif self.buffers is not None:
+            batches = sample_batches(self.user_item_pairs, self.batch_size, self.negative_sampler,
+                                     numpy.random.Generator(numpy.random.PCG64(self.seed)),
+                                     self.include_last_batch, self.buffers)
+        else:
+            random_state = numpy.random if self.seed is None else numpy.random.RandomState(self.seed)
+            batches = sample_batches(self.user_item_pairs, self.batch_size, self.negative_sampler, random_state,
+                                     self.include_last_batch)
+        for batch in batches:
+            self.step += 1
+            yield batch
+
+    def next_batch(self):
+        if self._batches is None:
+            self._batches = self.sample
+        return self._batches.__next__()
+
+    def get_prefetched(self):
+        try:
+            depth = self.batch_queue.qsize()
+        except NotImplementedError:
+            # multiprocessing.Queue.qsize is not available on every platform
+            depth = 0
+        self.queue_depth_sum += depth
+        self.min_queue_depth = depth if self.min_queue_depth is None else min(self.min_queue_depth, depth)
+        if depth == 0:
+            self.n_stalls += 1
+        start = time.time()
+        batch = self.batch_queue.get()
+        self.wait_time += time.time() - start
+        return batch
+
+    def stats(self):
+        """
+        :return: the queue statistics seen by the trainer: number of batches taken, the mean and minimum number
+                 of ready batches when one was requested, how often the queue was empty (stalls) and the total
+                 seconds spent waiting on it
+        """
+        return {"batches": self.step,
+                "mean_queue_depth": self.queue_depth_sum / float(max(self.step, 1)),
+                "min_queue_depth": self.min_queue_depth,
+                "stalls": self.n_stalls,
+                "wait_time": self.wait_time}
+
+    def close(self):
+        """
+        Stop and join the background workers
+        """
+        if not self.workers:
+            return
+        self.stop_event.set()
+        for worker in self.workers:
+            # drain the queue so that no worker stays blocked on a full queue
+            while worker.is_alive():
+                try:
+                    self.batch_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+                worker.join(timeout=0.1)
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
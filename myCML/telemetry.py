@@ -0,0 +1,158 @@
+"""
+Per-step training telemetry for CML: phase timings, throughput, impostor fraction, embedding norm histograms and
+peak RSS, written as one JSON record per line, with optional cProfile or TensorFlow traces every N steps
+"""
+import cProfile
+import contextlib
+import json
+import os
+import resource
+import sys
+import time
+
+import numpy
+
+PROFILERS = ("cprofile", "tf")
+
+
+def peak_rss_mb():
+    """
+    :return: the peak resident set size of this process in MB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2. ** 20 if sys.platform == "darwin" else peak / 2. ** 10
+
+
+def norm_histogram(embeddings, bins=20, max_norm=None):
+    """
+    :return: {"counts": [...], "edges": [...]} the histogram of the row norms of embeddings
+    """
+    norms = numpy.sqrt(numpy.square(embeddings).sum(1))
+    counts, edges = numpy.histogram(norms, bins=bins, range=(0, max_norm or norms.max()))
+    return {"counts": counts.tolist(), "edges": edges.tolist()}
+
+
+def to_json(value):
+    # numpy scalars and arrays
+    return value.tolist() if hasattr(value, "tolist") else str(value)
+
+
+class Telemetry(object):
+    """
+    Collect the timings of the phases of every training step and write one record per step and per evaluation
+    to a JSONL file. Without a path the records are only kept in `last_record`.
+    """
+
+    def __init__(self, path=None, profile_every=None, profiler="cprofile", profile_dir=None, histogram_bins=20):
+        """
+        :param path: (optional) the JSONL file the records are appended to
+        :param profile_every: (optional) profile one step every profile_every steps
+        :param profiler: "cprofile" dumps a pstats file of the whole step, "tf" a chrome trace of sess.run
+               from tf.RunMetadata (open in chrome://tracing)
+        :param profile_dir: the directory of the profiles (default: the directory of path)
+        :param histogram_bins: number of bins of the embedding norm histograms
+        """
+        if profiler not in PROFILERS:
+            raise ValueError("profiler must be one of {}".format(PROFILERS))
+        self.path = path
+        self.profile_every = profile_every
+        self.profiler = profiler
+        self.profile_dir = profile_dir or os.path.dirname(os.path.abspath(path or "telemetry.jsonl"))
+        if path is not None and not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+            os.makedirs(os.path.dirname(os.path.abspath(path)))
+        if profile_every and not os.path.isdir(self.profile_dir):
+            os.makedirs(self.profile_dir)
+        self.sink = open(path, "a") if path is not None else None
+        self.histogram_bins = histogram_bins
+        self.timings = {}
+        self.step_start = None
+        self.profile = None
+        self.last_record = None
+
+    @contextlib.contextmanager
+    def timed(self, phase):
+        """
+        Time the block as `phase` of the current step
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[phase] = self.timings.get(phase, 0.) + time.time() - start
+
+    def profiling(self, step):
+        return bool(self.profile_every) and step % self.profile_every == 0
+
+    def start_step(self, step):
+        self.timings = {}
+        self.step_start = time.time()
+        if self.profiling(step) and self.profiler == "cprofile":
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def run(self, sess, fetches, feed_dict, step):
+        """
+        sess.run(fetches, feed_dict), timed as the "run" phase and traced on the profiled steps with profiler="tf"
+        """
+        with self.timed("run"):
+            if not (self.profiling(step) and self.profiler == "tf"):
+                return sess.run(fetches, feed_dict)
+            import tensorflow as tf
+            from tensorflow.python.client import timeline
+            run_metadata = tf.RunMetadata()
+            result = sess.run(fetches, feed_dict, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                              run_metadata=run_metadata)
+        with open(os.path.join(self.profile_dir, "step-{}.trace.json".format(step)), "w") as f:
+            f.write(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format())
+        return result
+
+    def end_step(self, step, n_pairs, loss, impostor_fraction=None):
+        """
+        Write the record of a training step
+        :param n_pairs: number of user-positive-item pairs of the batch
+        """
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(os.path.join(self.profile_dir, "step-{}.prof".format(step)))
+            self.profile = None
+        seconds = time.time() - self.step_start
+        record = {"event": "step", "step": step, "time": time.time(), "seconds": seconds,
+                  "pairs_per_second": n_pairs / seconds, "loss": loss, "impostor_fraction": impostor_fraction,
+                  "peak_rss_mb": peak_rss_mb()}
+        for phase, phase_seconds in self.timings.items():
+            record[phase + "_seconds"] = phase_seconds
+        self.write(record)
+
+    def evaluation(self, step, metrics, seconds, user_embeddings=None, item_embeddings=None, max_norm=None):
+        """
+        Write the record of an evaluation, with the norm histograms of the embeddings given
+        :param metrics: a dict of validation metrics
+        :param seconds: the duration of the evaluation
+        :param max_norm: the upper edge of the histograms, e.g. the clip_norm
+        """
+        record = {"event": "evaluation", "step": step, "time": time.time(), "eval_seconds": seconds,
+                  "peak_rss_mb": peak_rss_mb()}
+        record.update(metrics)
+        for name, embeddings in (("user", user_embeddings), ("item", item_embeddings)):
+            if embeddings is not None:
+                record[name + "_norm_histogram"] = norm_histogram(embeddings, self.histogram_bins, max_norm)
+        self.write(record)
+        if self.sink is not None:
+            self.sink.flush()
+
+    def write(self, record):
+        self.last_record = record
+        if self.sink is not None:
+            self.sink.write(json.dumps(record, default=to_json) + "\n")
+
+    def close(self):
+        if self.sink is not None:
+            self.sink.close()
+            self.sink = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
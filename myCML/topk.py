@@ -0,0 +1,87 @@
+import numpy
+
+from utils import scatter_rows
+
+BOUND_TOLERANCE = 1e-4
+
+
+def exact_top_k(user_embeddings, item_embeddings, k, user_ids=None, exclude=None, users_chunk=1024,
+                items_block=4096):
+    """
+    Exact Top-K items of each user by CML distance, without the (N_USER, N_ITEM) score matrix.
+
+    Users are processed in chunks, items in blocks of similar norm, and every chunk keeps a running
+    (users_chunk, k) Top-K merged with each block. Since ||u - v|| >= | ||u|| - ||v|| |, a block whose norm range
+    is farther from every user of the chunk than their current K-th neighbour is skipped without scoring.
+    Embeddings clipped by clip_norm keep the norms in a small range, so the bound prunes most when the norms
+    spread out in it.
+
+    :param user_embeddings: (|U|, K) user embeddings
+    :param item_embeddings: (|V|, K) item embeddings
+    :param k: number of items per user
+    :param user_ids: (optional) the users to retrieve for (default: every user)
+    :param exclude: (optional) a canonical csr user-item matrix of the items never returned, e.g. the train set
+    :param users_chunk: number of users scored at once
+    :param items_block: number of items scored at once
+    :return: (top_items, top_scores, pruned) the (len(user_ids), k) item ids best first, their scores
+             (minus the squared distance, as CML.item_scores) and the fraction of (chunk, block) pairs skipped
+    """
+    user_ids = numpy.arange(len(user_embeddings)) if user_ids is None else numpy.asarray(user_ids)
+    # items sorted by decreasing norm, so that every block spans a narrow norm range
+    item_squared_norms = numpy.square(item_embeddings).sum(1)
+    order = numpy.argsort(-item_squared_norms, kind="mergesort")
+    positions = numpy.empty_like(order)
+    positions[order] = numpy.arange(len(order))
+    sorted_items = item_embeddings[order]
+    sorted_squared_norms = item_squared_norms[order]
+    sorted_norms = numpy.sqrt(sorted_squared_norms)
+    block_starts = numpy.arange(0, len(order), items_block)
+    block_max_norms = sorted_norms[block_starts]
+    block_min_norms = sorted_norms[numpy.minimum(block_starts + items_block, len(order)) - 1]
+
+    top_items = numpy.empty((len(user_ids), k), dtype=numpy.int64)
+    top_scores = numpy.empty((len(user_ids), k), dtype=item_embeddings.dtype)
+    n_skipped = 0
+    for chunk_start in range(0, len(user_ids), users_chunk):
+        chunk = user_ids[chunk_start: chunk_start + users_chunk]
+        users = user_embeddings[chunk]
+        user_squared_norms = numpy.square(users).sum(1)
+        user_norms = numpy.sqrt(user_squared_norms)
+        # (chunk, block) lower bounds of the distances
+        bounds = numpy.square(numpy.maximum(0, numpy.maximum(block_min_norms[None, :] - user_norms[:, None],
+                                                             user_norms[:, None] - block_max_norms[None, :])))
+        if exclude is not None:
+            excluded_rows, excluded_items = scatter_rows(exclude, chunk)
+            excluded_positions = positions[excluded_items]
+            excluded = numpy.lexsort((excluded_rows, excluded_positions))
+            excluded_rows, excluded_positions = excluded_rows[excluded], excluded_positions[excluded]
+        best_distances = numpy.full((len(chunk), k), numpy.inf, dtype=item_embeddings.dtype)
+        best_positions = numpy.full((len(chunk), k), len(order), dtype=numpy.int64)
+        # the most promising blocks first, so that the K-th distance shrinks early
+        for block in numpy.argsort(bounds.min(0), kind="mergesort"):
+            # with some slack for the rounding of the computed distances
+            if (bounds[:, block] > best_distances.max(1) + BOUND_TOLERANCE).all():
+                n_skipped += 1
+                continue
+            start = block_starts[block]
+            stop = min(start + items_block, len(order))
+            distances = user_squared_norms[:, None] - 2 * users.dot(sorted_items[start: stop].T) \
+                + sorted_squared_norms[None, start: stop]
+            if exclude is not None:
+                lo, hi = numpy.searchsorted(excluded_positions, [start, stop])
+                distances[excluded_rows[lo: hi], excluded_positions[lo: hi] - start] = numpy.inf
+            # merge the block into the running Top-K
+            candidates = numpy.concatenate((best_distances, distances), 1)
+            candidate_positions = numpy.concatenate(
+                (best_positions, numpy.broadcast_to(numpy.arange(start, stop), distances.shape)), 1)
+            kept = numpy.argpartition(candidates, k - 1, axis=1)[:, :k]
+            best_distances = numpy.take_along_axis(candidates, kept, 1)
+            best_positions = numpy.take_along_axis(candidate_positions, kept, 1)
+        # best first, ties broken by item id, -1 pads the users with fewer than k retrievable items
+        best_items = numpy.where(best_positions < len(order),
+                                 order[numpy.minimum(best_positions, len(order) - 1)], -1)
+        ranked = numpy.lexsort((best_items, best_distances), axis=1)
+        top_items[chunk_start: chunk_start + len(chunk)] = numpy.take_along_axis(best_items, ranked, 1)
+        top_scores[chunk_start: chunk_start + len(chunk)] = -numpy.take_along_axis(best_distances, ranked, 1)
+    n_chunks = -(-len(user_ids) // users_chunk)
+    return top_items, top_scores, n_skipped / float(max(1, n_chunks * len(block_starts)))
@@ -0,0 +1,91 @@
+import os
+import time
+
+
+class EarlyStopping(object):
+    """
+    Patience based early stopping on a validation metric
+    """
+
+    def __init__(self, patience=10, higher_is_better=True, min_delta=0.):
+        """
+        :param patience: stop after this many evaluations without improvement
+        :param higher_is_better: False for metrics to minimize, e.g. a loss
+        :param min_delta: smallest change counted as an improvement
+        """
+        self.patience = patience
+        self.higher_is_better = higher_is_better
+        self.min_delta = min_delta
+        self.best = None
+        self.best_step = None
+        self.bad_rounds = 0
+
+    def update(self, value, step):
+        """
+        :return: True if value is the best so far
+        """
+        gain = value - self.best if self.best is not None else None
+        if gain is not None and not self.higher_is_better:
+            gain = -gain
+        if gain is None or gain > self.min_delta:
+            self.best, self.best_step, self.bad_rounds = value, step, 0
+            return True
+        self.bad_rounds += 1
+        return False
+
+    @property
+    def should_stop(self):
+        return self.bad_rounds >= self.patience
+
+
+class TrainingBudget(object):
+    """
+    Upper bounds on the number of training steps and the wall-clock time, None means unbounded
+    """
+
+    def __init__(self, max_steps=None, max_seconds=None):
+        self.max_steps = max_steps
+        self.max_seconds = max_seconds
+        self.start = time.time()
+
+    def exhausted(self, step):
+        return (self.max_steps is not None and step >= self.max_steps) or \
+               (self.max_seconds is not None and time.time() - self.start >= self.max_seconds)
+
+
+class EmbeddingCheckpointer(object):
+    """
+    Save the user and item embeddings of a CML model periodically and keep the best ones.
+    Without a checkpoint_dir nothing is written and the best embeddings are kept in memory.
+    """
+
+    def __init__(self, model, checkpoint_dir=None, max_to_keep=5):
+        self.variables = [model.user_embeddings, model.item_embeddings]
+        self.checkpoint_dir = checkpoint_dir
+        self.best_embeddings = None
+        self.best_path = None
+        if checkpoint_dir is not None:
+            # imported here so that EarlyStopping and TrainingBudget also serve the NumPy backend
+            import tensorflow as tf
+            if not os.path.isdir(os.path.join(checkpoint_dir, "best")):
+                os.makedirs(os.path.join(checkpoint_dir, "best"))
+            self.saver = tf.train.Saver(self.variables, max_to_keep=max_to_keep)
+            self.best_saver = tf.train.Saver(self.variables, max_to_keep=1)
+
+    def save(self, sess, step):
+        if self.checkpoint_dir is not None:
+            return self.saver.save(sess, os.path.join(self.checkpoint_dir, "embeddings"), global_step=step)
+
+    def save_best(self, sess, step):
+        if self.checkpoint_dir is None:
+            self.best_embeddings = sess.run(self.variables)
+        else:
+            self.best_path = self.best_saver.save(sess, os.path.join(self.checkpoint_dir, "best", "embeddings"),
+                                                  global_step=step)
+
+    def restore_best(self, sess):
+        if self.best_path is not None:
+            self.best_saver.restore(sess, self.best_path)
+        elif self.best_embeddings is not None:
+            for variable, value in zip(self.variables, self.best_embeddings):
+                variable.load(value, sess)
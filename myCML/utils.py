@@ -1,67 +1,149 @@
-from collections import defaultdict
-
+import os
 import random
+import sys
 import numpy as np
-from scipy.sparse import dok_matrix, lil_matrix
-from tqdm import tqdm
-
-
-def citeulike(tag_occurence_thres=10):
-    user_dict = defaultdict(set)
-    for u, item_list in enumerate(open("citeulike-t/users.dat").readlines()):
-        items = item_list.strip().split(" ")
-        for item in items:
-            user_dict[u].add(int(item))
-
-    n_users = len(user_dict)
-    n_items = max([item for items in user_dict.values() for item in items]) + 1
-
-    user_item_matrix = dok_matrix((n_users, n_items), dtype=np.int32)
-    for u, item_list in enumerate(open("citeulike-t/users.dat").readlines()):
-        items = item_list.strip().split(" ")
-        for item in items:
-            user_item_matrix[u, int(item)] = 1
-
-    n_features = 0
-    for l in open("citeulike-t/tag-item.dat").readlines():
-        items = l.strip().split(" ")
-        if len(items) >= tag_occurence_thres:
-            n_features += 1
+from scipy.sparse import coo_matrix, csr_matrix
+
+# common/ at the root of the repository holds the modules shared with myCDL
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+from common.cache import cached_csr_matrix
+from common.metrics import MetricsWriter, load_metrics, metrics_writer, save_columns
+
+
+# the version of read_index_lists, see cached_csr_matrix
+INDEX_LISTS_VERSION = 1
+
+
+def read_index_lists(path):
+    """
+    Parse a file holding one whitespace separated list of integer ids per line, reading it only once
+    :param path: path of the file, e.g. citeulike-t/users.dat
+    :return: a csr_matrix with one row per line whose indices are that line's ids, in file order and
+             with repetitions kept
+    """
+    lengths = []
+    tokens = []
+    with open(path) as f:
+        for line in f:
+            ids = line.split()
+            lengths.append(len(ids))
+            tokens.extend(ids)
+    ids = np.fromiter(map(int, tokens), dtype=np.int32, count=len(tokens))
+    indptr = np.concatenate(([0], np.cumsum(lengths))).astype(np.int32)
+    n_cols = int(ids.max()) + 1 if len(ids) else 0
+    return csr_matrix((np.ones(len(ids), dtype=np.int32), ids, indptr), shape=(len(lengths), n_cols))
+
+
+def binary_csr_matrix(rows, cols, shape, dtype=np.int32):
+    """
+    Build a 0/1 csr_matrix from COO index arrays, collapsing duplicated (row, col) entries
+    """
+    matrix = coo_matrix((np.ones(len(rows), dtype=dtype), (rows, cols)), shape=shape).tocsr()
+    matrix.data[:] = 1
+    return matrix
+
+
+def load_index_lists(path, cache=True):
+    """
+    read_index_lists(path) as (lengths, ids) arrays, through the binary cache unless cache is False
+    """
+    lists = cached_csr_matrix(path, read_index_lists, INDEX_LISTS_VERSION) if cache else read_index_lists(path)
+    return np.diff(lists.indptr), lists.indices
+
+
+def citeulike(tag_occurence_thres=10, data_dir="citeulike-t", cache=True):
+    """
+    Load citeulike-t as sparse matrices, parsing users.dat and tag-item.dat once each
+    :param tag_occurence_thres: keep the tags whose line in tag-item.dat has at least this many tokens
+    :param data_dir: the directory containing users.dat and tag-item.dat
+    :param cache: memory-map the parsed files from their binary cache (see cached_csr_matrix)
+    :return: (user_item_matrix, features) as csr_matrix of shapes (|U|, |V|) and (|V|, N_Features)
+    """
+    lengths, items = load_index_lists(os.path.join(data_dir, "users.dat"), cache)
+    n_users = len(lengths)
+    n_items = int(items.max()) + 1
+    users = np.repeat(np.arange(n_users), lengths)
+    user_item_matrix = binary_csr_matrix(users, items, (n_users, n_items))
+
+    lengths, tagged_items = load_index_lists(os.path.join(data_dir, "tag-item.dat"), cache)
+    # every line of tag-item.dat is a tag; only frequent tags become features
+    kept = lengths >= tag_occurence_thres
+    n_features = int(kept.sum())
     print("{} features over tag_occurence_thres ({})".format(n_features, tag_occurence_thres))
-    features = dok_matrix((n_items, n_features), dtype=np.int32)
-    feature_index = 0
-    for l in open("citeulike-t/tag-item.dat").readlines():
-        items = l.strip().split(" ")
-        if len(items) >= tag_occurence_thres:
-            features[[int(i) for i in items], feature_index] = 1
-            feature_index += 1
+    feature_ids = np.repeat(np.cumsum(kept) - 1, lengths)
+    token_kept = np.repeat(kept, lengths)
+    features = binary_csr_matrix(tagged_items[token_kept], feature_ids[token_kept], (n_items, n_features))
 
     return user_item_matrix, features
 
 
 def split_data(user_item_matrix, split_ratio=(3, 1, 1), seed=1):
-    np.random.seed(seed)
-    train = dok_matrix(user_item_matrix.shape)
-    validation = dok_matrix(user_item_matrix.shape)
-    test = dok_matrix(user_item_matrix.shape)
-    user_item_matrix = lil_matrix(user_item_matrix)
-    for user in tqdm(range(user_item_matrix.shape[0]), desc="Split data into train/valid/test"):
-        items = list(user_item_matrix[user, :].nonzero()[1])
-        if len(items) >= 5:
-
-            np.random.shuffle(items)
-
-            train_count = int(len(items) * split_ratio[0] / sum(split_ratio))
-            valid_count = int(len(items) * split_ratio[1] / sum(split_ratio))
-
-            for i in items[0: train_count]:
-                train[user, i] = 1
-            for i in items[train_count: train_count + valid_count]:
-                validation[user, i] = 1
-            for i in items[train_count + valid_count:]:
-                test[user, i] = 1
-    print("{}/{}/{} train/valid/test samples".format(
-        len(train.nonzero()[0]),
-        len(validation.nonzero()[0]),
-        len(test.nonzero()[0])))
+    """
+    Randomly split every user's items into train/validation/test by split_ratio.
+    Users with fewer than 5 items are left out of all three matrices.
+    :param user_item_matrix: the (|U|, |V|) user-item matrix, any scipy.sparse format
+    :param split_ratio: the train/validation/test proportions
+    :param seed: seed of the per-user shuffles
+    :return: (train, validation, test) as csr_matrix of the same shape as user_item_matrix
+    """
+    rng = np.random.RandomState(seed)
+    user_item_matrix = csr_matrix(user_item_matrix)
+    user_item_matrix.sum_duplicates()
+    indptr, indices = user_item_matrix.indptr, user_item_matrix.indices
+    n_users = user_item_matrix.shape[0]
+
+    lengths = np.diff(indptr)
+    users = np.repeat(np.arange(n_users), lengths)
+    # shuffle every row independently: sort the entries by a random key within each row
+    shuffled_items = indices[np.lexsort((rng.random_sample(len(indices)), users))]
+    # position of every shuffled entry inside its row
+    positions = np.arange(len(indices)) - np.repeat(indptr[:-1], lengths)
+
+    train_count = np.floor(lengths * split_ratio[0] / sum(split_ratio)).astype(np.int64)
+    valid_count = np.floor(lengths * split_ratio[1] / sum(split_ratio)).astype(np.int64)
+    train_end = np.repeat(train_count, lengths)
+    valid_end = train_end + np.repeat(valid_count, lengths)
+    eligible = np.repeat(lengths >= 5, lengths)
+
+    masks = (eligible & (positions < train_end),
+             eligible & (positions >= train_end) & (positions < valid_end),
+             eligible & (positions >= valid_end))
+    train, validation, test = [binary_csr_matrix(users[mask], shuffled_items[mask], user_item_matrix.shape,
+                                                 dtype=np.float64)
+                               for mask in masks]
+    print("{}/{}/{} train/valid/test samples".format(train.nnz, validation.nnz, test.nnz))
     return train, validation, test
+
+
+def scatter_rows(user_item_matrix, user_ids):
+    """
+    :return: (rows, items) such that user_item_matrix[user_ids[rows[j]], items[j]] are the non-zeros of those users
+    """
+    block = user_item_matrix[user_ids]
+    return np.repeat(np.arange(len(user_ids)), np.diff(block.indptr)), block.indices
+
+
+def item_index(user_item_matrix):
+    """
+    :return: user_item_matrix as a csr_matrix whose rows hold each user's items sorted and without duplicates
+    """
+    user_item_matrix = csr_matrix(user_item_matrix, copy=True)
+    user_item_matrix.eliminate_zeros()
+    user_item_matrix.sum_duplicates()
+    return user_item_matrix
+
+
+def row_items(user_item_matrix, user_id):
+    return user_item_matrix.indices[user_item_matrix.indptr[user_id]: user_item_matrix.indptr[user_id + 1]]
+
+
+def isin_sorted(sorted_items, items):
+    """
+    :return: a boolean mask of the items that appear in sorted_items, by binary search
+    """
+    if len(sorted_items) == 0:
+        return np.zeros(len(items), dtype=bool)
+    positions = np.minimum(np.searchsorted(sorted_items, items), len(sorted_items) - 1)
+    return sorted_items[positions] == items